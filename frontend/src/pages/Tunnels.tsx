@@ -248,12 +248,19 @@ const Tunnels = () => {
     setReapplyingAll(true)
     try {
       const response = await api.post('/tunnels/reapply-all')
-      if (response.data && response.data.status === 'success') {
-        alert(`${t.tunnels.reapplyAllSuccess || 'Success'}: ${response.data.message}`)
-        fetchData()
-      } else {
+      if (!response.data?.job_id) {
         throw new Error(response.data?.message || 'Failed to reapply all tunnels')
       }
+      let job = response.data.job
+      while (job.status === 'pending' || job.status === 'running') {
+        await new Promise((resolve) => setTimeout(resolve, 1000))
+        job = (await api.get(`/tunnels/reapply-all/${response.data.job_id}`)).data
+      }
+      if (job.status !== 'completed') {
+        throw new Error(job.errors?.[job.errors.length - 1] || 'Failed to reapply all tunnels')
+      }
+      alert(`${t.tunnels.reapplyAllSuccess || 'Success'}: ${job.message}`)
+      fetchData()
     } catch (error: any) {
       console.error('Failed to reapply all tunnels:', error)
       const errorMessage = error.response?.data?.detail || error.message || 'Failed to reapply all tunnels'
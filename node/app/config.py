@@ -12,6 +12,29 @@ class Settings(BaseSettings):
     panel_address: str = "panel.example.com:443"
     panel_api_port: int = 8000
     
+    panel_channel_enabled: bool = True
+    panel_channel_port: int = 4443
+    panel_channel_tls: bool = True
+    panel_channel_retry_max: float = 60.0
+    
+    restore_concurrency: int = 16
+    readiness_timeout: float = 10.0
+    
+    restart_backoff_base: float = 1.0
+    restart_backoff_max: float = 60.0
+    restart_stable_after: float = 60.0
+    restart_flap_window: float = 300.0
+    restart_flap_threshold: int = 5
+    
+    traffic_accounting_enabled: bool = True
+    
+    gost_shared_mode: bool = False
+    gost_api_port: int = 18080
+    
+    rathole_shared_mode: bool = False
+    frp_shared_mode: bool = False
+    frp_admin_port_base: int = 17400
+    
     class Config:
         env_file = ".env"
         case_sensitive = False
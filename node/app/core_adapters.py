@@ -1,6 +1,7 @@
 """Core adapters for different tunnel types"""
 from typing import Protocol, Dict, Any, Optional, List
-import subprocess
+import asyncio
+import contextlib
 import os
 import psutil
 import time
@@ -8,6 +9,15 @@ import logging
 from pathlib import Path
 import shutil
 
+from app.config import settings
+from app.pid_registry import PidRegistry
+from app.process_supervisor import ProcessSupervisor
+from app.gost_api import SharedGostInstance, build_service
+from app.shared_cores import SharedCores, SharedFrpc, SharedFrps, SharedRathole, endpoint_key
+from app.readiness import READY_PATTERNS, wait_for_ready
+from app.traffic_accounting import TrafficAccounting, tunnel_ports
+from app.tunnel_store import TunnelStore, spec_hash
+
 logger = logging.getLogger(__name__)
 def parse_address_port(address_str: str):
     """Parse address:port string, returns (host, port, is_ipv6)"""
@@ -55,15 +65,15 @@ class CoreAdapter(Protocol):
     """Protocol for core adapters"""
     name: str
     
-    def apply(self, tunnel_id: str, spec: Dict[str, Any]) -> None:
+    async def apply(self, tunnel_id: str, spec: Dict[str, Any]) -> None:
         """Apply tunnel configuration"""
         ...
     
-    def remove(self, tunnel_id: str) -> None:
+    async def remove(self, tunnel_id: str) -> None:
         """Remove tunnel"""
         ...
     
-    def status(self, tunnel_id: str) -> Dict[str, Any]:
+    async def status(self, tunnel_id: str) -> Dict[str, Any]:
         """Get tunnel status"""
         ...
 
@@ -72,16 +82,45 @@ class RatholeAdapter:
     """Rathole reverse tunnel adapter"""
     name = "rathole"
     
-    def __init__(self):
+    def __init__(self, supervisor: Optional[ProcessSupervisor] = None):
         self.config_dir = Path("/etc/cimex-node/rathole")
         self.config_dir.mkdir(parents=True, exist_ok=True)
-        self.processes = {}
+        self.supervisor = supervisor or ProcessSupervisor()
+        self.shared = SharedCores(self.supervisor, self.config_dir, self._shared_instance) if settings.rathole_shared_mode else None
+    
+    def _resolve_binary_path(self) -> str:
+        """Resolve rathole binary path"""
+        if Path("/usr/local/bin/rathole").exists():
+            return "/usr/local/bin/rathole"
+        return shutil.which("rathole") or "rathole"
+    
+    def _shared_instance(self, key: str, params: Dict[str, Any]) -> SharedRathole:
+        return SharedRathole(self.supervisor, self.config_dir, Path(self._resolve_binary_path()), key, params)
+    
+    async def _apply_shared(self, tunnel_id: str, params: Dict[str, Any], ports: List[Any], token: str):
+        """Add the tunnel's services to the rathole instance of its control endpoint"""
+        services = []
+        for i, port in enumerate(ports):
+            port_num = int(port) if isinstance(port, (int, str)) and str(port).isdigit() else port
+            if params["mode"] == "server":
+                addr = f"0.0.0.0:{port_num}"
+            else:
+                addr = f"127.0.0.1:{port_num}"
+            services.append({
+                "name": f"{tunnel_id}_{i}" if len(ports) > 1 else tunnel_id,
+                "token": token,
+                "addr": addr,
+                "port": port_num,
+            })
+        endpoint = params["bind_addr"] if params["mode"] == "server" else params["remote_addr"]
+        await self.shared.put(tunnel_id, endpoint_key(params["mode"], endpoint), params, services)
     
-    def apply(self, tunnel_id: str, spec: Dict[str, Any]):
+    async def apply(self, tunnel_id: str, spec: Dict[str, Any]):
         """Apply Rathole tunnel - supports both server and client modes"""
-        if tunnel_id in self.processes:
+        key = f"{self.name}:{tunnel_id}"
+        if key in self.supervisor.processes:
             logger.info(f"Rathole tunnel {tunnel_id} already exists, removing it first")
-            self.remove(tunnel_id)
+            await self.remove(tunnel_id)
         
         mode = spec.get('mode', 'client')
         
@@ -109,6 +148,16 @@ class RatholeAdapter:
                 bind_host = "0.0.0.0"
                 bind_port = 23333
             
+            if self.shared:
+                await self._apply_shared(tunnel_id, {
+                    "mode": "server",
+                    "bind_addr": f"{bind_host}:{bind_port}",
+                    "bind_port": bind_port,
+                    "websocket": use_websocket,
+                    "tls": bool(websocket_tls),
+                }, ports, token)
+                return
+            
             config = f"""[server]
 bind_addr = "{bind_host}:{bind_port}"
 default_token = "{token}"
@@ -136,18 +185,8 @@ bind_addr = "0.0.0.0:{port_num}"
             with open(config_path, "w") as f:
                 f.write(config)
             
-            try:
-                proc = subprocess.Popen(
-                    ["/usr/local/bin/rathole", "-s", str(config_path)],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                )
-            except FileNotFoundError:
-                proc = subprocess.Popen(
-                    ["rathole", "-s", str(config_path)],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                )
+            cmd = [self._resolve_binary_path(), "-s", str(config_path)]
+            ready_ports = [bind_port]
         else:
             remote_addr = spec.get('remote_addr', '').strip()
             token = spec.get('token', '').strip()
@@ -175,6 +214,15 @@ bind_addr = "0.0.0.0:{port_num}"
                 remote_addr = remote_addr[6:]
                 websocket_tls = True
             
+            if self.shared:
+                await self._apply_shared(tunnel_id, {
+                    "mode": "client",
+                    "remote_addr": remote_addr,
+                    "websocket": use_websocket,
+                    "tls": bool(websocket_tls),
+                }, ports, token)
+                return
+            
             config = f"""[client]
 remote_addr = "{remote_addr}"
 default_token = "{token}"
@@ -204,56 +252,42 @@ local_addr = "{local_addr}"
             with open(config_path, "w") as f:
                 f.write(config)
             
-            try:
-                proc = subprocess.Popen(
-                    ["/usr/local/bin/rathole", "-c", str(config_path)],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                )
-            except FileNotFoundError:
-                proc = subprocess.Popen(
-                    ["rathole", "-c", str(config_path)],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                )
+            cmd = [self._resolve_binary_path(), "-c", str(config_path)]
+            ready_ports = []
         
-        self.processes[tunnel_id] = proc
-        time.sleep(0.5)
-        if proc.poll() is not None:
-            stderr = proc.stderr.read().decode() if proc.stderr else "Unknown error"
-            raise RuntimeError(f"rathole failed to start: {stderr}")
+        log_file = self.config_dir / f"rathole_{tunnel_id}.log"
+        await self.supervisor.start(
+            key,
+            cmd,
+            log_path=log_file,
+            cwd=self.config_dir,
+            header=[f"Starting rathole {mode} for tunnel {tunnel_id}", f"Command: {' '.join(cmd)}"],
+        )
+        await self.supervisor.wait_ready(
+            key,
+            label="rathole",
+            tcp_ports=ready_ports,
+            patterns=READY_PATTERNS["rathole"],
+        )
     
-    def remove(self, tunnel_id: str):
+    async def remove(self, tunnel_id: str):
         """Remove Rathole tunnel"""
+        if self.shared and await self.shared.remove(tunnel_id):
+            return
         config_path = self.config_dir / f"{tunnel_id}.toml"
         
-        if tunnel_id in self.processes:
-            proc = self.processes[tunnel_id]
-            try:
-                proc.terminate()
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                proc.kill()
-            except:
-                pass
-            del self.processes[tunnel_id]
-        
-        try:
-            subprocess.run(["pkill", "-f", f"rathole.*{tunnel_id}"], check=False, timeout=3)
-        except:
-            pass
+        await self.supervisor.stop(f"{self.name}:{tunnel_id}")
             
         if config_path.exists():
             config_path.unlink()
     
-    def status(self, tunnel_id: str) -> Dict[str, Any]:
+    async def status(self, tunnel_id: str) -> Dict[str, Any]:
         """Get status"""
+        if self.shared and self.shared.owns(tunnel_id):
+            is_running = self.shared.tunnel_running(tunnel_id)
+            return {"active": is_running, "type": "rathole", "shared": True, "process_running": is_running}
         config_path = self.config_dir / f"{tunnel_id}.toml"
-        is_running = False
-        
-        if tunnel_id in self.processes:
-            proc = self.processes[tunnel_id]
-            is_running = proc.poll() is None
+        is_running = self.supervisor.is_running(f"{self.name}:{tunnel_id}")
         
         return {
             "active": config_path.exists() and is_running,
@@ -296,14 +330,14 @@ class BackhaulAdapter:
         self,
         config_dir: Optional[Path] = None,
         binary_path: Optional[Path] = None,
+        supervisor: Optional[ProcessSupervisor] = None,
     ):
         resolved_config = config_dir or Path(
             os.environ.get("CIMEX_BACKHAUL_CLIENT_DIR", "/etc/cimex-node/backhaul")
         )
         self.config_dir = Path(resolved_config)
         self.config_dir.mkdir(parents=True, exist_ok=True)
-        self.processes: Dict[str, subprocess.Popen] = {}
-        self.log_handles: Dict[str, Any] = {}
+        self.supervisor = supervisor or ProcessSupervisor()
         default_binary = binary_path or Path(
             os.environ.get("BACKHAUL_CLIENT_BINARY", "/usr/local/bin/backhaul")
         )
@@ -312,11 +346,12 @@ class BackhaulAdapter:
             Path("backhaul"),
         ]
 
-    def apply(self, tunnel_id: str, spec: Dict[str, Any]):
+    async def apply(self, tunnel_id: str, spec: Dict[str, Any]):
         """Apply Backhaul tunnel - supports both server and client modes"""
-        if tunnel_id in self.processes:
+        key = f"{self.name}:{tunnel_id}"
+        if key in self.supervisor.processes:
             logger.info(f"Backhaul tunnel {tunnel_id} already exists, removing it first")
-            self.remove(tunnel_id)
+            await self.remove(tunnel_id)
         
         mode = spec.get('mode', 'client')
         
@@ -393,27 +428,12 @@ class BackhaulAdapter:
                 if value is not None and value != "":
                     server_config[key] = value
             
+            config_content = self._render_toml({"server": server_config})
             config_path = self.config_dir / f"{tunnel_id}.toml"
-            config_path.write_text(self._render_toml({"server": server_config}), encoding="utf-8")
-            
-            binary_path = self._resolve_binary_path()
-            log_path = self.config_dir / f"backhaul_{tunnel_id}.log"
-            log_fh = log_path.open("w", buffering=1)
-            log_fh.write(f"Starting Backhaul server for tunnel {tunnel_id}\n")
-            log_fh.write(self._render_toml({"server": server_config}))
-            log_fh.flush()
-            
-            try:
-                proc = subprocess.Popen(
-                    [str(binary_path), "-c", str(config_path)],
-                    stdout=log_fh,
-                    stderr=subprocess.STDOUT,
-                    cwd=str(self.config_dir),
-                    start_new_session=True,
-                )
-            except Exception:
-                log_fh.close()
-                raise
+            config_path.write_text(config_content, encoding="utf-8")
+            header = [f"Starting Backhaul server for tunnel {tunnel_id}", config_content]
+            _, control_port, _ = parse_address_port(bind_addr)
+            ready_ports = [control_port] if transport != "udp" else []
         else:
             remote_addr = spec.get("remote_addr") or spec.get("control_addr") or spec.get("bind_addr")
             if not remote_addr:
@@ -456,59 +476,32 @@ class BackhaulAdapter:
             if spec.get("accept_udp") and transport in {"tcp", "tcpmux"}:
                 config_dict["accept_udp"] = True
 
+            config_content = self._render_toml({"client": config_dict})
             config_path = self.config_dir / f"{tunnel_id}.toml"
-            config_path.write_text(self._render_toml({"client": config_dict}), encoding="utf-8")
+            config_path.write_text(config_content, encoding="utf-8")
+            header = [f"Starting Backhaul client for tunnel {tunnel_id}", config_content]
+            ready_ports = []
 
-            binary_path = self._resolve_binary_path()
-
-            log_path = self.config_dir / f"backhaul_{tunnel_id}.log"
-            log_fh = log_path.open("w", buffering=1)
-            log_fh.write(f"Starting Backhaul client for tunnel {tunnel_id}\n")
-            log_fh.write(self._render_toml({"client": config_dict}))
-            log_fh.flush()
-
-            try:
-                proc = subprocess.Popen(
-                    [str(binary_path), "-c", str(config_path)],
-                    stdout=log_fh,
-                    stderr=subprocess.STDOUT,
-                )
-            except Exception:
-                log_fh.close()
-                raise
-
-        time.sleep(0.5)
-        if proc.poll() is not None:
-            error_output = ""
-            try:
-                error_output = log_path.read_text(encoding="utf-8")[-1000:]
-            except Exception:
-                pass
-            log_fh.close()
-            raise RuntimeError(f"backhaul failed to start: {error_output}")
-
-        self.processes[tunnel_id] = proc
-        self.log_handles[tunnel_id] = log_fh
+        binary_path = self._resolve_binary_path()
+        log_path = self.config_dir / f"backhaul_{tunnel_id}.log"
+        await self.supervisor.start(
+            key,
+            [str(binary_path), "-c", str(config_path)],
+            log_path=log_path,
+            cwd=self.config_dir,
+            header=header,
+        )
+        await self.supervisor.wait_ready(
+            key,
+            label="backhaul",
+            tcp_ports=ready_ports,
+            patterns=READY_PATTERNS["backhaul"],
+        )
 
-    def remove(self, tunnel_id: str):
+    async def remove(self, tunnel_id: str):
         config_path = self.config_dir / f"{tunnel_id}.toml"
         
-        if tunnel_id in self.processes:
-            proc = self.processes[tunnel_id]
-            try:
-                proc.terminate()
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                proc.kill()
-            except Exception:
-                pass
-            del self.processes[tunnel_id]
-        if tunnel_id in self.log_handles:
-            try:
-                self.log_handles[tunnel_id].close()
-            except Exception:
-                pass
-            del self.log_handles[tunnel_id]
+        await self.supervisor.stop(f"{self.name}:{tunnel_id}")
 
         if config_path.exists():
             try:
@@ -516,10 +509,9 @@ class BackhaulAdapter:
             except Exception:
                 pass
 
-    def status(self, tunnel_id: str) -> Dict[str, Any]:
+    async def status(self, tunnel_id: str) -> Dict[str, Any]:
         config_path = self.config_dir / f"{tunnel_id}.toml"
-        proc = self.processes.get(tunnel_id)
-        is_running = proc is not None and proc.poll() is None
+        is_running = self.supervisor.is_running(f"{self.name}:{tunnel_id}")
         return {
             "active": config_path.exists() and is_running,
             "type": "backhaul",
@@ -569,11 +561,10 @@ class ChiselAdapter:
     """Chisel reverse tunnel adapter"""
     name = "chisel"
     
-    def __init__(self):
+    def __init__(self, supervisor: Optional[ProcessSupervisor] = None):
         self.config_dir = Path("/etc/cimex-node/chisel")
         self.config_dir.mkdir(parents=True, exist_ok=True)
-        self.processes = {}
-        self.log_handles = {}
+        self.supervisor = supervisor or ProcessSupervisor()
     
     def _resolve_binary_path(self) -> Path:
         """Resolve chisel binary path"""
@@ -601,11 +592,12 @@ class ChiselAdapter:
             "Chisel binary not found. Expected at CHISEL_BINARY, '/usr/local/bin/chisel', or in PATH."
         )
     
-    def apply(self, tunnel_id: str, spec: Dict[str, Any]):
+    async def apply(self, tunnel_id: str, spec: Dict[str, Any]):
         """Apply Chisel tunnel - supports both server and client modes"""
-        if tunnel_id in self.processes:
+        key = f"{self.name}:{tunnel_id}"
+        if key in self.supervisor.processes:
             logger.info(f"Chisel tunnel {tunnel_id} already exists, removing it first")
-            self.remove(tunnel_id)
+            await self.remove(tunnel_id)
         
         mode = spec.get('mode', 'client')
         
@@ -636,23 +628,11 @@ class ChiselAdapter:
             if fingerprint:
                 cmd.extend(["--fingerprint", fingerprint])
             
-            log_file = self.config_dir / f"{tunnel_id}.log"
-            log_f = open(log_file, 'w', buffering=1)
-            try:
-                log_f.write(f"Starting chisel server for tunnel {tunnel_id}\n")
-                log_f.write(f"Command: {' '.join(cmd)}\n")
-                log_f.write(f"server_port={server_port}, reverse_port={reverse_port}\n")
-                log_f.flush()
-                proc = subprocess.Popen(
-                    cmd,
-                    stdout=log_f,
-                    stderr=subprocess.STDOUT,
-                    cwd=str(self.config_dir),
-                    start_new_session=True
-                )
-            except FileNotFoundError:
-                log_f.close()
-                raise RuntimeError("chisel binary not found. Please install chisel.")
+            header = [
+                f"Starting chisel server for tunnel {tunnel_id}",
+                f"Command: {' '.join(cmd)}",
+                f"server_port={server_port}, reverse_port={reverse_port}",
+            ]
         else:
             server_url = spec.get('server_url', '').strip()
             
@@ -706,73 +686,32 @@ class ChiselAdapter:
             reverse_specs = [f"R:{port}:127.0.0.1:{port}" for port in ports]
             logger.info(f"Chisel tunnel {tunnel_id}: ports={ports}, server_url={server_url}")
             
-            log_file = self.config_dir / f"{tunnel_id}.log"
-            log_f = open(log_file, 'w', buffering=1)
-            try:
-                log_f.write(f"Starting chisel client for tunnel {tunnel_id}\n")
-                log_f.write(f"Command: {' '.join(cmd)}\n")
-                log_f.write(f"server_url={server_url}, reverse_specs={', '.join(reverse_specs)}\n")
-                log_f.flush()
-                proc = subprocess.Popen(
-                    cmd,
-                    stdout=log_f,
-                    stderr=subprocess.STDOUT,
-                    cwd=str(self.config_dir),
-                    start_new_session=True
-                )
-            except FileNotFoundError:
-                log_f.close()
-                raise RuntimeError("chisel binary not found. Please install chisel.")
+            header = [
+                f"Starting chisel client for tunnel {tunnel_id}",
+                f"Command: {' '.join(cmd)}",
+                f"server_url={server_url}, reverse_specs={', '.join(reverse_specs)}",
+            ]
         
-        self.log_handles[tunnel_id] = log_f
-        self.processes[tunnel_id] = proc
-        time.sleep(1.0)  # Give it more time to start
-        if proc.poll() is not None:
-            stderr = ""
-            if log_file.exists():
-                with open(log_file, 'r') as f:
-                    stderr = f.read()
-            if tunnel_id in self.log_handles:
-                try:
-                    self.log_handles[tunnel_id].close()
-                except:
-                    pass
-                del self.log_handles[tunnel_id]
-            raise RuntimeError(f"chisel failed to start: {stderr[-500:] if len(stderr) > 500 else stderr}")
+        log_file = self.config_dir / f"{tunnel_id}.log"
+        try:
+            await self.supervisor.start(key, cmd, log_path=log_file, cwd=self.config_dir, header=header)
+        except FileNotFoundError:
+            raise RuntimeError("chisel binary not found. Please install chisel.")
+        await self.supervisor.wait_ready(
+            key,
+            label="chisel",
+            settle=1.0,
+            tcp_ports=[server_port] if mode == 'server' else [],
+            patterns=READY_PATTERNS["chisel"],
+        )
     
-    def remove(self, tunnel_id: str):
+    async def remove(self, tunnel_id: str):
         """Remove Chisel tunnel"""
-        if tunnel_id in self.processes:
-            proc = self.processes[tunnel_id]
-            try:
-                proc.terminate()
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                proc.kill()
-                proc.wait()
-            except:
-                pass
-            del self.processes[tunnel_id]
-        
-        if tunnel_id in self.log_handles:
-            try:
-                self.log_handles[tunnel_id].close()
-            except:
-                pass
-            del self.log_handles[tunnel_id]
-        
-        try:
-            subprocess.run(["pkill", "-f", f"chisel.*{tunnel_id}"], check=False, timeout=3)
-        except:
-            pass
+        await self.supervisor.stop(f"{self.name}:{tunnel_id}")
     
-    def status(self, tunnel_id: str) -> Dict[str, Any]:
+    async def status(self, tunnel_id: str) -> Dict[str, Any]:
         """Get status"""
-        is_running = False
-        
-        if tunnel_id in self.processes:
-            proc = self.processes[tunnel_id]
-            is_running = proc.poll() is None
+        is_running = self.supervisor.is_running(f"{self.name}:{tunnel_id}")
         
         return {
             "active": is_running,
@@ -785,11 +724,11 @@ class FrpAdapter:
     """FRP reverse tunnel adapter"""
     name = "frp"
     
-    def __init__(self):
+    def __init__(self, supervisor: Optional[ProcessSupervisor] = None):
         self.config_dir = Path("/etc/cimex-node/frp")
         self.config_dir.mkdir(parents=True, exist_ok=True)
-        self.processes = {}
-        self.log_handles = {}
+        self.supervisor = supervisor or ProcessSupervisor()
+        self.shared = SharedCores(self.supervisor, self.config_dir, self._shared_instance) if settings.frp_shared_mode else None
     
     def _resolve_binary_path(self) -> Path:
         """Resolve frpc binary path"""
@@ -816,11 +755,34 @@ class FrpAdapter:
             "frpc binary not found. Expected at FRPC_BINARY, '/usr/local/bin/frpc', or in PATH."
         )
     
-    def apply(self, tunnel_id: str, spec: Dict[str, Any]):
+    def _resolve_server_binary_path(self) -> Path:
+        """Resolve frps binary path"""
+        env_path = os.environ.get("FRPS_BINARY")
+        if env_path:
+            return Path(env_path)
+        for path in (Path("/usr/local/bin/frps"), Path("/usr/bin/frps")):
+            if path.exists() and path.is_file():
+                return path
+        resolved = shutil.which("frps")
+        if resolved:
+            return Path(resolved)
+        raise FileNotFoundError("frps binary not found. Expected at FRPS_BINARY, '/usr/local/bin/frps', or in PATH.")
+    
+    def _shared_instance(self, key: str, params: Dict[str, Any]):
+        if params["mode"] == "server":
+            return SharedFrps(self.supervisor, self.config_dir, self._resolve_server_binary_path(), key, params)
+        used = {getattr(instance, "admin_port", None) for instance in self.shared.instances.values()}
+        admin_port = settings.frp_admin_port_base
+        while admin_port in used:
+            admin_port += 1
+        return SharedFrpc(self.supervisor, self.config_dir, self._resolve_binary_path(), key, params, admin_port=admin_port)
+    
+    async def apply(self, tunnel_id: str, spec: Dict[str, Any]):
         """Apply FRP tunnel - supports both server and client modes"""
-        if tunnel_id in self.processes:
+        key = f"{self.name}:{tunnel_id}"
+        if key in self.supervisor.processes:
             logger.info(f"FRP tunnel {tunnel_id} already exists, removing it first")
-            self.remove(tunnel_id)
+            await self.remove(tunnel_id)
         
         mode = spec.get('mode', 'client')
         
@@ -828,6 +790,14 @@ class FrpAdapter:
             bind_port = spec.get('bind_port', 7000)
             token = spec.get('token')
             
+            if self.shared:
+                try:
+                    params = {"mode": "server", "bind_port": int(bind_port), "token": token}
+                    await self.shared.put(tunnel_id, endpoint_key("frps", bind_port), params, [])
+                except FileNotFoundError:
+                    raise RuntimeError("FRP server binary (frps) not found. Please install FRP.")
+                return
+            
             config_file = self.config_dir / f"frps_{tunnel_id}.yaml"
             config_content = f"""bindPort: {bind_port}
 """
@@ -842,25 +812,7 @@ class FrpAdapter:
             
             logger.info(f"FRP server tunnel {tunnel_id}: bind_port={bind_port}, token={'set' if token else 'none'}")
             
-            env_path = os.environ.get("FRPS_BINARY")
-            if env_path:
-                binary_path = Path(env_path)
-            else:
-                common_paths = [
-                    Path("/usr/local/bin/frps"),
-                    Path("/usr/bin/frps"),
-                ]
-                binary_path = None
-                for path in common_paths:
-                    if path.exists() and path.is_file():
-                        binary_path = path
-                        break
-                if not binary_path:
-                    resolved = shutil.which("frps")
-                    if resolved:
-                        binary_path = Path(resolved)
-                    else:
-                        raise FileNotFoundError("frps binary not found. Expected at FRPS_BINARY, '/usr/local/bin/frps', or in PATH.")
+            binary_path = self._resolve_server_binary_path()
             
             config_file_abs = config_file.resolve()
             cmd = [
@@ -868,23 +820,12 @@ class FrpAdapter:
                 "-c", str(config_file_abs)
             ]
             
-            log_file = self.config_dir / f"{tunnel_id}.log"
-            log_f = open(log_file, 'w', buffering=1)
-            try:
-                log_f.write(f"Starting FRP server for tunnel {tunnel_id}\n")
-                log_f.write(f"Command: {' '.join(cmd)}\n")
-                log_f.write(f"Config: bind_port={bind_port}, token={'set' if token else 'none'}\n")
-                log_f.flush()
-                proc = subprocess.Popen(
-                    cmd,
-                    stdout=log_f,
-                    stderr=subprocess.STDOUT,
-                    cwd=str(self.config_dir),
-                    start_new_session=True
-                )
-            except FileNotFoundError:
-                log_f.close()
-                raise RuntimeError("FRP server binary (frps) not found. Please install FRP.")
+            header = [
+                f"Starting FRP server for tunnel {tunnel_id}",
+                f"Command: {' '.join(cmd)}",
+                f"Config: bind_port={bind_port}, token={'set' if token else 'none'}",
+            ]
+            missing_binary_error = "FRP server binary (frps) not found. Please install FRP."
         else:
             logger.info(f"FRP tunnel {tunnel_id} received spec: {spec}")
             
@@ -920,6 +861,28 @@ class FrpAdapter:
             if not server_addr or server_addr in ["0.0.0.0", "localhost", "127.0.0.1", "::1"]:
                 raise ValueError(f"Invalid FRP server_addr: {server_addr}. Must be a valid foreign server IP address or hostname.")
             
+            if self.shared:
+                proxies = []
+                for i, port_config in enumerate(ports):
+                    if isinstance(port_config, dict):
+                        local_port = port_config.get('local')
+                        remote_port = port_config.get('remote')
+                    else:
+                        local_port = remote_port = port_config
+                    proxies.append({
+                        "name": f"{tunnel_id}_{i}" if len(ports) > 1 else tunnel_id,
+                        "type": tunnel_type,
+                        "local_ip": local_ip,
+                        "local_port": local_port,
+                        "remote_port": remote_port,
+                    })
+                params = {"mode": "client", "server_addr": server_addr, "server_port": int(server_port), "token": token}
+                try:
+                    await self.shared.put(tunnel_id, endpoint_key("frpc", server_addr, server_port), params, proxies)
+                except FileNotFoundError:
+                    raise RuntimeError("FRP binary (frpc) not found. Please install FRP.")
+                return
+            
             config_file = self.config_dir / f"frpc_{tunnel_id}.yaml"
             config_content = f"""serverAddr: "{server_addr}"
 serverPort: {server_port}
@@ -959,61 +922,31 @@ serverPort: {server_port}
                 "-c", str(config_file_abs)
             ]
             
-            log_file = self.config_dir / f"{tunnel_id}.log"
-            log_f = open(log_file, 'w', buffering=1)
-            try:
-                log_f.write(f"Starting FRP client for tunnel {tunnel_id}\n")
-                log_f.write(f"Command: {' '.join(cmd)}\n")
-                log_f.write(f"Config: type={tunnel_type}, local={local_ip}:{local_port}, remote={remote_port}, server={server_addr}:{server_port}\n")
-                log_f.flush()
-                proc = subprocess.Popen(
-                    cmd,
-                    stdout=log_f,
-                    stderr=subprocess.STDOUT,
-                    cwd=str(self.config_dir),
-                    start_new_session=True,
-                    env=os.environ.copy()
-                )
-            except FileNotFoundError:
-                log_f.close()
-                raise RuntimeError("FRP binary (frpc) not found. Please install FRP.")
+            header = [
+                f"Starting FRP client for tunnel {tunnel_id}",
+                f"Command: {' '.join(cmd)}",
+                f"Config: type={tunnel_type}, local={local_ip}:{local_port}, remote={remote_port}, server={server_addr}:{server_port}",
+            ]
+            missing_binary_error = "FRP binary (frpc) not found. Please install FRP."
         
-        self.log_handles[tunnel_id] = log_f
-        self.processes[tunnel_id] = proc
-        time.sleep(1.0)
-        if proc.poll() is not None:
-            stderr = ""
-            if log_file.exists():
-                with open(log_file, 'r') as f:
-                    stderr = f.read()
-            if tunnel_id in self.log_handles:
-                try:
-                    self.log_handles[tunnel_id].close()
-                except:
-                    pass
-                del self.log_handles[tunnel_id]
-            raise RuntimeError(f"FRP failed to start: {stderr[-500:] if len(stderr) > 500 else stderr}")
+        log_file = self.config_dir / f"{tunnel_id}.log"
+        try:
+            await self.supervisor.start(key, cmd, log_path=log_file, cwd=self.config_dir, header=header)
+        except FileNotFoundError:
+            raise RuntimeError(missing_binary_error)
+        await self.supervisor.wait_ready(
+            key,
+            label="FRP",
+            settle=1.0,
+            tcp_ports=[bind_port] if mode == 'server' else [],
+            patterns=READY_PATTERNS["frp"],
+        )
     
-    def remove(self, tunnel_id: str):
+    async def remove(self, tunnel_id: str):
         """Remove FRP tunnel"""
-        if tunnel_id in self.processes:
-            proc = self.processes[tunnel_id]
-            try:
-                proc.terminate()
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                proc.kill()
-                proc.wait()
-            except:
-                pass
-            del self.processes[tunnel_id]
-        
-        if tunnel_id in self.log_handles:
-            try:
-                self.log_handles[tunnel_id].close()
-            except:
-                pass
-            del self.log_handles[tunnel_id]
+        if self.shared and await self.shared.remove(tunnel_id):
+            return
+        await self.supervisor.stop(f"{self.name}:{tunnel_id}")
         
         config_file = self.config_dir / f"frpc_{tunnel_id}.yaml"
         if config_file.exists():
@@ -1021,19 +954,13 @@ serverPort: {server_port}
                 config_file.unlink()
             except:
                 pass
-        
-        try:
-            subprocess.run(["pkill", "-f", f"frpc.*{tunnel_id}"], check=False, timeout=3)
-        except:
-            pass
     
-    def status(self, tunnel_id: str) -> Dict[str, Any]:
+    async def status(self, tunnel_id: str) -> Dict[str, Any]:
         """Get status"""
-        is_running = False
-        
-        if tunnel_id in self.processes:
-            proc = self.processes[tunnel_id]
-            is_running = proc.poll() is None
+        if self.shared and self.shared.owns(tunnel_id):
+            is_running = self.shared.tunnel_running(tunnel_id)
+            return {"active": is_running, "type": "frp", "shared": True, "process_running": is_running}
+        is_running = self.supervisor.is_running(f"{self.name}:{tunnel_id}")
         
         return {
             "active": is_running,
@@ -1046,11 +973,11 @@ class GostAdapter:
     """GOST forwarding adapter - forwards from Iran node to Foreign server"""
     name = "gost"
     
-    def __init__(self):
+    def __init__(self, supervisor: Optional[ProcessSupervisor] = None):
         self.config_dir = Path("/etc/cimex-node/gost")
         self.config_dir.mkdir(parents=True, exist_ok=True)
-        self.processes = {}
-        self.log_handles = {}
+        self.supervisor = supervisor or ProcessSupervisor()
+        self.shared = SharedGostInstance(self.supervisor, self.config_dir) if settings.gost_shared_mode else None
     
     def _resolve_binary_path(self) -> Path:
         """Resolve gost binary path"""
@@ -1077,11 +1004,12 @@ class GostAdapter:
             "GOST binary not found. Expected at GOST_BINARY, '/usr/local/bin/gost', or in PATH."
         )
     
-    def apply(self, tunnel_id: str, spec: Dict[str, Any]):
+    async def apply(self, tunnel_id: str, spec: Dict[str, Any]):
         """Apply GOST forwarding - Iran node forwards to Foreign server"""
-        if tunnel_id in self.processes:
+        key = f"{self.name}:{tunnel_id}"
+        if key in self.supervisor.processes:
             logger.info(f"GOST tunnel {tunnel_id} already exists, removing it first")
-            self.remove(tunnel_id)
+            await self.remove(tunnel_id)
         
         ports = spec.get('ports', [])
         if not ports:
@@ -1099,10 +1027,10 @@ class GostAdapter:
         
         tunnel_type = spec.get('type', 'tcp').lower()
         use_ipv6 = spec.get('use_ipv6', False)
+        if tunnel_type not in ("tcp", "udp", "ws", "grpc", "tcpmux"):
+            raise ValueError(f"Unsupported GOST tunnel type: {tunnel_type}")
         
-        binary_path = self._resolve_binary_path()
-        cmd = [str(binary_path)]
-        
+        routes = []
         for port in ports:
             port_num = int(port) if isinstance(port, (int, str)) and str(port).isdigit() else port
             
@@ -1125,11 +1053,7 @@ class GostAdapter:
             else:
                 listen_addr = f"0.0.0.0:{port_num}"
             
-            if tunnel_type == "tcp":
-                cmd.append(f"-L=tcp://{listen_addr}/{target_addr}")
-            elif tunnel_type == "udp":
-                cmd.append(f"-L=udp://{listen_addr}/{target_addr}")
-            elif tunnel_type == "ws":
+            if tunnel_type == "ws":
                 import socket
                 try:
                     if use_ipv6:
@@ -1143,86 +1067,82 @@ class GostAdapter:
                     s.close()
                 except Exception:
                     bind_ip = "[::]" if use_ipv6 else "0.0.0.0"
-                cmd.append(f"-L=ws://{bind_ip}:{port_num}/tcp://{target_addr}")
-            elif tunnel_type == "grpc":
-                cmd.append(f"-L=grpc://{listen_addr}/{target_addr}")
-            elif tunnel_type == "tcpmux":
-                cmd.append(f"-L=tcpmux://{listen_addr}/{target_addr}")
+                listen_addr = f"{bind_ip}:{port_num}"
+            
+            routes.append((listen_addr, target_addr))
+        
+        port_numbers = [int(p) for p in ports if str(p).isdigit()]
+        if self.shared:
+            await self._apply_shared(tunnel_id, tunnel_type, routes, port_numbers)
+            return
+        
+        binary_path = self._resolve_binary_path()
+        cmd = [str(binary_path)]
+        for listen_addr, target_addr in routes:
+            if tunnel_type == "ws":
+                cmd.append(f"-L=ws://{listen_addr}/tcp://{target_addr}")
             else:
-                raise ValueError(f"Unsupported GOST tunnel type: {tunnel_type}")
+                cmd.append(f"-L={tunnel_type}://{listen_addr}/{target_addr}")
         
         log_file = self.config_dir / f"{tunnel_id}.log"
-        log_f = open(log_file, 'w', buffering=1)
+        header = [
+            f"Starting GOST forwarding for tunnel {tunnel_id}",
+            f"Command: {' '.join(cmd)}",
+            f"Forwarding: {tunnel_type}://{listen_addr} -> {target_addr}",
+        ]
         try:
-            log_f.write(f"Starting GOST forwarding for tunnel {tunnel_id}\n")
-            log_f.write(f"Command: {' '.join(cmd)}\n")
-            log_f.write(f"Forwarding: {tunnel_type}://{listen_addr} -> {target_addr}\n")
-            log_f.flush()
-            
-            proc = subprocess.Popen(
-                cmd,
-                stdout=log_f,
-                stderr=subprocess.STDOUT,
-                cwd=str(self.config_dir),
-                start_new_session=True,
-                close_fds=False
-            )
+            await self.supervisor.start(key, cmd, log_path=log_file, cwd=self.config_dir, header=header)
         except Exception as e:
-            log_f.close()
             raise RuntimeError(f"Failed to start GOST: {e}")
         
-        self.log_handles[tunnel_id] = log_f
-        self.processes[tunnel_id] = proc
-        
-        time.sleep(1.5)
-        if proc.poll() is not None:
-            stderr = ""
-            if log_file.exists():
-                with open(log_file, 'r') as f:
-                    stderr = f.read()
-            if tunnel_id in self.log_handles:
-                try:
-                    self.log_handles[tunnel_id].close()
-                except:
-                    pass
-                del self.log_handles[tunnel_id]
-            raise RuntimeError(f"GOST failed to start: {stderr[-500:] if len(stderr) > 500 else stderr}")
+        await self.supervisor.wait_ready(
+            key,
+            label="GOST",
+            tcp_ports=port_numbers if tunnel_type != "udp" else [],
+            udp_ports=port_numbers if tunnel_type == "udp" else [],
+        )
         
         logger.info(f"GOST forwarding started for tunnel {tunnel_id}: {tunnel_type}://{listen_addr} -> {target_addr}")
     
-    def remove(self, tunnel_id: str):
-        """Remove GOST tunnel"""
-        if tunnel_id in self.processes:
-            proc = self.processes[tunnel_id]
-            try:
-                proc.terminate()
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                proc.kill()
-                proc.wait()
-            except:
-                pass
-            del self.processes[tunnel_id]
-        
-        if tunnel_id in self.log_handles:
-            try:
-                self.log_handles[tunnel_id].close()
-            except:
-                pass
-            del self.log_handles[tunnel_id]
+    async def _apply_shared(self, tunnel_id: str, tunnel_type: str, routes: List[tuple], port_numbers: List[int]):
+        """Install the tunnel as services on the shared GOST instance"""
+        services = [
+            build_service(f"{tunnel_id}-{i}", tunnel_type, listen_addr, target_addr)
+            for i, (listen_addr, target_addr) in enumerate(routes)
+        ]
+        await self.shared.put_services(tunnel_id, services)
         
-        try:
-            subprocess.run(["pkill", "-f", f"gost.*{tunnel_id}"], check=False, timeout=3, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-        except:
-            pass
+        ready, reason = await wait_for_ready(
+            self.shared.is_running,
+            pgid=self.shared.pid,
+            tcp_ports=port_numbers if tunnel_type != "udp" else [],
+            udp_ports=port_numbers if tunnel_type == "udp" else [],
+            timeout=settings.readiness_timeout,
+        )
+        if not ready:
+            await self.shared.remove_services(tunnel_id)
+            raise RuntimeError(f"GOST failed to start ({reason})")
+        logger.info(f"GOST forwarding added to shared instance for tunnel {tunnel_id}: {len(services)} services")
+    
+    async def remove(self, tunnel_id: str):
+        """Remove GOST tunnel"""
+        if self.shared and tunnel_id in self.shared.services:
+            await self.shared.remove_services(tunnel_id)
+            return
+        await self.supervisor.stop(f"{self.name}:{tunnel_id}")
     
-    def status(self, tunnel_id: str) -> Dict[str, Any]:
+    async def status(self, tunnel_id: str) -> Dict[str, Any]:
         """Get status"""
-        is_running = False
+        if self.shared and tunnel_id in self.shared.services:
+            is_running = await self.shared.tunnel_running(tunnel_id)
+            return {
+                "active": is_running,
+                "type": "gost",
+                "process_running": self.shared.is_running(),
+                "shared": True
+            }
         
-        if tunnel_id in self.processes:
-            proc = self.processes[tunnel_id]
-            is_running = proc.poll() is None
+        is_running = self.supervisor.is_running(f"{self.name}:{tunnel_id}")
         
         return {
             "active": is_running,
@@ -1234,15 +1154,15 @@ class GostAdapter:
 class AdapterManager:
     """Manager for core adapters"""
     
+    RESTORE_CORE_LIMITS = {
+        "rathole": 8,
+        "backhaul": 8,
+        "chisel": 8,
+        "frp": 8,
+        "gost": 16,
+    }
+    
     def __init__(self):
-        self.adapters: Dict[str, CoreAdapter] = {
-            "rathole": RatholeAdapter(),
-            "backhaul": BackhaulAdapter(),
-            "chisel": ChiselAdapter(),
-            "frp": FrpAdapter(),
-            "gost": GostAdapter(),
-        }
-        self.active_tunnels: Dict[str, CoreAdapter] = {}
         self.config_dir = Path("/var/lib/cimex-node")
         try:
             self.config_dir.mkdir(parents=True, exist_ok=True)
@@ -1250,144 +1170,180 @@ class AdapterManager:
         except Exception as e:
             logger.error(f"Failed to create tunnel persistence directory {self.config_dir}: {e}")
             raise
-        self.tunnels_file = self.config_dir / "tunnels.json"
-        self.tunnel_configs: Dict[str, Dict[str, Any]] = {}
+        self.supervisor = ProcessSupervisor(PidRegistry(self.config_dir / "pids"))
+        self.adapters: Dict[str, CoreAdapter] = {
+            "rathole": RatholeAdapter(supervisor=self.supervisor),
+            "backhaul": BackhaulAdapter(supervisor=self.supervisor),
+            "chisel": ChiselAdapter(supervisor=self.supervisor),
+            "frp": FrpAdapter(supervisor=self.supervisor),
+            "gost": GostAdapter(supervisor=self.supervisor),
+        }
+        self.active_tunnels: Dict[str, CoreAdapter] = {}
+        # Applies, removals and restores of one tunnel run one at a time
+        self._tunnel_locks: Dict[str, asyncio.Lock] = {}
+        self.accounting = TrafficAccounting()
+        self.store = TunnelStore(self.config_dir)
+        self.tunnels_file = self.store.snapshot_path
+        self.tunnel_configs: Dict[str, Dict[str, Any]] = self.store.configs
+        self.restore_progress: Dict[str, Any] = {"state": "pending"}
         logger.info(f"Tunnel persistence file: {self.tunnels_file}")
     
     def get_adapter(self, tunnel_core: str) -> Optional[CoreAdapter]:
         """Get adapter for tunnel core"""
         return self.adapters.get(tunnel_core)
     
+    def _tunnel_lock(self, tunnel_id: str) -> asyncio.Lock:
+        lock = self._tunnel_locks.get(tunnel_id)
+        if lock is None:
+            lock = self._tunnel_locks[tunnel_id] = asyncio.Lock()
+        return lock
+    
     def _load_tunnels(self):
         """Load persisted tunnel configurations"""
-        import json
-        if self.tunnels_file.exists():
-            try:
-                file_size = self.tunnels_file.stat().st_size
-                logger.info(f"Found tunnel config file at {self.tunnels_file} (size: {file_size} bytes)")
-                
-                if file_size == 0:
-                    logger.warning(f"Tunnel config file {self.tunnels_file} is empty")
-                    self.tunnel_configs = {}
-                    return
-                
-                with open(self.tunnels_file, 'r') as f:
-                    content = f.read()
-                    if not content.strip():
-                        logger.warning(f"Tunnel config file {self.tunnels_file} contains only whitespace")
-                        self.tunnel_configs = {}
-                        return
-                    
-                    self.tunnel_configs = json.loads(content)
-                
-                logger.info(f"Loaded {len(self.tunnel_configs)} persisted tunnel configurations from {self.tunnels_file}")
-                for tunnel_id, config in self.tunnel_configs.items():
-                    core = config.get("core", "unknown")
-                    mode = config.get("spec", {}).get("mode", "N/A")
-                    logger.info(f"  - Tunnel {tunnel_id}: core={core}, mode={mode}")
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse tunnel configurations JSON from {self.tunnels_file}: {e}", exc_info=True)
-                self.tunnel_configs = {}
-            except Exception as e:
-                logger.error(f"Failed to load tunnel configurations from {self.tunnels_file}: {e}", exc_info=True)
-                self.tunnel_configs = {}
-        else:
-            logger.info(f"No tunnel configurations file found at {self.tunnels_file} (this is normal for new nodes)")
-            self.tunnel_configs = {}
-    
-    def _save_tunnels(self):
-        """Save tunnel configurations to disk"""
-        import json
-        import os
         try:
-            logger.info(f"Saving {len(self.tunnel_configs)} tunnel configurations to {self.tunnels_file}")
-            
-            temp_file = self.tunnels_file.with_suffix('.tmp')
-            with open(temp_file, 'w') as f:
-                json.dump(self.tunnel_configs, f, indent=2)
-                f.flush()
-                os.fsync(f.fileno())
-            
-            temp_file.replace(self.tunnels_file)
-            
-            if self.tunnels_file.exists():
-                file_size = self.tunnels_file.stat().st_size
-                logger.info(f"Successfully saved tunnel configurations to {self.tunnels_file} (size: {file_size} bytes, tunnels: {list(self.tunnel_configs.keys())})")
-            else:
-                logger.error(f"File {self.tunnels_file} was not created after write operation")
+            self.store.load()
         except Exception as e:
-            logger.error(f"Failed to save tunnel configurations to {self.tunnels_file}: {e}", exc_info=True)
+            logger.error(f"Failed to load tunnel configurations from {self.tunnels_file}: {e}", exc_info=True)
+        for tunnel_id, config in self.tunnel_configs.items():
+            core = config.get("core", "unknown")
+            mode = config.get("spec", {}).get("mode", "N/A")
+            logger.info(f"  - Tunnel {tunnel_id}: core={core}, mode={mode}")
     
     async def restore_tunnels(self):
-        """Restore all persisted tunnels on startup"""
-        import logging
-        logger = logging.getLogger(__name__)
-        
+        """Restore all persisted tunnels on startup, server-mode tunnels first"""
         logger.info(f"Starting tunnel restoration from {self.tunnels_file}")
         logger.info(f"Config directory exists: {self.config_dir.exists()}, writable: {os.access(self.config_dir, os.W_OK) if self.config_dir.exists() else False}")
         logger.info(f"Tunnels file exists: {self.tunnels_file.exists()}")
         
+        await self.supervisor.reap_orphans()
         self._load_tunnels()
         
+        self.restore_progress = {
+            "state": "running",
+            "total": len(self.tunnel_configs),
+            "restored": 0,
+            "failed": 0,
+            "skipped": 0,
+            "started_at": time.time(),
+            "finished_at": None,
+            "errors": {},
+        }
+        
         if not self.tunnel_configs:
             logger.info("No persisted tunnels to restore")
+            self._finish_restore()
             return
         
-        logger.info(f"Restoring {len(self.tunnel_configs)} persisted tunnels...")
-        restored = 0
-        failed = 0
+        servers = []
+        clients = []
+        for tunnel_id, config in list(self.tunnel_configs.items()):
+            tunnel_core = config.get("core")
+            spec = config.get("spec", {})
+            
+            if not tunnel_core:
+                self._restore_failed(tunnel_id, "Missing core")
+                continue
+            if not spec:
+                self._restore_failed(tunnel_id, "Empty spec")
+                continue
+            adapter = self.get_adapter(tunnel_core)
+            if not adapter:
+                self._restore_failed(tunnel_id, f"Unknown core {tunnel_core}")
+                continue
+            
+            mode = spec.get('mode', 'N/A')
+            if tunnel_core in ["rathole", "backhaul", "chisel", "frp"] and mode == 'N/A':
+                logger.warning(f"Tunnel {tunnel_id}: Reverse tunnel missing mode field, defaulting to client")
+                spec['mode'] = 'client'
+            
+            entry = (tunnel_id, tunnel_core, spec, adapter)
+            if spec.get('mode') == 'server':
+                servers.append(entry)
+            else:
+                clients.append(entry)
+        
+        logger.info(
+            f"Restoring {len(servers) + len(clients)} persisted tunnels "
+            f"({len(servers)} server, {len(clients)} client, concurrency={settings.restore_concurrency})..."
+        )
         
-        for tunnel_id, config in self.tunnel_configs.items():
-            try:
-                tunnel_core = config.get("core")
-                spec = config.get("spec", {})
-                
-                if not tunnel_core:
-                    logger.warning(f"Tunnel {tunnel_id}: Missing core, skipping")
-                    failed += 1
-                    continue
-                
-                if not spec:
-                    logger.warning(f"Tunnel {tunnel_id}: Empty spec, skipping")
-                    failed += 1
-                    continue
-                
-                adapter = self.get_adapter(tunnel_core)
-                if not adapter:
-                    logger.warning(f"Tunnel {tunnel_id}: Unknown core {tunnel_core}, skipping")
-                    failed += 1
-                    continue
-                
-                mode = spec.get('mode', 'N/A')
-                logger.info(f"Restoring tunnel {tunnel_id}: core={tunnel_core}, mode={mode}, spec_keys={list(spec.keys())}")
-                
-                if tunnel_core in ["rathole", "backhaul", "chisel", "frp"] and mode == 'N/A':
-                    logger.warning(f"Tunnel {tunnel_id}: Reverse tunnel missing mode field, defaulting to client")
-                    spec['mode'] = 'client'
-                
-                try:
-                    adapter.apply(tunnel_id, spec)
-                    self.active_tunnels[tunnel_id] = adapter
-                    restored += 1
-                    logger.info(f"Successfully restored tunnel {tunnel_id} (core={tunnel_core}, mode={spec.get('mode', 'N/A')})")
-                except Exception as apply_error:
-                    logger.error(f"Failed to apply tunnel {tunnel_id} during restoration: {apply_error}", exc_info=True)
-                    failed += 1
-            except Exception as e:
-                logger.error(f"Failed to restore tunnel {tunnel_id}: {e}", exc_info=True)
-                failed += 1
+        global_limit = asyncio.Semaphore(max(1, settings.restore_concurrency))
+        core_limits = {
+            core: asyncio.Semaphore(limit) for core, limit in self.RESTORE_CORE_LIMITS.items()
+        }
         
-        logger.info(f"Tunnel restoration completed: {restored} restored, {failed} failed")
+        # Clients dial the servers, so the server side of every reverse tunnel goes first
+        for phase in (servers, clients):
+            await asyncio.gather(*(
+                self._restore_one(tunnel_id, tunnel_core, spec, adapter, global_limit, core_limits.get(tunnel_core))
+                for tunnel_id, tunnel_core, spec, adapter in phase
+            ))
+        
+        self._finish_restore()
+    
+    async def _restore_one(
+        self,
+        tunnel_id: str,
+        tunnel_core: str,
+        spec: Dict[str, Any],
+        adapter: CoreAdapter,
+        global_limit: asyncio.Semaphore,
+        core_limit: Optional[asyncio.Semaphore],
+    ):
+        """Restore a single tunnel under the global and per-core limits"""
+        async with global_limit:
+            async with core_limit or contextlib.nullcontext():
+                async with self._tunnel_lock(tunnel_id):
+                    if tunnel_id in self.active_tunnels or tunnel_id not in self.tunnel_configs:
+                        # Applied or removed by the panel while restoration was still running
+                        self.restore_progress["skipped"] += 1
+                        return
+                    try:
+                        logger.info(f"Restoring tunnel {tunnel_id}: core={tunnel_core}, mode={spec.get('mode', 'N/A')}")
+                        await adapter.apply(tunnel_id, spec)
+                        self.active_tunnels[tunnel_id] = adapter
+                        await self._install_counters(tunnel_id, spec)
+                        self.restore_progress["restored"] += 1
+                        logger.info(f"Successfully restored tunnel {tunnel_id} (core={tunnel_core}, mode={spec.get('mode', 'N/A')})")
+                    except Exception as e:
+                        logger.error(f"Failed to apply tunnel {tunnel_id} during restoration: {e}", exc_info=True)
+                        self._restore_failed(tunnel_id, str(e))
+    
+    def _restore_failed(self, tunnel_id: str, error: str):
+        logger.warning(f"Tunnel {tunnel_id}: {error}, skipping")
+        self.restore_progress["failed"] += 1
+        self.restore_progress["errors"][tunnel_id] = error[:500]
+    
+    def _finish_restore(self):
+        self.restore_progress["state"] = "completed"
+        self.restore_progress["finished_at"] = time.time()
+        logger.info(
+            f"Tunnel restoration completed: {self.restore_progress['restored']} restored, "
+            f"{self.restore_progress['failed']} failed, {self.restore_progress['skipped']} skipped"
+        )
+    
+    def is_ready(self) -> bool:
+        """Return True once startup restoration has finished"""
+        return self.restore_progress.get("state") == "completed"
     
-    async def apply_tunnel(self, tunnel_id: str, tunnel_core: str, spec: Dict[str, Any]):
-        """Apply tunnel using appropriate adapter"""
-        import logging
-        logger = logging.getLogger(__name__)
+    async def apply_tunnel(self, tunnel_id: str, tunnel_core: str, spec: Dict[str, Any], persist: bool = True, force: bool = False) -> str:
+        """Apply tunnel using appropriate adapter; returns "unchanged" if it was already running this spec"""
+        async with self._tunnel_lock(tunnel_id):
+            return await self._apply_locked(tunnel_id, tunnel_core, spec, persist, force)
+    
+    async def _apply_locked(self, tunnel_id: str, tunnel_core: str, spec: Dict[str, Any], persist: bool, force: bool) -> str:
         logger.info(f"Applying tunnel {tunnel_id}: core={tunnel_core}")
+        # Hash the spec as sent by the panel, before adapters add defaults to it
+        applied_hash = spec_hash(tunnel_core, spec)
+        
+        if not force and await self._is_unchanged(tunnel_id, tunnel_core, applied_hash):
+            logger.info(f"Tunnel {tunnel_id} already running with the same spec, leaving it untouched")
+            await self._install_counters(tunnel_id, spec)
+            return "unchanged"
         
         if tunnel_id in self.active_tunnels:
             logger.info(f"Tunnel {tunnel_id} already exists, removing it first")
-            await self.remove_tunnel(tunnel_id)
+            await self._remove_locked(tunnel_id, persist=persist, keep_counters=True)
         
         adapter = self.get_adapter(tunnel_core)
         if not adapter:
@@ -1396,37 +1352,153 @@ class AdapterManager:
             raise ValueError(error_msg)
         
         logger.info(f"Using adapter: {adapter.name}, mode={spec.get('mode', 'N/A')}")
-        adapter.apply(tunnel_id, spec)
+        await adapter.apply(tunnel_id, spec)
         self.active_tunnels[tunnel_id] = adapter
+        await self._install_counters(tunnel_id, spec)
         
-        self.tunnel_configs[tunnel_id] = {
+        self.store.put(tunnel_id, {
             "core": tunnel_core,
-            "spec": spec.copy()
-        }
-        logger.info(f"Saving tunnel {tunnel_id} to persistent storage (core={tunnel_core}, mode={spec.get('mode', 'N/A')})")
-        self._save_tunnels()
-        logger.info(f"Tunnel {tunnel_id} applied and saved successfully (core={tunnel_core}, mode={spec.get('mode', 'N/A')}, total_saved={len(self.tunnel_configs)})")
+            "spec": spec.copy(),
+            "spec_hash": applied_hash
+        }, sync=persist)
+        logger.info(f"Tunnel {tunnel_id} applied successfully (core={tunnel_core}, mode={spec.get('mode', 'N/A')}, total_saved={len(self.tunnel_configs)})")
+        return "applied"
     
-    async def remove_tunnel(self, tunnel_id: str):
-        """Remove tunnel"""
+    async def _install_counters(self, tunnel_id: str, spec: Dict[str, Any]):
+        """Make sure the tunnel's traffic counters exist; they are gone after a host reboot"""
+        try:
+            await self.accounting.install(tunnel_id, tunnel_ports(spec))
+        except Exception as e:
+            logger.warning(f"Failed to install traffic counters for tunnel {tunnel_id}: {e}")
+    
+    async def _is_unchanged(self, tunnel_id: str, tunnel_core: str, applied_hash: str) -> bool:
+        """True if the tunnel is live with the same core and spec hash"""
+        adapter = self.active_tunnels.get(tunnel_id)
+        config = self.tunnel_configs.get(tunnel_id)
+        if adapter is None or not config or config.get("core") != tunnel_core:
+            return False
+        stored_hash = config.get("spec_hash") or spec_hash(tunnel_core, config.get("spec") or {})
+        if stored_hash != applied_hash:
+            return False
+        try:
+            status = await adapter.status(tunnel_id)
+        except Exception as e:
+            logger.debug(f"Could not get status of tunnel {tunnel_id}: {e}")
+            return False
+        return bool(status.get("active"))
+    
+    async def remove_tunnel(self, tunnel_id: str, persist: bool = True, keep_counters: bool = False):
+        """Remove tunnel; `keep_counters` leaves its traffic counters in place for a reapply"""
+        async with self._tunnel_lock(tunnel_id):
+            await self._remove_locked(tunnel_id, persist, keep_counters)
+    
+    async def _remove_locked(self, tunnel_id: str, persist: bool, keep_counters: bool):
         if tunnel_id in self.active_tunnels:
             adapter = self.active_tunnels[tunnel_id]
-            adapter.remove(tunnel_id)
+            await adapter.remove(tunnel_id)
             del self.active_tunnels[tunnel_id]
         
-        if tunnel_id in self.tunnel_configs:
-            del self.tunnel_configs[tunnel_id]
-            self._save_tunnels()
+        if not keep_counters:
+            try:
+                await self.accounting.uninstall(tunnel_id)
+            except Exception as e:
+                logger.warning(f"Failed to remove traffic counters for tunnel {tunnel_id}: {e}")
+        self.store.delete(tunnel_id, sync=persist)
+    
+    async def apply_batch(self, operations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Run a batch of apply/remove operations concurrently and fsync state once.
+        
+        Operations on the same tunnel run in submission order; different tunnels
+        run in parallel under the restore concurrency cap. Results are returned in
+        the same order as `operations`.
+        """
+        results: List[Dict[str, Any]] = [{} for _ in operations]
+        by_tunnel: Dict[str, List[int]] = {}
+        for index, operation in enumerate(operations):
+            by_tunnel.setdefault(operation.get("tunnel_id"), []).append(index)
+        
+        limit = asyncio.Semaphore(max(1, settings.restore_concurrency))
+        
+        async def run_tunnel(indexes: List[int]):
+            async with limit:
+                for index in indexes:
+                    operation = operations[index]
+                    tunnel_id = operation.get("tunnel_id")
+                    op = operation.get("op")
+                    result = {"tunnel_id": tunnel_id, "op": op}
+                    try:
+                        if op == "apply":
+                            outcome = await self.apply_tunnel(
+                                tunnel_id,
+                                operation.get("core"),
+                                operation.get("spec") or {},
+                                persist=False,
+                                force=bool(operation.get("force")),
+                            )
+                            message = "Tunnel unchanged" if outcome == "unchanged" else "Tunnel applied"
+                            result.update({"status": "success", "message": message, "result": outcome})
+                        elif op == "remove":
+                            await self.remove_tunnel(tunnel_id, persist=False)
+                            result.update({"status": "success", "message": "Tunnel removed"})
+                        else:
+                            raise ValueError(f"Unknown operation: {op}")
+                    except Exception as e:
+                        logger.error(f"Batch {op} failed for tunnel {tunnel_id}: {e}", exc_info=True)
+                        result.update({"status": "error", "message": str(e)})
+                    results[index] = result
+        
+        try:
+            await asyncio.gather(*(run_tunnel(indexes) for indexes in by_tunnel.values()))
+        finally:
+            self.store.sync()
+        return results
+    
+    async def tunnel_states(self) -> Dict[str, Dict[str, Any]]:
+        """Spec hash and process state of every configured tunnel, for panel reconciliation"""
+        async def state(tunnel_id: str, config: Dict[str, Any]):
+            adapter = self.active_tunnels.get(tunnel_id)
+            if adapter is None:
+                process_state = "stopped"
+            else:
+                try:
+                    status = await adapter.status(tunnel_id)
+                    process_state = "running" if status.get("active") else "dead"
+                except Exception as e:
+                    logger.warning(f"Failed to get status of tunnel {tunnel_id}: {e}")
+                    process_state = "unknown"
+            core = config.get("core")
+            return tunnel_id, {
+                "core": core,
+                "spec_hash": config.get("spec_hash") or spec_hash(core, config.get("spec") or {}),
+                "state": process_state,
+            }
+        
+        results = await asyncio.gather(*(state(tunnel_id, config) for tunnel_id, config in list(self.tunnel_configs.items())))
+        return dict(results)
     
     async def get_tunnel_status(self, tunnel_id: str) -> Dict[str, Any]:
         """Get tunnel status"""
         if tunnel_id in self.active_tunnels:
             adapter = self.active_tunnels[tunnel_id]
-            return adapter.status(tunnel_id)
+            status = await adapter.status(tunnel_id)
+            status["restart"] = self.supervisor.restart_info(f"{adapter.name}:{tunnel_id}")
+            return status
         return {"active": False}
     
     async def cleanup(self):
-        """Cleanup all tunnels"""
-        for tunnel_id in list(self.active_tunnels.keys()):
-            await self.remove_tunnel(tunnel_id)
+        """Stop all tunnel processes, keeping persisted configs for the next restore"""
+        # Stop consolidated instances outright rather than reloading them once per removed tunnel
+        for name in ("rathole", "frp"):
+            if self.adapters[name].shared:
+                await self.adapters[name].shared.stop()
+        await asyncio.gather(
+            *(adapter.remove(tunnel_id) for tunnel_id, adapter in self.active_tunnels.items()),
+            return_exceptions=True,
+        )
+        self.active_tunnels.clear()
+        gost = self.adapters["gost"]
+        if gost.shared:
+            await gost.shared.stop()
+        await self.supervisor.stop_all()
+        self.store.close()
 
@@ -0,0 +1,189 @@
+"""Shared GOST v3 instance driven through its localhost config API"""
+import asyncio
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Set
+
+import httpx
+
+from app.config import settings
+from app.process_supervisor import ProcessSupervisor
+from app.readiness import wait_for_ready
+
+logger = logging.getLogger(__name__)
+
+SHARED_KEY = "gost:shared"
+
+# gost v2 URL scheme -> (v3 listener, v3 handler)
+LISTENER_TYPES = {
+    "tcp": ("tcp", "tcp"),
+    "udp": ("udp", "udp"),
+    "ws": ("ws", "tcp"),
+    "grpc": ("grpc", "tcp"),
+    "tcpmux": ("mtcp", "tcp"),
+}
+
+
+def build_service(name: str, tunnel_type: str, listen_addr: str, target_addr: str) -> Dict[str, Any]:
+    """Build a v3 forwarding service equivalent to `-L=<type>://<listen>/<target>`"""
+    if tunnel_type not in LISTENER_TYPES:
+        raise ValueError(f"Unsupported GOST tunnel type: {tunnel_type}")
+    listener, handler = LISTENER_TYPES[tunnel_type]
+    return {
+        "name": name,
+        "addr": listen_addr,
+        "handler": {"type": handler},
+        "listener": {"type": listener},
+        "forwarder": {"nodes": [{"name": f"{name}-target", "addr": target_addr}]},
+    }
+
+
+class SharedGostInstance:
+    """One long-running gost process per node; tunnels are services added over its API"""
+
+    STATUS_TTL = 1.0
+
+    def __init__(self, supervisor: ProcessSupervisor, config_dir: Path):
+        self.supervisor = supervisor
+        self.config_dir = config_dir
+        self.api_port = settings.gost_api_port
+        self.services: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = asyncio.Lock()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._live_names: Set[str] = set()
+        self._live_checked_at = 0.0
+
+    def _resolve_binary_path(self) -> Path:
+        """Resolve the gost v3 binary path"""
+        env_path = os.environ.get("GOST_SHARED_BINARY")
+        if env_path and Path(env_path).is_file():
+            return Path(env_path)
+        for path in (Path("/usr/local/bin/gost3"), Path("/usr/bin/gost3")):
+            if path.is_file():
+                return path
+        resolved = shutil.which("gost3")
+        if resolved:
+            return Path(resolved)
+        raise FileNotFoundError(
+            "gost v3 binary not found. Expected at GOST_SHARED_BINARY, '/usr/local/bin/gost3', or in PATH."
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{self.api_port}", timeout=5.0)
+        return self._client
+
+    def is_running(self) -> bool:
+        return self.supervisor.is_running(SHARED_KEY)
+
+    @property
+    def pid(self) -> Optional[int]:
+        managed = self.supervisor.get(SHARED_KEY)
+        return managed.pid if managed else None
+
+    async def ensure_running(self):
+        """Start the shared instance if needed and replay every known service into it"""
+        if self.is_running():
+            return
+        cmd = [str(self._resolve_binary_path()), "-api", f"127.0.0.1:{self.api_port}"]
+        await self.supervisor.start(
+            SHARED_KEY,
+            cmd,
+            log_path=self.config_dir / "gost_shared.log",
+            cwd=self.config_dir,
+            header=["Starting shared GOST instance", f"Command: {' '.join(cmd)}"],
+            on_restart=self._replay_after_restart,
+        )
+        await self.supervisor.wait_ready(SHARED_KEY, label="shared GOST", tcp_ports=[self.api_port])
+        await self._replay()
+        logger.info(f"Shared GOST instance ready on 127.0.0.1:{self.api_port} with {len(self.services)} tunnels")
+
+    async def _replay(self):
+        for services in self.services.values():
+            for service in services:
+                await self._upsert(service)
+        self._live_checked_at = 0.0
+
+    async def _replay_after_restart(self):
+        """Re-push every service once the supervisor has respawned a crashed instance"""
+        managed = self.supervisor.get(SHARED_KEY)
+        ready, reason = await wait_for_ready(
+            managed.is_running if managed else (lambda: False),
+            pgid=managed.pid if managed else None,
+            tcp_ports=[self.api_port],
+            timeout=settings.readiness_timeout,
+        )
+        if not ready:
+            raise RuntimeError(f"shared GOST API did not come back ({reason})")
+        async with self._lock:
+            await self._replay()
+        logger.info(f"Re-pushed {len(self.services)} tunnels to restarted shared GOST instance")
+
+    async def put_services(self, tunnel_id: str, services: List[Dict[str, Any]]):
+        """Install the services of a tunnel, replacing any it had before"""
+        async with self._lock:
+            await self.ensure_running()
+            previous = {service["name"] for service in self.services.get(tunnel_id, [])}
+            for service in services:
+                await self._upsert(service)
+            for name in previous - {service["name"] for service in services}:
+                await self._delete(name)
+            self.services[tunnel_id] = services
+            self._live_checked_at = 0.0
+
+    async def remove_services(self, tunnel_id: str):
+        """Remove every service belonging to a tunnel"""
+        async with self._lock:
+            services = self.services.pop(tunnel_id, [])
+            if self.is_running():
+                for service in services:
+                    await self._delete(service["name"])
+            self._live_checked_at = 0.0
+
+    async def tunnel_running(self, tunnel_id: str) -> bool:
+        """Return True if all services of the tunnel are present in the live service list"""
+        services = self.services.get(tunnel_id)
+        if not services or not self.is_running():
+            return False
+        live = await self._service_names()
+        return all(service["name"] in live for service in services)
+
+    async def stop(self):
+        await self.supervisor.stop(SHARED_KEY)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _service_names(self) -> Set[str]:
+        now = time.monotonic()
+        if now - self._live_checked_at < self.STATUS_TTL:
+            return self._live_names
+        try:
+            response = await self.client.get("/config", params={"format": "json"})
+            response.raise_for_status()
+            services = response.json().get("services") or []
+            self._live_names = {service.get("name") for service in services}
+        except Exception as e:
+            logger.warning(f"Could not list shared GOST services: {e}")
+            self._live_names = set()
+        self._live_checked_at = now
+        return self._live_names
+
+    async def _upsert(self, service: Dict[str, Any]):
+        response = await self.client.post("/config/services", json=service)
+        if response.status_code >= 400:
+            response = await self.client.put(f"/config/services/{service['name']}", json=service)
+        if response.status_code >= 400:
+            raise RuntimeError(f"GOST API rejected service {service['name']}: {response.text}")
+
+    async def _delete(self, name: str):
+        try:
+            response = await self.client.delete(f"/config/services/{name}")
+            if response.status_code >= 400 and response.status_code != 404:
+                logger.warning(f"GOST API failed to delete service {name}: {response.text}")
+        except Exception as e:
+            logger.warning(f"GOST API failed to delete service {name}: {e}")
@@ -0,0 +1,175 @@
+"""Persistent control channel from node to panel"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import random
+import ssl
+from typing import Dict, Any, Optional
+
+import httpx
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PanelChannel:
+    """Keeps one WebSocket open to the panel's node server.
+
+    The node dials out, so it stays reachable behind NAT without FRP. It
+    answers the panel's challenge with an HMAC under the channel secret
+    issued at registration; the channel then sends periodic heartbeats and
+    serves panel RPC frames by replaying them against this agent's own API
+    in process; requests run concurrently and replies are matched by id on
+    the panel.
+    """
+
+    def __init__(self, app, panel_client):
+        self.app = app
+        self.panel_client = panel_client
+        self.task: Optional[asyncio.Task] = None
+        self.connected = False
+        self._local: Optional[httpx.AsyncClient] = None
+        self._send_lock = asyncio.Lock()
+        self._handlers: set = set()
+
+    async def start(self):
+        """Start the connect/reconnect loop"""
+        if not settings.panel_channel_enabled:
+            logger.info("Panel control channel disabled")
+            return
+        self._local = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=self.app),
+            base_url="http://node",
+            timeout=httpx.Timeout(120.0),
+        )
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Close the channel"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self._local:
+            await self._local.aclose()
+            self._local = None
+
+    def _url(self) -> str:
+        address = self.panel_client.panel_address
+        rest = address.split("://", 1)[1] if "://" in address else address
+        host = rest.rsplit(":", 1)[0] if ":" in rest and not rest.endswith("]") else rest
+        scheme = "wss" if settings.panel_channel_tls else "ws"
+        return f"{scheme}://{host}:{settings.panel_channel_port}/channel"
+
+    def _ssl_context(self) -> Optional[ssl.SSLContext]:
+        if not settings.panel_channel_tls:
+            return None
+        context = ssl.create_default_context()
+        # The panel serves its self-signed CA certificate; like the agent's HTTP calls, do not verify it
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+
+    async def _run(self):
+        import websockets
+
+        attempt = 0
+        while True:
+            if not self.panel_client.node_id or not self.panel_client.channel_secret:
+                # Wait for registration to assign our node id and channel secret
+                await asyncio.sleep(5)
+                continue
+            url = self._url()
+            try:
+                async with websockets.connect(url, ssl=self._ssl_context(), max_size=16 * 1024 * 1024) as websocket:
+                    attempt = 0
+                    await self._session(websocket)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug(f"Panel control channel to {url} failed: {e}")
+            finally:
+                if self.connected:
+                    logger.info("Panel control channel disconnected")
+                self.connected = False
+            attempt += 1
+            delay = min(settings.panel_channel_retry_max, 2 ** min(attempt, 6))
+            await asyncio.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+    async def _send(self, websocket, message: Dict[str, Any]):
+        async with self._send_lock:
+            await websocket.send(json.dumps(message))
+
+    async def _session(self, websocket):
+        challenge = json.loads(await asyncio.wait_for(websocket.recv(), timeout=10.0))
+        if challenge.get("type") != "challenge":
+            raise ConnectionError(f"Unexpected handshake challenge: {challenge}")
+        node_id = self.panel_client.node_id
+        signature = hmac.new(
+            self.panel_client.channel_secret.encode(),
+            f"{node_id}:{challenge.get('nonce', '')}".encode(),
+            hashlib.sha256,
+        ).hexdigest()
+        await self._send(websocket, {
+            "type": "hello",
+            "node_id": node_id,
+            "role": settings.node_role,
+            "name": settings.node_name,
+            "signature": signature,
+        })
+        welcome = json.loads(await asyncio.wait_for(websocket.recv(), timeout=10.0))
+        if welcome.get("type") != "welcome":
+            raise ConnectionError(f"Unexpected handshake reply: {welcome}")
+        interval = float(welcome.get("heartbeat_interval") or 15.0)
+        self.connected = True
+        logger.info(f"Panel control channel connected (heartbeat every {interval}s)")
+
+        heartbeat = asyncio.create_task(self._heartbeat(websocket, interval))
+        try:
+            async for raw in websocket:
+                message = json.loads(raw)
+                if message.get("type") == "request":
+                    handler = asyncio.create_task(self._handle(websocket, message))
+                    self._handlers.add(handler)
+                    handler.add_done_callback(self._handlers.discard)
+        finally:
+            heartbeat.cancel()
+            for handler in list(self._handlers):
+                handler.cancel()
+
+    async def _heartbeat(self, websocket, interval: float):
+        while True:
+            adapter_manager = getattr(self.app.state, "adapter_manager", None)
+            data = {}
+            if adapter_manager:
+                data = {
+                    "ready": adapter_manager.is_ready(),
+                    "active_tunnels": len(adapter_manager.active_tunnels),
+                }
+            await self._send(websocket, {"type": "heartbeat", "data": data})
+            await asyncio.sleep(interval)
+
+    async def _handle(self, websocket, message: Dict[str, Any]):
+        """Run one panel RPC against the local agent API and send back the reply"""
+        method = message.get("method", "GET")
+        path = message.get("path", "/")
+        try:
+            response = await self._local.request(method, path, json=message.get("body") if method != "GET" else None)
+            try:
+                body = response.json()
+            except ValueError:
+                body = response.text
+            reply = {"type": "response", "id": message.get("id"), "status_code": response.status_code, "body": body}
+        except Exception as e:
+            logger.error(f"Control channel request {method} {path} failed: {e}", exc_info=True)
+            reply = {"type": "response", "id": message.get("id"), "status_code": 500, "body": {"detail": str(e)}}
+        try:
+            await self._send(websocket, reply)
+        except Exception as e:
+            logger.debug(f"Could not send reply for {path}: {e}")
@@ -20,6 +20,7 @@ class PanelClient:
         self.ca_path = Path(settings.panel_ca_path)
         self.client = None
         self.node_id = None
+        self.channel_secret: Optional[str] = None
         self.fingerprint = None
         self.registered = False
         self.using_frp = False
@@ -112,6 +113,7 @@ class PanelClient:
                     logger.info(f"[HTTP] Node registered successfully with ID: {self.node_id}")
                 
                 metadata = data.get("metadata", {})
+                self.channel_secret = metadata.get("channel_secret")
                 frp_config = metadata.get("frp_config")
                 if frp_config and frp_config.get("enabled"):
                     # Check if FRP is already running with the same config
@@ -0,0 +1,145 @@
+"""Persisted registry of core process groups, used to tear down tunnels and orphans by PID"""
+import json
+import logging
+import os
+import signal
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def process_start_time(pid: int) -> Optional[int]:
+    """Return the kernel start time of a process (clock ticks since boot), or None if it is gone"""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+    except OSError:
+        return None
+    # comm may contain spaces and parentheses; fields after it are space separated
+    fields = stat.rsplit(")", 1)[-1].split()
+    try:
+        return int(fields[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def signal_group(pgid: int, sig: int) -> bool:
+    """Send a signal to a process group, returning False if the group no longer exists"""
+    try:
+        os.killpg(pgid, sig)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError as e:
+        logger.warning(f"Not permitted to signal process group {pgid}: {e}")
+        return False
+
+
+def group_alive(pgid: int) -> bool:
+    return signal_group(pgid, 0)
+
+
+class PidRegistry:
+    """One small pidfile per supervised process key.
+
+    Adding or removing a tunnel touches only its own file, and the recorded
+    start time guards against signalling a recycled PID after a restart.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key.replace(':', '.').replace('/', '_')}.pid"
+
+    def add(self, key: str, pid: int, cmd: List[str]):
+        """Record a freshly spawned process group leader"""
+        try:
+            pgid = os.getpgid(pid)
+        except ProcessLookupError:
+            return
+        entry = {
+            "key": key,
+            "pid": pid,
+            "pgid": pgid,
+            "start_time": process_start_time(pid),
+            "cmd": cmd,
+        }
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            tmp_path.write_text(json.dumps(entry), encoding="utf-8")
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Failed to record PID {pid} for {key}: {e}")
+
+    def remove(self, key: str):
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to remove pidfile for {key}: {e}")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(self._path(key).read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def entries(self) -> List[Dict[str, Any]]:
+        result = []
+        for path in self.directory.glob("*.pid"):
+            try:
+                result.append(json.loads(path.read_text(encoding="utf-8")))
+            except Exception:
+                path.unlink(missing_ok=True)
+        return result
+
+    def is_same_process(self, entry: Dict[str, Any]) -> bool:
+        """Return True if the recorded leader is still the process we spawned"""
+        start_time = process_start_time(entry["pid"])
+        return start_time is not None and start_time == entry.get("start_time")
+
+    def kill(self, entry: Dict[str, Any], timeout: float = 5.0) -> bool:
+        """Terminate a recorded process group, escalating to SIGKILL after `timeout`"""
+        pgid = entry.get("pgid") or entry["pid"]
+        if process_start_time(entry["pid"]) is not None and not self.is_same_process(entry):
+            # The leader PID now belongs to an unrelated process
+            return False
+        if not signal_group(pgid, signal.SIGTERM):
+            return False
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not group_alive(pgid):
+                return True
+            time.sleep(0.05)
+        signal_group(pgid, signal.SIGKILL)
+        return True
+
+    def kill_key(self, key: str, timeout: float = 5.0) -> bool:
+        """Kill the process group recorded under `key`, if any, and forget it"""
+        entry = self.get(key)
+        if not entry:
+            return False
+        killed = self.kill(entry, timeout)
+        self.remove(key)
+        return killed
+
+    def reap_orphans(self, timeout: float = 5.0) -> int:
+        """Kill every recorded process group left behind by a previous run"""
+        killed = 0
+        for entry in self.entries():
+            try:
+                if self.kill(entry, timeout):
+                    killed += 1
+                    logger.info(f"Killed orphaned process group {entry.get('pgid')} for {entry.get('key')}")
+            except Exception as e:
+                logger.warning(f"Failed to kill orphan {entry.get('key')}: {e}")
+            self.remove(entry.get("key", ""))
+        return killed
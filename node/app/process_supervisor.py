@@ -0,0 +1,386 @@
+"""Asyncio process supervisor for tunnel core processes"""
+import asyncio
+import logging
+import os
+import random
+import signal
+import sys
+import time
+import warnings
+from collections import deque
+from pathlib import Path
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Any
+
+from app.config import settings
+from app.pid_registry import PidRegistry, signal_group
+from app.readiness import wait_for_ready
+
+logger = logging.getLogger(__name__)
+
+
+def install_child_watcher():
+    """Use pidfd-based child reaping on Python versions that do not pick it by default"""
+    if sys.version_info >= (3, 12) or not hasattr(os, "pidfd_open"):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+    logger.info("Using pidfd child watcher for core processes")
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with jitter for the given restart attempt"""
+    delay = min(settings.restart_backoff_max, settings.restart_backoff_base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RestartStats:
+    """Crash and restart history of one supervised process key"""
+
+    def __init__(self):
+        self.restarts = 0
+        self.consecutive = 0
+        self.crashes: Deque[float] = deque()
+        self.last_exit_code: Optional[int] = None
+        self.last_crash_at: Optional[float] = None
+        self.flapping = False
+
+    def record_crash(self, exit_code: Optional[int], uptime: float):
+        now = time.monotonic()
+        if uptime >= settings.restart_stable_after:
+            self.consecutive = 0
+        self.crashes.append(now)
+        while self.crashes and now - self.crashes[0] > settings.restart_flap_window:
+            self.crashes.popleft()
+        self.last_exit_code = exit_code
+        self.last_crash_at = time.time()
+        self.flapping = len(self.crashes) >= settings.restart_flap_threshold
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "restarts": self.restarts,
+            "recent_crashes": len(self.crashes),
+            "last_exit_code": self.last_exit_code,
+            "last_crash_at": self.last_crash_at,
+            "flapping": self.flapping,
+        }
+
+
+class ManagedProcess:
+    """A core process started by the supervisor"""
+
+    def __init__(
+        self,
+        key: str,
+        cmd: List[str],
+        process: asyncio.subprocess.Process,
+        log_path: Optional[Path] = None,
+        log_handle: Optional[Any] = None,
+        cwd: Optional[Path] = None,
+        env: Optional[Dict[str, str]] = None,
+        on_restart: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        self.key = key
+        self.cmd = cmd
+        self.process = process
+        self.log_path = log_path
+        self.log_handle = log_handle
+        self.cwd = cwd
+        self.env = env
+        self.on_restart = on_restart
+        self.started_at = time.monotonic()
+        self.supervised = False
+        self.watcher: Optional[asyncio.Task] = None
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.process.returncode
+
+    def is_running(self) -> bool:
+        """Return True while the process has not exited"""
+        return self.process.returncode is None
+
+    def log_tail(self, limit: int = 1000) -> str:
+        """Return the last `limit` characters of the process log"""
+        if not self.log_path or not self.log_path.exists():
+            return ""
+        try:
+            return self.log_path.read_text(encoding="utf-8", errors="replace")[-limit:]
+        except Exception:
+            return ""
+
+    def close_log(self):
+        if self.log_handle:
+            try:
+                self.log_handle.close()
+            except Exception:
+                pass
+            self.log_handle = None
+
+
+class ProcessSupervisor:
+    """Starts, stops and watches core processes without blocking the event loop.
+
+    Once a process has become ready, its exit is awaited by a watcher task and
+    an unexpected exit restarts the same command with exponential backoff.
+    """
+
+    def __init__(self, registry: Optional[PidRegistry] = None):
+        self.processes: Dict[str, ManagedProcess] = {}
+        self.restart_stats: Dict[str, RestartStats] = {}
+        self.registry = registry
+
+    async def start(
+        self,
+        key: str,
+        cmd: List[str],
+        log_path: Optional[Path] = None,
+        cwd: Optional[Path] = None,
+        env: Optional[Dict[str, str]] = None,
+        header: Optional[List[str]] = None,
+        on_restart: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> ManagedProcess:
+        """Spawn a process under `key`, replacing any process already registered for it.
+
+        `on_restart` is awaited after the supervisor respawns the process following a crash.
+        """
+        if key in self.processes:
+            logger.info(f"Process {key} already exists, stopping it first")
+            await self.stop(key)
+        self.restart_stats.pop(key, None)
+        return await self._spawn(key, cmd, log_path, cwd, env, header, on_restart)
+
+    async def _spawn(
+        self,
+        key: str,
+        cmd: List[str],
+        log_path: Optional[Path],
+        cwd: Optional[Path],
+        env: Optional[Dict[str, str]],
+        header: Optional[List[str]],
+        on_restart: Optional[Callable[[], Awaitable[None]]],
+        append: bool = False,
+    ) -> ManagedProcess:
+        log_fh = None
+        if log_path:
+            log_fh = open(log_path, "a" if append else "w", buffering=1)
+            for line in header or []:
+                log_fh.write(f"{line}\n")
+            log_fh.flush()
+
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=log_fh if log_fh else asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.STDOUT if log_fh else asyncio.subprocess.DEVNULL,
+                cwd=str(cwd) if cwd else None,
+                env=env,
+                start_new_session=True,
+            )
+        except Exception:
+            if log_fh:
+                log_fh.close()
+            raise
+
+        if self.registry:
+            self.registry.add(key, process.pid, cmd)
+        managed = ManagedProcess(key, cmd, process, log_path, log_fh, cwd, env, on_restart)
+        managed.watcher = asyncio.create_task(self._watch(managed))
+        self.processes[key] = managed
+        logger.info(f"Started process {key} (pid={process.pid}): {' '.join(cmd)}")
+        return managed
+
+    async def _watch(self, managed: ManagedProcess):
+        """Await the exit of a process and restart it if it crashed while supervised"""
+        await managed.process.wait()
+        key = managed.key
+        if not managed.supervised or self.processes.get(key) is not managed:
+            return
+        managed.close_log()
+
+        stats = self.restart_stats.setdefault(key, RestartStats())
+        stats.record_crash(managed.returncode, time.monotonic() - managed.started_at)
+        if stats.flapping:
+            logger.error(
+                f"Process {key} is flapping: {len(stats.crashes)} crashes in the last "
+                f"{settings.restart_flap_window:g}s (exit code {managed.returncode})"
+            )
+
+        while self.processes.get(key) is managed:
+            delay = backoff_delay(stats.consecutive)
+            stats.consecutive += 1
+            logger.warning(
+                f"Process {key} (pid={managed.pid}) exited with code {managed.returncode}, "
+                f"restarting in {delay:.1f}s (attempt {stats.consecutive})"
+            )
+            await asyncio.sleep(delay)
+            if self.processes.get(key) is not managed:
+                return
+            try:
+                restarted = await self._spawn(
+                    key,
+                    managed.cmd,
+                    managed.log_path,
+                    managed.cwd,
+                    managed.env,
+                    [f"Restarting after exit code {managed.returncode} (restart #{stats.restarts + 1})"],
+                    managed.on_restart,
+                    append=True,
+                )
+            except Exception as e:
+                logger.error(f"Failed to restart process {key}: {e}")
+                continue
+            restarted.supervised = True
+            stats.restarts += 1
+            if restarted.on_restart:
+                try:
+                    await restarted.on_restart()
+                except Exception as e:
+                    logger.error(f"Post-restart hook for {key} failed: {e}")
+            return
+
+    async def wait_ready(
+        self,
+        key: str,
+        label: Optional[str] = None,
+        settle: float = 0.5,
+        tcp_ports: Iterable[int] = (),
+        udp_ports: Iterable[int] = (),
+        patterns: Iterable[str] = (),
+        timeout: Optional[float] = None,
+    ) -> ManagedProcess:
+        """Wait until the process is serving, raising RuntimeError if it exits or never binds"""
+        managed = self.processes.get(key)
+        if not managed:
+            raise RuntimeError(f"{label or key} is not running")
+
+        ready, reason = await wait_for_ready(
+            managed.is_running,
+            pgid=managed.pid,
+            tcp_ports=tcp_ports,
+            udp_ports=udp_ports,
+            log_path=managed.log_path,
+            patterns=patterns,
+            timeout=timeout if timeout is not None else settings.readiness_timeout,
+            settle=settle,
+        )
+        if ready:
+            logger.info(f"Process {key} is ready ({reason})")
+            managed.supervised = True
+            return managed
+
+        if managed.is_running():
+            await self.stop(key)
+        else:
+            self._discard(key)
+        error_output = managed.log_tail()
+        if managed.returncode is not None and reason == "process exited":
+            reason = f"exit code {managed.returncode}"
+        raise RuntimeError(f"{label or key} failed to start ({reason}): {error_output}")
+
+    async def stop(self, key: str, timeout: float = 5.0):
+        """Terminate the process group registered under `key`, killing it after `timeout`.
+
+        Keys that are only known from the PID registry (left over from a previous
+        run) are torn down by their recorded process group.
+        """
+        managed = self.processes.pop(key, None)
+        self.restart_stats.pop(key, None)
+        if not managed:
+            if self.registry and self.registry.get(key):
+                await asyncio.to_thread(self.registry.kill_key, key, timeout)
+            return
+        if managed.watcher and managed.watcher is not asyncio.current_task():
+            managed.watcher.cancel()
+
+        process = managed.process
+        try:
+            if process.returncode is None:
+                signal_group(process.pid, signal.SIGTERM)
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Process {key} (pid={process.pid}) did not exit after {timeout}s, killing it")
+                    signal_group(process.pid, signal.SIGKILL)
+                    await asyncio.wait_for(process.wait(), timeout=timeout)
+        except Exception as e:
+            logger.warning(f"Error stopping process {key}: {e}")
+        finally:
+            managed.close_log()
+            if self.registry:
+                self.registry.remove(key)
+
+    async def stop_all(self):
+        """Stop every supervised process concurrently"""
+        await asyncio.gather(
+            *(self.stop(key) for key in list(self.processes.keys())),
+            return_exceptions=True,
+        )
+
+    def get(self, key: str) -> Optional[ManagedProcess]:
+        return self.processes.get(key)
+
+    def is_running(self, key: str) -> bool:
+        managed = self.processes.get(key)
+        return managed is not None and managed.is_running()
+
+    async def reap_orphans(self) -> int:
+        """Kill process groups recorded by a previous run of the agent"""
+        if not self.registry:
+            return 0
+        killed = await asyncio.to_thread(self.registry.reap_orphans)
+        if killed:
+            logger.info(f"Killed {killed} orphaned core process groups from a previous run")
+        return killed
+
+    def restart_info(self, key: str) -> Dict[str, Any]:
+        """Return the restart history of a process key"""
+        stats = self.restart_stats.get(key)
+        return stats.to_dict() if stats else RestartStats().to_dict()
+
+    def health(self) -> Dict[str, Dict[str, Any]]:
+        """Return liveness and restart history of every supervised process"""
+        return {
+            key: {
+                "pid": managed.pid,
+                "running": managed.is_running(),
+                **self.restart_info(key),
+            }
+            for key, managed in self.processes.items()
+        }
+
+    def _discard(self, key: str):
+        managed = self.processes.pop(key, None)
+        if managed:
+            managed.close_log()
+        if self.registry:
+            self.registry.remove(key)
+
+
+async def run_command(cmd: List[str], timeout: float = 3.0) -> Optional[int]:
+    """Run a short helper command (iptables, ...) without blocking the event loop"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except FileNotFoundError:
+        return None
+    try:
+        return await asyncio.wait_for(process.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        return None
@@ -1,8 +1,9 @@
 """Agent API endpoints"""
 from fastapi import APIRouter, Request, HTTPException
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 import logging
+import time
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -14,12 +15,26 @@ class TunnelApply(BaseModel):
     core: str
     type: str
     spec: Dict[str, Any]
+    force: bool = False  # restart even if the same spec is already running
 
 
 class TunnelRemove(BaseModel):
     tunnel_id: str
 
 
+class TunnelOperation(BaseModel):
+    op: str  # "apply" or "remove"
+    tunnel_id: str
+    core: Optional[str] = None
+    type: Optional[str] = None
+    spec: Optional[Dict[str, Any]] = None
+    force: bool = False
+
+
+class TunnelBatch(BaseModel):
+    operations: List[TunnelOperation]
+
+
 @router.post("/tunnels/apply")
 async def apply_tunnel(data: TunnelApply, request: Request):
     """Apply tunnel configuration"""
@@ -28,13 +43,16 @@ async def apply_tunnel(data: TunnelApply, request: Request):
     
     logger.info(f"Applying tunnel {data.tunnel_id}: core={data.core}, type={data.type}")
     try:
-        await adapter_manager.apply_tunnel(
+        outcome = await adapter_manager.apply_tunnel(
             tunnel_id=data.tunnel_id,
             tunnel_core=data.core,
-            spec=data.spec
+            spec=data.spec,
+            force=data.force
         )
+        if outcome == "unchanged":
+            return {"status": "success", "message": "Tunnel unchanged", "result": outcome}
         logger.info(f"Tunnel {data.tunnel_id} applied successfully")
-        return {"status": "success", "message": "Tunnel applied"}
+        return {"status": "success", "message": "Tunnel applied", "result": outcome}
     except Exception as e:
         logger.error(f"Failed to apply tunnel {data.tunnel_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -52,6 +70,34 @@ async def remove_tunnel(data: TunnelRemove, request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/tunnels/batch")
+async def batch_tunnels(data: TunnelBatch, request: Request):
+    """Apply and remove many tunnels in one request"""
+    adapter_manager = request.app.state.adapter_manager
+    
+    logger.info(f"Running tunnel batch with {len(data.operations)} operations")
+    results = await adapter_manager.apply_batch([op.model_dump() for op in data.operations])
+    failed = sum(1 for result in results if result.get("status") != "success")
+    return {
+        "status": "success" if failed == 0 else "partial",
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "results": results
+    }
+
+
+@router.get("/tunnels/state")
+async def get_tunnel_states(request: Request):
+    """Get the spec hash and process state of every tunnel in one call"""
+    adapter_manager = request.app.state.adapter_manager
+    
+    return {
+        "status": "success",
+        "ready": adapter_manager.is_ready(),
+        "data": await adapter_manager.tunnel_states()
+    }
+
+
 @router.get("/tunnels/status")
 async def get_tunnel_status(tunnel_id: str, request: Request):
     """Get tunnel status"""
@@ -71,7 +117,50 @@ async def get_status(request: Request):
     
     return {
         "status": "ok",
+        "ready": adapter_manager.is_ready(),
         "active_tunnels": len(adapter_manager.active_tunnels),
         "tunnels": list(adapter_manager.active_tunnels.keys())
     }
 
+
+@router.get("/traffic")
+async def get_traffic(request: Request):
+    """Get cumulative per-tunnel byte/packet counters from the kernel"""
+    adapter_manager = request.app.state.adapter_manager
+    
+    try:
+        counters = await adapter_manager.accounting.read_counters()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "status": "success",
+        "available": bool(adapter_manager.accounting.available),
+        "collected_at": time.time(),
+        "data": counters
+    }
+
+
+@router.get("/supervisor")
+async def get_supervisor_health(request: Request):
+    """Get liveness and crash/restart history of supervised core processes"""
+    adapter_manager = request.app.state.adapter_manager
+    processes = adapter_manager.supervisor.health()
+    
+    return {
+        "status": "success",
+        "flapping": [key for key, info in processes.items() if info["flapping"]],
+        "data": processes
+    }
+
+
+@router.get("/restore")
+async def get_restore_progress(request: Request):
+    """Get startup tunnel restoration progress"""
+    adapter_manager = request.app.state.adapter_manager
+    
+    return {
+        "status": "success",
+        "ready": adapter_manager.is_ready(),
+        "data": adapter_manager.restore_progress
+    }
+
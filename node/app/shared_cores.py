@@ -0,0 +1,376 @@
+"""Consolidated rathole and frp instances, one process per control endpoint"""
+import asyncio
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Callable, Dict, Any, List, Optional
+
+import httpx
+
+from app.config import settings
+from app.process_supervisor import ProcessSupervisor
+from app.readiness import READY_PATTERNS, wait_for_ready
+
+logger = logging.getLogger(__name__)
+
+
+def endpoint_key(*parts: Any) -> str:
+    """Build a file-name safe instance key from endpoint parts"""
+    return re.sub(r"[^A-Za-z0-9.-]+", "_", "-".join(str(part) for part in parts)).strip("_")
+
+
+class SharedCoreInstance:
+    """One supervised core process carrying the services of many tunnels.
+
+    The config file always holds every tunnel's services, so a crashed
+    instance comes back complete when the supervisor respawns it. Adding or
+    removing a tunnel rewrites the file and hot-reloads the running process
+    instead of restarting it, which keeps the other tunnels connected.
+    """
+
+    core = "core"
+    extension = "conf"
+    patterns: List[str] = []
+
+    def __init__(self, supervisor: ProcessSupervisor, config_dir: Path, binary: Path, key: str, params: Dict[str, Any]):
+        self.supervisor = supervisor
+        self.config_dir = config_dir
+        self.binary = binary
+        self.key = key
+        self.params = params
+        self.services: Dict[str, List[Dict[str, Any]]] = {}
+        self.lock = asyncio.Lock()
+
+    @property
+    def process_key(self) -> str:
+        return f"{self.core}:shared:{self.key}"
+
+    @property
+    def config_path(self) -> Path:
+        return self.config_dir / f"shared_{self.key}.{self.extension}"
+
+    def is_running(self) -> bool:
+        return self.supervisor.is_running(self.process_key)
+
+    @property
+    def pid(self) -> Optional[int]:
+        managed = self.supervisor.get(self.process_key)
+        return managed.pid if managed else None
+
+    def command(self) -> List[str]:
+        return [str(self.binary), "-c", str(self.config_path)]
+
+    def render(self) -> str:
+        raise NotImplementedError
+
+    def ready_ports(self) -> List[int]:
+        return []
+
+    async def reload(self):
+        """Make the running process pick up the rewritten config"""
+
+    async def wait_services(self, tunnel_id: str):
+        """Wait until the tunnel's services are serving on the running instance"""
+
+    def _write(self):
+        # Written in place: rathole watches the file itself and would lose the watch on a rename
+        with open(self.config_path, "w") as f:
+            f.write(self.render())
+
+    async def _start(self):
+        cmd = self.command()
+        await self.supervisor.start(
+            self.process_key,
+            cmd,
+            log_path=self.config_dir / f"shared_{self.key}.log",
+            cwd=self.config_dir,
+            header=[f"Starting shared {self.core} instance {self.key}", f"Command: {' '.join(cmd)}"],
+        )
+        await self.supervisor.wait_ready(
+            self.process_key,
+            label=f"shared {self.core}",
+            tcp_ports=self.ready_ports(),
+            patterns=self.patterns,
+        )
+        logger.info(f"Shared {self.core} instance {self.key} started with {len(self.services)} tunnels")
+
+    async def put(self, tunnel_id: str, services: List[Dict[str, Any]]):
+        """Install a tunnel's services, replacing the ones it had before"""
+        async with self.lock:
+            previous = self.services.get(tunnel_id)
+            self.services[tunnel_id] = services
+            try:
+                self._write()
+                if self.is_running():
+                    await self.reload()
+                else:
+                    await self._start()
+                await self.wait_services(tunnel_id)
+            except Exception:
+                if previous is None:
+                    self.services.pop(tunnel_id, None)
+                else:
+                    self.services[tunnel_id] = previous
+                await self._settle_after_failure()
+                raise
+        logger.info(f"Tunnel {tunnel_id} applied to shared {self.core} instance {self.key} ({len(self.services)} tunnels)")
+
+    async def remove(self, tunnel_id: str):
+        """Drop a tunnel's services, stopping the process once no tunnel is left"""
+        async with self.lock:
+            if self.services.pop(tunnel_id, None) is None:
+                return
+            if not self.services:
+                await self.stop()
+                return
+            self._write()
+            if self.is_running():
+                try:
+                    await self.reload()
+                except Exception as e:
+                    logger.warning(f"Shared {self.core} instance {self.key} did not reload after removing {tunnel_id}: {e}")
+        logger.info(f"Tunnel {tunnel_id} removed from shared {self.core} instance {self.key}")
+
+    async def stop(self):
+        await self.supervisor.stop(self.process_key)
+        if self.config_path.exists():
+            try:
+                self.config_path.unlink()
+            except Exception:
+                pass
+
+    async def _settle_after_failure(self):
+        """Put the instance back on the config it ran before a failed change"""
+        if not self.services:
+            await self.stop()
+            return
+        self._write()
+        if self.is_running():
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.warning(f"Shared {self.core} instance {self.key} did not reload its previous config: {e}")
+
+    def tunnel_running(self, tunnel_id: str) -> bool:
+        return tunnel_id in self.services and self.is_running()
+
+
+class SharedRathole(SharedCoreInstance):
+    """A rathole server or client; rathole reloads its services when the config file changes"""
+
+    core = "rathole"
+    extension = "toml"
+    patterns = READY_PATTERNS["rathole"]
+
+    def command(self) -> List[str]:
+        flag = "-s" if self.params["mode"] == "server" else "-c"
+        return [str(self.binary), flag, str(self.config_path)]
+
+    def ready_ports(self) -> List[int]:
+        return [self.params["bind_port"]] if self.params["mode"] == "server" else []
+
+    def render(self) -> str:
+        section = self.params["mode"]
+        if section == "server":
+            config = f"""[server]
+bind_addr = "{self.params['bind_addr']}"
+"""
+        else:
+            config = f"""[client]
+remote_addr = "{self.params['remote_addr']}"
+"""
+        if self.params["websocket"]:
+            config += f"""
+[{section}.transport]
+type = "websocket"
+
+[{section}.transport.websocket]
+"""
+            if self.params["tls"]:
+                config += "tls = true\n"
+        for services in self.services.values():
+            for service in services:
+                addr_field = "bind_addr" if section == "server" else "local_addr"
+                config += f"""
+[{section}.services.{service['name']}]
+token = "{service['token']}"
+{addr_field} = "{service['addr']}"
+"""
+        return config
+
+    async def wait_services(self, tunnel_id: str):
+        ports = [service["port"] for service in self.services.get(tunnel_id, []) if service.get("port")]
+        ready, reason = await wait_for_ready(
+            self.is_running,
+            pgid=self.pid,
+            tcp_ports=ports if self.params["mode"] == "server" else [],
+            timeout=settings.readiness_timeout,
+        )
+        if not ready:
+            raise RuntimeError(f"rathole did not pick up tunnel {tunnel_id} ({reason})")
+
+
+class SharedFrps(SharedCoreInstance):
+    """One frps per bind port; proxies come from the clients, so tunnels only hold a reference"""
+
+    core = "frps"
+    extension = "yaml"
+    patterns = READY_PATTERNS["frp"]
+
+    def ready_ports(self) -> List[int]:
+        return [self.params["bind_port"]]
+
+    def render(self) -> str:
+        config = f"""bindPort: {self.params['bind_port']}
+"""
+        if self.params["token"]:
+            config += f"""auth:
+  method: token
+  token: "{self.params['token']}"
+"""
+        return config
+
+
+class SharedFrpc(SharedCoreInstance):
+    """One frpc per frps endpoint, reloaded through its localhost admin API"""
+
+    core = "frpc"
+    extension = "yaml"
+
+    def __init__(self, *args, admin_port: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.admin_port = admin_port
+
+    def ready_ports(self) -> List[int]:
+        return [self.admin_port]
+
+    def render(self) -> str:
+        config = f"""serverAddr: "{self.params['server_addr']}"
+serverPort: {self.params['server_port']}
+webServer:
+  addr: 127.0.0.1
+  port: {self.admin_port}
+"""
+        if self.params["token"]:
+            config += f"""auth:
+  method: token
+  token: "{self.params['token']}"
+"""
+        config += "\nproxies:\n"
+        for services in self.services.values():
+            for proxy in services:
+                config += f"""  - name: {proxy['name']}
+    type: {proxy['type']}
+    localIP: {proxy['local_ip']}
+    localPort: {proxy['local_port']}
+    remotePort: {proxy['remote_port']}
+"""
+        return config
+
+    async def _admin(self, path: str) -> httpx.Response:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{self.admin_port}", timeout=5.0) as client:
+            return await client.get(path)
+
+    async def reload(self):
+        response = await self._admin("/api/reload")
+        if response.status_code >= 400:
+            raise RuntimeError(f"frpc rejected the reload: {response.text.strip()}")
+
+    async def wait_services(self, tunnel_id: str):
+        names = {proxy["name"] for proxy in self.services.get(tunnel_id, [])}
+        deadline = time.monotonic() + settings.readiness_timeout
+        pending = names
+        while True:
+            if not self.is_running():
+                raise RuntimeError("frpc exited")
+            try:
+                response = await self._admin("/api/status")
+                proxies = [proxy for group in (response.json() or {}).values() for proxy in (group or [])]
+                states = {proxy.get("name"): proxy for proxy in proxies}
+                for name in names:
+                    proxy = states.get(name) or {}
+                    if proxy.get("err") and proxy.get("status") != "running":
+                        raise RuntimeError(f"frpc proxy {name} failed: {proxy['err']}")
+                pending = {name for name in names if (states.get(name) or {}).get("status") != "running"}
+            except RuntimeError:
+                raise
+            except Exception as e:
+                logger.debug(f"frpc admin API not answering yet: {e}")
+            if not pending:
+                return
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"frpc proxies not running after {settings.readiness_timeout:g}s: {', '.join(sorted(pending))}")
+            await asyncio.sleep(0.2)
+
+
+class SharedCores:
+    """Shared instances of one core keyed by control endpoint, and which tunnel lives where"""
+
+    def __init__(self, supervisor: ProcessSupervisor, config_dir: Path, factory: Callable[..., SharedCoreInstance]):
+        self.supervisor = supervisor
+        self.config_dir = config_dir
+        self.factory = factory
+        self.instances: Dict[str, SharedCoreInstance] = {}
+        self.owners: Dict[str, str] = {}
+        self._lock = asyncio.Lock()
+
+    def owns(self, tunnel_id: str) -> bool:
+        return tunnel_id in self.owners
+
+    async def put(self, tunnel_id: str, key: str, params: Dict[str, Any], services: List[Dict[str, Any]]):
+        """Install a tunnel on the instance for `key`, moving it off any other instance"""
+        async with self._lock:
+            instance = self.instances.get(key)
+            if instance is not None and instance.params != params:
+                others = [t for t in instance.services if t != tunnel_id]
+                if others:
+                    raise ValueError(
+                        f"Control endpoint {key} is already used by tunnels {', '.join(others)} with different "
+                        f"settings; tunnels sharing an endpoint must use the same token and transport"
+                    )
+                # Only this tunnel uses the endpoint: restart it on the new settings
+                await instance.stop()
+                instance.params = params
+            if instance is None:
+                instance = self.instances[key] = self.factory(key, params)
+            previous = self.owners.get(tunnel_id)
+        if previous and previous != key:
+            await self.remove(tunnel_id)
+        try:
+            await instance.put(tunnel_id, services)
+        except Exception:
+            async with self._lock:
+                if not instance.services and self.instances.get(key) is instance:
+                    del self.instances[key]
+            raise
+        self.owners[tunnel_id] = key
+
+    async def remove(self, tunnel_id: str) -> bool:
+        """Remove a tunnel from its instance; returns False if no instance carries it"""
+        key = self.owners.pop(tunnel_id, None)
+        instance = self.instances.get(key) if key else None
+        if instance is None:
+            return False
+        await instance.remove(tunnel_id)
+        async with self._lock:
+            if not instance.services and self.instances.get(key) is instance:
+                del self.instances[key]
+        return True
+
+    def tunnel_running(self, tunnel_id: str) -> bool:
+        instance = self.instances.get(self.owners.get(tunnel_id, ""))
+        return instance is not None and instance.tunnel_running(tunnel_id)
+
+    async def stop(self):
+        """Stop every instance, keeping nothing; tunnels are restored from the store on start"""
+        instances = list(self.instances.values())
+        self.instances.clear()
+        self.owners.clear()
+        await asyncio.gather(*(instance.stop() for instance in instances), return_exceptions=True)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            key: {"running": instance.is_running(), "tunnels": sorted(instance.services)}
+            for key, instance in self.instances.items()
+        }
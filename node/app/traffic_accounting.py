@@ -0,0 +1,242 @@
+"""Per-tunnel traffic accounting with kernel packet counters"""
+import asyncio
+import logging
+import re
+import shutil
+import time
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Incoming packets to a tunnel port are counted from INPUT only and its
+# replies from OUTPUT only. One chain hooked into both would also count a
+# core's own connections to the same port number on a remote host (gost
+# forwards to remote:port by default) in both directions.
+CHAIN_IN = "CIMEX_ACCT_IN"
+CHAIN_OUT = "CIMEX_ACCT_OUT"
+HOOKS = (("INPUT", CHAIN_IN), ("OUTPUT", CHAIN_OUT))
+# Single chain of earlier versions, removed when the split chains are set up
+LEGACY_CHAIN = "CIMEX_ACCT"
+COMMENT_PREFIX = "cimex:"
+PROTOCOLS = ("tcp", "udp")
+# One rule set per address family; ip6tables is skipped where it is missing
+FAMILIES = ("iptables", "ip6tables")
+
+# `[packets:bytes] -A CIMEX_ACCT_IN ... --comment "cimex:<tunnel_id>:<in|out>"`
+_SAVE_LINE = re.compile(
+    r'^\[(\d+):(\d+)\] -A (?:' + CHAIN_IN + '|' + CHAIN_OUT + r') .*?--(dport|sport) (\d+) .*?--comment "?' + COMMENT_PREFIX + r'([^:"\s]+):(in|out)"?'
+)
+
+
+def tunnel_ports(spec: Dict[str, Any]) -> List[int]:
+    """Return the public ports a tunnel spec exposes, whatever core carries it"""
+    ports = spec.get("ports")
+    candidates: List[Any] = []
+    if isinstance(ports, list) and ports:
+        for entry in ports:
+            if isinstance(entry, dict):
+                candidates.append(entry.get("local") or entry.get("listen_port") or entry.get("public_port"))
+            else:
+                # Backhaul style "443=1.2.3.4:443" or "0.0.0.0:443"
+                candidates.append(str(entry).split("=", 1)[0].rsplit(":", 1)[-1])
+    else:
+        for key in ("listen_port", "public_port", "remote_port", "proxy_port", "reverse_port"):
+            if spec.get(key):
+                candidates.append(spec.get(key))
+                break
+
+    result = []
+    for candidate in candidates:
+        try:
+            port = int(str(candidate).strip())
+        except (TypeError, ValueError):
+            continue
+        if 0 < port < 65536 and port not in result:
+            result.append(port)
+    return result
+
+
+def _rule_specs(tunnel_id: str, ports: Iterable[int]) -> List[str]:
+    specs = []
+    for port in ports:
+        for proto in PROTOCOLS:
+            specs.append(f'{CHAIN_IN} -p {proto} -m {proto} --dport {port} -m comment --comment "{COMMENT_PREFIX}{tunnel_id}:in"')
+            specs.append(f'{CHAIN_OUT} -p {proto} -m {proto} --sport {port} -m comment --comment "{COMMENT_PREFIX}{tunnel_id}:out"')
+    return specs
+
+
+class TrafficAccounting:
+    """Counts tunnel traffic with iptables and ip6tables rules in dedicated chains.
+
+    Each tunnel gets rules without a target, so matching packets are only
+    counted by the kernel. Installing and removing a tunnel's rules is a
+    single restore call per address family, and all counters are read at
+    once with the matching save command. Rules are kept across agent
+    restarts so counters stay cumulative; after a host reboot the chain is
+    gone and install() recreates them.
+    """
+
+    def __init__(self):
+        self.enabled = settings.traffic_accounting_enabled
+        self.tunnel_ports: Dict[str, List[int]] = {}
+        self.installed_at: Dict[str, float] = {}
+        self.available: Optional[bool] = None
+        self.families: List[str] = []
+        # Ports actually installed per tool, which may differ after an upgrade or a partial failure
+        self.installed: Dict[str, Dict[str, List[int]]] = {}
+        self._lock = asyncio.Lock()
+
+    async def _exec(self, cmd: List[str], stdin: Optional[str] = None, timeout: float = 10.0) -> Tuple[int, str, str]:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                process.communicate(stdin.encode() if stdin is not None else None),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return -1, "", f"{cmd[0]} timed out"
+        return process.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+    async def _restore(self, tool: str, lines: List[str]) -> bool:
+        payload = "*filter\n" + "\n".join(lines) + "\nCOMMIT\n"
+        code, _, stderr = await self._exec([f"{tool}-restore", "-w", "--noflush"], stdin=payload)
+        if code != 0:
+            logger.warning(f"{tool}-restore failed: {stderr.strip()}")
+        return code == 0
+
+    async def _hook(self, tool: str) -> bool:
+        """Create the accounting chains and hook them into INPUT/OUTPUT for one address family"""
+        if not (shutil.which(tool) and shutil.which(f"{tool}-restore") and shutil.which(f"{tool}-save")):
+            return False
+        await self._drop_legacy_chain(tool)
+        for hook, chain in HOOKS:
+            await self._exec([tool, "-w", "-N", chain])
+            code, _, _ = await self._exec([tool, "-w", "-C", hook, "-j", chain])
+            if code != 0:
+                code, _, stderr = await self._exec([tool, "-w", "-I", hook, "1", "-j", chain])
+                if code != 0:
+                    logger.warning(f"{tool} accounting unavailable, cannot hook {chain} into {hook}: {stderr.strip()}")
+                    return False
+        return True
+
+    async def _drop_legacy_chain(self, tool: str):
+        """Remove the shared in/out chain of earlier versions; its tunnels are counted afresh"""
+        code, _, _ = await self._exec([tool, "-w", "-n", "-L", LEGACY_CHAIN])
+        if code != 0:
+            return
+        for hook, _ in HOOKS:
+            while (await self._exec([tool, "-w", "-D", hook, "-j", LEGACY_CHAIN]))[0] == 0:
+                pass
+        await self._exec([tool, "-w", "-F", LEGACY_CHAIN])
+        await self._exec([tool, "-w", "-X", LEGACY_CHAIN])
+        logger.info(f"Removed legacy {tool} accounting chain {LEGACY_CHAIN}")
+
+    async def _ensure_ready(self) -> bool:
+        """Set up the chain for every available address family once"""
+        if self.available is not None:
+            return self.available
+        if self.enabled:
+            for tool in FAMILIES:
+                if await self._hook(tool):
+                    self.families.append(tool)
+        self.available = bool(self.families)
+        if not self.available:
+            logger.info("Traffic accounting disabled (turned off or iptables not available)")
+            return False
+
+        # Adopt rules left by a previous run so their counters keep accumulating
+        for tool in self.families:
+            self.installed[tool] = {}
+            for tunnel_id, data in (await self._read(tool)).items():
+                self.installed[tool][tunnel_id] = data["ports"]
+                self.tunnel_ports.setdefault(tunnel_id, data["ports"])
+                self.installed_at.setdefault(tunnel_id, time.time())
+        logger.info(
+            f"Traffic accounting ready on {', '.join(self.families)} "
+            f"({len(self.tunnel_ports)} tunnels already counted)"
+        )
+        return True
+
+    async def install(self, tunnel_id: str, ports: List[int]):
+        """Make a tunnel's counters match its ports; a no-op when they already do, so it is safe to repeat"""
+        async with self._lock:
+            if not await self._ensure_ready():
+                return
+            for tool in self.families:
+                current = self.installed[tool].get(tunnel_id)
+                if sorted(current or []) == sorted(ports):
+                    continue
+                lines = [f"-D {spec}" for spec in _rule_specs(tunnel_id, current or [])]
+                lines += [f"-A {spec}" for spec in _rule_specs(tunnel_id, ports)]
+                if await self._restore(tool, lines):
+                    if ports:
+                        self.installed[tool][tunnel_id] = list(ports)
+                    else:
+                        self.installed[tool].pop(tunnel_id, None)
+            if not ports:
+                self.tunnel_ports.pop(tunnel_id, None)
+                self.installed_at.pop(tunnel_id, None)
+            elif sorted(self.tunnel_ports.get(tunnel_id) or []) != sorted(ports):
+                self.tunnel_ports[tunnel_id] = list(ports)
+                self.installed_at[tunnel_id] = time.time()
+
+    async def uninstall(self, tunnel_id: str):
+        """Remove a tunnel's counters"""
+        async with self._lock:
+            self.tunnel_ports.pop(tunnel_id, None)
+            self.installed_at.pop(tunnel_id, None)
+            if not self.available:
+                return
+            for tool in self.families:
+                ports = self.installed[tool].pop(tunnel_id, None)
+                if ports:
+                    await self._restore(tool, [f"-D {spec}" for spec in _rule_specs(tunnel_id, ports)])
+
+    async def _read(self, tool: str) -> Dict[str, Dict[str, Any]]:
+        code, stdout, stderr = await self._exec([f"{tool}-save", "-c", "-t", "filter"])
+        if code != 0:
+            logger.warning(f"{tool}-save failed: {stderr.strip()}")
+            return {}
+        counters: Dict[str, Dict[str, Any]] = {}
+        for line in stdout.splitlines():
+            match = _SAVE_LINE.match(line)
+            if not match:
+                continue
+            packets, byte_count, _, port, tunnel_id, direction = match.groups()
+            entry = counters.setdefault(tunnel_id, {
+                "rx_bytes": 0, "rx_packets": 0, "tx_bytes": 0, "tx_packets": 0, "ports": [],
+            })
+            prefix = "rx" if direction == "in" else "tx"
+            entry[f"{prefix}_bytes"] += int(byte_count)
+            entry[f"{prefix}_packets"] += int(packets)
+            if int(port) not in entry["ports"]:
+                entry["ports"].append(int(port))
+        return counters
+
+    async def read_counters(self) -> Dict[str, Dict[str, Any]]:
+        """Return cumulative byte/packet counters for every counted tunnel, IPv4 and IPv6 summed"""
+        async with self._lock:
+            if not await self._ensure_ready():
+                return {}
+        counters: Dict[str, Dict[str, Any]] = {}
+        for tool in self.families:
+            for tunnel_id, data in (await self._read(tool)).items():
+                entry = counters.get(tunnel_id)
+                if entry is None:
+                    counters[tunnel_id] = data
+                    continue
+                for key in ("rx_bytes", "rx_packets", "tx_bytes", "tx_packets"):
+                    entry[key] += data[key]
+                entry["ports"] += [port for port in data["ports"] if port not in entry["ports"]]
+        for tunnel_id, entry in counters.items():
+            entry["installed_at"] = self.installed_at.get(tunnel_id)
+        return counters
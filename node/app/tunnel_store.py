@@ -0,0 +1,161 @@
+"""Journaled tunnel state store for the node agent"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def spec_hash(core: str, spec: Dict[str, Any]) -> str:
+    """Hash of a tunnel's core and spec in canonical JSON form; the panel computes the same value"""
+    canonical = json.dumps({"core": core, "spec": spec}, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class TunnelStore:
+    """Tunnel configurations kept as a snapshot plus an append-only journal.
+
+    Each put/delete appends one JSON line to the journal, so a change costs
+    O(1) I/O however many tunnels the node carries. The journal is folded
+    into the snapshot once it outgrows the live set, and again on every load.
+    Journal records carry the full tunnel state, so replaying them over a
+    newer snapshot after a crash mid-compaction is harmless; a torn trailing
+    line from a crash mid-append is dropped.
+    """
+
+    COMPACT_MIN_ENTRIES = 1000
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.snapshot_path = self.directory / "tunnels.json"
+        self.journal_path = self.directory / "tunnels.journal"
+        self.configs: Dict[str, Dict[str, Any]] = {}
+        self._journal = None
+        self._journal_entries = 0
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """Read the snapshot, replay the journal over it and compact"""
+        configs = self._read_snapshot()
+        replayed = 0
+
+        if self.journal_path.exists():
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line_no, line in enumerate(f, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Ignoring torn journal record at {self.journal_path}:{line_no}")
+                        break
+                    tunnel_id = record.get("id")
+                    if record.get("op") == "put":
+                        configs[tunnel_id] = record.get("config") or {}
+                    elif record.get("op") == "del":
+                        configs.pop(tunnel_id, None)
+                    replayed += 1
+
+        self.configs.clear()
+        self.configs.update(configs)
+        logger.info(
+            f"Loaded {len(self.configs)} tunnel configurations from {self.snapshot_path} "
+            f"({replayed} journal records replayed)"
+        )
+
+        if self.journal_path.exists() and self.journal_path.stat().st_size > 0:
+            self.compact()
+        return self.configs
+
+    def put(self, tunnel_id: str, config: Dict[str, Any], sync: bool = True):
+        """Record the full config of a tunnel"""
+        self.configs[tunnel_id] = config
+        self._append({"op": "put", "id": tunnel_id, "config": config}, sync)
+
+    def delete(self, tunnel_id: str, sync: bool = True):
+        """Record the removal of a tunnel"""
+        if self.configs.pop(tunnel_id, None) is None:
+            return
+        self._append({"op": "del", "id": tunnel_id}, sync)
+
+    def sync(self):
+        """Flush and fsync journal records written with sync=False"""
+        if self._journal:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        self._maybe_compact()
+
+    def compact(self):
+        """Write the live set to a new snapshot and truncate the journal"""
+        temp_file = self.snapshot_path.with_suffix(".tmp")
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(self.configs, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        temp_file.replace(self.snapshot_path)
+        self._fsync_directory()
+
+        self.close()
+        with open(self.journal_path, "w", encoding="utf-8") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_entries = 0
+        logger.info(f"Compacted tunnel store: {len(self.configs)} tunnels in {self.snapshot_path}")
+
+    def close(self):
+        if self._journal:
+            try:
+                self._journal.close()
+            except Exception:
+                pass
+            self._journal = None
+
+    def _append(self, record: Dict[str, Any], sync: bool):
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._journal_entries += 1
+        if sync:
+            self.sync()
+
+    def _maybe_compact(self):
+        if self._journal_entries > max(self.COMPACT_MIN_ENTRIES, len(self.configs)):
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Failed to compact tunnel store: {e}", exc_info=True)
+
+    def _read_snapshot(self) -> Dict[str, Dict[str, Any]]:
+        if not self.snapshot_path.exists():
+            logger.info(f"No tunnel snapshot found at {self.snapshot_path} (this is normal for new nodes)")
+            return {}
+        try:
+            content = self.snapshot_path.read_text(encoding="utf-8")
+            if not content.strip():
+                logger.warning(f"Tunnel snapshot {self.snapshot_path} is empty")
+                return {}
+            return json.loads(content)
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to parse tunnel snapshot {self.snapshot_path}: {e}", exc_info=True)
+            try:
+                backup = self.snapshot_path.with_suffix(".corrupt")
+                self.snapshot_path.replace(backup)
+                logger.error(f"Moved unreadable tunnel snapshot to {backup}")
+            except Exception:
+                pass
+        except Exception as e:
+            logger.error(f"Failed to read tunnel snapshot {self.snapshot_path}: {e}", exc_info=True)
+        return {}
+
+    def _fsync_directory(self):
+        fd: Optional[int] = None
+        try:
+            fd = os.open(str(self.directory), os.O_RDONLY)
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            if fd is not None:
+                os.close(fd)
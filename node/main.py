@@ -11,7 +11,9 @@ from fastapi.middleware.cors import CORSMiddleware
 from app.config import settings
 from app.routers import agent
 from app.panel_client import PanelClient
+from app.panel_channel import PanelChannel
 from app.core_adapters import AdapterManager
+from app.process_supervisor import install_child_watcher
 
 logging.basicConfig(
     level=logging.INFO,
@@ -36,6 +38,7 @@ async def registration_loop(panel_client: PanelClient):
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
+    install_child_watcher()
     h2_client = PanelClient()
     registration_task = None
     try:
@@ -50,6 +53,10 @@ async def lifespan(app: FastAPI):
         
         registration_task = asyncio.create_task(registration_loop(h2_client))
         app.state.registration_task = registration_task
+        
+        panel_channel = PanelChannel(app, h2_client)
+        await panel_channel.start()
+        app.state.panel_channel = panel_channel
     except Exception as e:
         logger.error(f"Failed to start Panel client: {e}")
         logger.error("Node API will still be available, but panel connection will not work")
@@ -59,18 +66,29 @@ async def lifespan(app: FastAPI):
     adapter_manager = AdapterManager()
     app.state.adapter_manager = adapter_manager
     
-    try:
-        await adapter_manager.restore_tunnels()
-    except Exception as e:
-        logger.error(f"Failed to restore tunnels on startup: {e}", exc_info=True)
+    async def restore_tunnels():
+        try:
+            await adapter_manager.restore_tunnels()
+        except Exception as e:
+            logger.error(f"Failed to restore tunnels on startup: {e}", exc_info=True)
+    
+    app.state.restore_task = asyncio.create_task(restore_tunnels())
     
     yield
+    if hasattr(app.state, 'restore_task') and not app.state.restore_task.done():
+        app.state.restore_task.cancel()
+        try:
+            await app.state.restore_task
+        except asyncio.CancelledError:
+            pass
     if hasattr(app.state, 'registration_task') and app.state.registration_task:
         app.state.registration_task.cancel()
         try:
             await app.state.registration_task
         except asyncio.CancelledError:
             pass
+    if hasattr(app.state, 'panel_channel'):
+        await app.state.panel_channel.stop()
     if hasattr(app.state, 'h2_client') and app.state.h2_client:
         try:
             await app.state.h2_client.stop()
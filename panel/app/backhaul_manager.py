@@ -1,12 +1,18 @@
 """Backhaul server management for panel"""
 import logging
 import os
+import re
 import shutil
 import subprocess
-import time
+import threading
 from pathlib import Path
 from typing import Dict, List, Optional, Any
 
+from app.pid_registry import pid_registry, stop_process
+from app.process_monitor import process_monitor
+from app.readiness import READY_PATTERNS, wait_for_ready
+from app.utils import parse_address_port
+
 
 logger = logging.getLogger(__name__)
 
@@ -52,6 +58,7 @@ class BackhaulManager:
         self.config_dir = Path(resolved_config)
         self.config_dir.mkdir(parents=True, exist_ok=True)
         self.processes: Dict[str, subprocess.Popen] = {}
+        self._lock = threading.RLock()
         self.log_handles: Dict[str, Any] = {}
         default_binary = binary_path or Path(
             os.environ.get("BACKHAUL_SERVER_BINARY", "/usr/local/bin/backhaul")
@@ -63,77 +70,94 @@ class BackhaulManager:
 
     def start_server(self, tunnel_id: str, spec: dict) -> bool:
         """Start a Backhaul server for a tunnel"""
-        config_path = self.config_dir / f"{tunnel_id}.toml"
-        log_path = self.config_dir / f"backhaul_{tunnel_id}.log"
+        with self._lock:
+            config_path = self.config_dir / f"{tunnel_id}.toml"
+            log_path = self.config_dir / f"backhaul_{tunnel_id}.log"
 
-        config_content = self._build_server_config(spec or {})
-        if not config_content.strip():
-            raise ValueError("Backhaul config is empty")
+            config_content = self._build_server_config(spec or {})
+            if not config_content.strip():
+                raise ValueError("Backhaul config is empty")
 
-        config_path.write_text(config_content, encoding="utf-8")
+            config_path.write_text(config_content, encoding="utf-8")
 
-        if tunnel_id in self.processes:
-            self.stop_server(tunnel_id)
+            if tunnel_id in self.processes:
+                self.stop_server(tunnel_id)
 
-        binary_path = self._resolve_binary_path()
+            binary_path = self._resolve_binary_path()
 
-        log_fh = log_path.open("w", buffering=1)
-        log_fh.write(f"Starting Backhaul server for tunnel {tunnel_id}\n")
-        log_fh.write(config_content)
-        log_fh.flush()
+            log_fh = log_path.open("w", buffering=1)
+            log_fh.write(f"Starting Backhaul server for tunnel {tunnel_id}\n")
+            log_fh.write(config_content)
+            log_fh.flush()
 
-        try:
-            proc = subprocess.Popen(
-                [str(binary_path), "-c", str(config_path)],
-                stdout=log_fh,
-                stderr=subprocess.STDOUT,
-                cwd=str(self.config_dir),
-                start_new_session=True,
-            )
-        except Exception:
-            log_fh.close()
-            raise
-
-        self.processes[tunnel_id] = proc
-        self.log_handles[tunnel_id] = log_fh
-
-        time.sleep(1.0)
-        if proc.poll() is not None:
-            error_output = ""
             try:
-                error_output = log_path.read_text(encoding="utf-8")[-1000:]
+                proc = subprocess.Popen(
+                    [str(binary_path), "-c", str(config_path)],
+                    stdout=log_fh,
+                    stderr=subprocess.STDOUT,
+                    cwd=str(self.config_dir),
+                    start_new_session=True,
+                )
             except Exception:
-                pass
-            self._cleanup_process(tunnel_id)
-            raise RuntimeError(
-                f"Backhaul server failed to start (exit code {proc.returncode}). "
-                f"Log tail: {error_output}"
+                log_fh.close()
+                raise
+
+            self.processes[tunnel_id] = proc
+            self.log_handles[tunnel_id] = log_fh
+            pid_registry.add(f"backhaul:{tunnel_id}", proc.pid, proc.args)
+
+            ready_ports = []
+            transport = (spec or {}).get("transport") or (spec or {}).get("type") or "tcp"
+            bind_match = re.search(r'^bind_addr = "([^"]+)"', config_content, re.MULTILINE)
+            if bind_match and transport.lower() != "udp":
+                _, control_port, _ = parse_address_port(bind_match.group(1))
+                ready_ports = [control_port]
+
+            ready, reason = wait_for_ready(
+                proc,
+                tcp_ports=ready_ports,
+                log_path=log_path,
+                patterns=READY_PATTERNS["backhaul"],
             )
+            if not ready:
+                error_output = ""
+                try:
+                    error_output = log_path.read_text(encoding="utf-8")[-1000:]
+                except Exception:
+                    pass
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                self._cleanup_process(tunnel_id)
+                raise RuntimeError(
+                    f"Backhaul server failed to start ({reason}). "
+                    f"Log tail: {error_output}"
+                )
 
-        logger.info("Started Backhaul server for tunnel %s using config %s", tunnel_id, config_path)
-        return True
+            process_monitor.watch(f"backhaul:{tunnel_id}", proc, lambda: self.start_server(tunnel_id, spec), lock=self._lock)
+            logger.info("Started Backhaul server for tunnel %s using config %s", tunnel_id, config_path)
+            return True
 
     def stop_server(self, tunnel_id: str):
         """Stop Backhaul server for a tunnel"""
-        if tunnel_id in self.processes:
-            proc = self.processes[tunnel_id]
-            try:
-                proc.terminate()
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                proc.kill()
-                proc.wait(timeout=5)
-            except Exception as exc:
-                logger.warning("Error stopping Backhaul server for tunnel %s: %s", tunnel_id, exc)
-            finally:
-                self._cleanup_process(tunnel_id)
-
-        config_path = self.config_dir / f"{tunnel_id}.toml"
-        if config_path.exists():
-            try:
-                config_path.unlink()
-            except Exception as exc:
-                logger.warning("Failed to remove Backhaul config %s: %s", config_path, exc)
+        with self._lock:
+            process_monitor.unwatch(f"backhaul:{tunnel_id}")
+            if tunnel_id in self.processes:
+                proc = self.processes[tunnel_id]
+                try:
+                    stop_process(proc)
+                except Exception as exc:
+                    logger.warning("Error stopping Backhaul server for tunnel %s: %s", tunnel_id, exc)
+                finally:
+                    pid_registry.remove(f"backhaul:{tunnel_id}")
+                    self._cleanup_process(tunnel_id)
+
+            config_path = self.config_dir / f"{tunnel_id}.toml"
+            if config_path.exists():
+                try:
+                    config_path.unlink()
+                except Exception as exc:
+                    logger.warning("Failed to remove Backhaul config %s: %s", config_path, exc)
 
     def is_running(self, tunnel_id: str) -> bool:
         """Return True if server process is running"""
@@ -142,18 +166,20 @@ class BackhaulManager:
 
     def cleanup_all(self):
         """Stop all Backhaul servers"""
-        for tunnel_id in list(self.processes.keys()):
-            self.stop_server(tunnel_id)
+        with self._lock:
+            for tunnel_id in list(self.processes.keys()):
+                self.stop_server(tunnel_id)
 
     def get_active_servers(self) -> List[str]:
         """Return active Backhaul tunnel IDs"""
-        active = []
-        for tunnel_id, proc in list(self.processes.items()):
-            if proc.poll() is None:
-                active.append(tunnel_id)
-            else:
-                self._cleanup_process(tunnel_id)
-        return active
+        with self._lock:
+            active = []
+            for tunnel_id, proc in list(self.processes.items()):
+                if proc.poll() is None:
+                    active.append(tunnel_id)
+                else:
+                    self._cleanup_process(tunnel_id)
+            return active
 
     def _cleanup_process(self, tunnel_id: str):
         if tunnel_id in self.processes:
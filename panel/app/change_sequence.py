@@ -0,0 +1,107 @@
+"""Global change sequence and the ETags derived from it for dashboard polling"""
+import hashlib
+import time
+import uuid
+from itertools import chain
+from typing import Optional
+
+from fastapi import Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import Tunnel, Node, Settings, CoreResetConfig
+
+# Rows whose changes are visible in the dashboard endpoints
+WATCHED_MODELS = (Tunnel, Node, Settings, CoreResetConfig)
+
+# Dashboard endpoints served with ETags. Those marked live also show data
+# that is not in the database (system load, node probes); their tags roll
+# over every etag_live_ttl seconds so that data is refreshed regularly.
+ETAG_PATHS = {
+    "/api/status": True,
+    "/api/tunnels": False,
+    "/api/nodes": True,
+    "/api/core-health/health": True,
+}
+
+
+class ChangeSequence:
+    """Monotonic counter bumped whenever a tunnel, node or setting changes.
+
+    Committed ORM changes to the watched models bump it through session
+    events. Writers that update those tables with Core statements on the
+    session connection (usage, heartbeats) and node connection changes
+    bump it directly. The epoch is new
+    on every start so tags issued by a previous process never match.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.value = 0
+
+    def bump(self):
+        self.value += 1
+
+    def etag(self, path: str, query: str, live: bool) -> str:
+        tag = f"{self.epoch}-{self.value}"
+        if live:
+            tag += f"-{int(time.time() // max(settings.etag_live_ttl, 1.0))}"
+        if query:
+            tag += "-" + hashlib.sha1(query.encode()).hexdigest()[:12]
+        return f'"{path.rsplit("/", 1)[-1]}-{tag}"'
+
+
+def if_none_match(header: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header matches the tag (weak comparison, as the header requires)"""
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+async def etag_middleware(request, call_next):
+    """Answer 304 for unchanged dashboard reads before the endpoint runs"""
+    path = request.url.path.rstrip("/")
+    live = ETAG_PATHS.get(path)
+    if request.method != "GET" or live is None:
+        return await call_next(request)
+    # Taken before the endpoint reads anything, so a change during the read gets a new tag
+    etag = change_sequence.etag(path, request.url.query, live)
+    if if_none_match(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@event.listens_for(Session, "after_flush")
+def _after_flush(session, flush_context):
+    if any(isinstance(obj, WATCHED_MODELS) for obj in chain(session.new, session.dirty, session.deleted)):
+        session.info["changes_pending"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _on_orm_execute(orm_execute_state):
+    mapper = orm_execute_state.bind_mapper
+    if not orm_execute_state.is_select and mapper is not None and issubclass(mapper.class_, WATCHED_MODELS):
+        orm_execute_state.session.info["changes_pending"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    if session.info.pop("changes_pending", False):
+        change_sequence.bump()
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop("changes_pending", None)
+
+
+change_sequence = ChangeSequence()
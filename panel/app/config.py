@@ -19,12 +19,56 @@ class Settings(BaseSettings):
     db_name: str = "cimex"
     db_user: str = "cimex"
     db_password: str = "changeme"
+    db_busy_timeout_ms: int = 5000
+    db_cache_size_kb: int = 65536
+    db_mmap_size: int = 268435456
+    db_read_pool_size: int = 4
+    etag_live_ttl: float = 15.0
     
     node_port: int = 4443
     node_cert_path: str = "./certs/ca.crt"
     node_key_path: str = "./certs/ca.key"
     node_server_cert_path: str = "./certs/ca-server.crt"
     node_server_key_path: str = "./certs/ca-server.key"
+    node_channel_enabled: bool = True
+    node_heartbeat_interval: float = 15.0
+    
+    node_http2: bool = False  # needs the h2 package and an HTTPS node address
+    node_pool_max_connections: int = 20
+    node_keepalive_expiry: float = 30.0
+    node_pool_idle_timeout: float = 300.0
+    node_pool_max_failures: int = 3
+    node_breaker_threshold: int = 5
+    node_breaker_reset_timeout: float = 30.0
+    node_rtt_min_samples: int = 5
+    node_timeout_min: float = 1.0
+    node_max_concurrency: int = 16
+    
+    reapply_batch_size: int = 25
+    reapply_node_concurrency: int = 2
+    reapply_concurrency: int = 8
+    
+    job_workers: int = 4
+    job_retention_days: int = 7
+    
+    gost_shared_mode: bool = False
+    gost_api_port: int = 18090
+    
+    rathole_shared_mode: bool = False
+    frp_shared_mode: bool = False
+    
+    restart_backoff_base: float = 1.0
+    restart_backoff_max: float = 60.0
+    restart_stable_after: float = 60.0
+    restart_flap_window: float = 300.0
+    restart_flap_threshold: int = 5
+    
+    usage_poll_interval: int = 30
+    usage_compact_interval: int = 60
+    usage_raw_retention_hours: int = 6
+    usage_minute_retention_days: int = 2
+    usage_hour_retention_days: int = 90
+    usage_day_retention_days: int = 0  # 0 keeps day buckets forever
     
     secret_key: str = "changeme-secret-key-change-in-production"
     
@@ -3,7 +3,7 @@ import os
 import logging
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import text
+from sqlalchemy import event, text
 from app.config import settings
 
 Base = declarative_base()
@@ -16,9 +16,83 @@ else:
 engine = create_async_engine(db_url, echo=False)
 AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Separate pool for read-only requests: with WAL they read the last committed
+# state without waiting for a connection held by a tunnel change
+read_engine = create_async_engine(
+    db_url,
+    echo=False,
+    pool_size=settings.db_read_pool_size,
+    max_overflow=settings.db_read_pool_size,
+)
+AsyncReadSessionLocal = async_sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
 logger = logging.getLogger(__name__)
 
 
+def _apply_pragmas(dbapi_connection, read_only: bool):
+    cursor = dbapi_connection.cursor()
+    try:
+        if not read_only:
+            # Persistent in the file; readers then never block the writer or each other
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.db_busy_timeout_ms)}")
+        cursor.execute(f"PRAGMA cache_size=-{int(settings.db_cache_size_kb)}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.db_mmap_size)}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+    finally:
+        cursor.close()
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def _on_write_connect(dbapi_connection, connection_record):
+    _apply_pragmas(dbapi_connection, read_only=False)
+
+
+@event.listens_for(read_engine.sync_engine, "connect")
+def _on_read_connect(dbapi_connection, connection_record):
+    _apply_pragmas(dbapi_connection, read_only=True)
+
+
+# Schema steps applied once each, tracked in PRAGMA user_version
+SCHEMA_VERSIONS = [
+    (1, [
+        "CREATE INDEX IF NOT EXISTS ix_tunnels_status_core ON tunnels (status, core)",
+        "CREATE INDEX IF NOT EXISTS ix_tunnels_node_status ON tunnels (node_id, status)",
+        "CREATE INDEX IF NOT EXISTS ix_core_reset_config_enabled_next ON core_reset_config (enabled, next_reset)",
+        "ANALYZE",
+    ]),
+    # Keyset pagination order for the tunnel and node listings
+    (2, [
+        "CREATE INDEX IF NOT EXISTS ix_tunnels_created ON tunnels (created_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_nodes_registered ON nodes (registered_at, id)",
+    ]),
+    # Node lookups by role and address, and usage history by tunnel and time.
+    # Needs the node columns migrate_db adds first.
+    (3, [
+        "CREATE INDEX IF NOT EXISTS ix_nodes_role ON nodes (role)",
+        "CREATE INDEX IF NOT EXISTS ix_nodes_ip_address ON nodes (ip_address)",
+        "CREATE INDEX IF NOT EXISTS ix_usage_tunnel_timestamp ON usage (tunnel_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_usage_timestamp ON usage (timestamp)",
+        "ANALYZE",
+    ]),
+]
+
+
+async def _apply_schema_versions(conn):
+    version = (await conn.execute(text("PRAGMA user_version"))).scalar() or 0
+    for target, statements in SCHEMA_VERSIONS:
+        if target <= version:
+            continue
+        logger.info(f"Applying database schema version {target}")
+        for statement in statements:
+            await conn.execute(text(statement))
+        await conn.execute(text(f"PRAGMA user_version={target}"))
+        version = target
+
+
 async def migrate_db():
     """Migrate database schema - add missing columns"""
     if settings.db_type != "sqlite":
@@ -47,6 +121,23 @@ async def migrate_db():
             await conn.execute(text(
                 "ALTER TABLE tunnels ADD COLUMN iran_node_id VARCHAR"
             ))
+        
+        result = await conn.execute(text(
+            "PRAGMA table_info(nodes)"
+        ))
+        node_columns = [row[1] for row in result.fetchall()]
+        for column in ("role", "ip_address", "api_address"):
+            if column not in node_columns:
+                logger.info(f"Adding {column} column to nodes table")
+                await conn.execute(text(
+                    f"ALTER TABLE nodes ADD COLUMN {column} VARCHAR"
+                ))
+                await conn.execute(text(
+                    f"UPDATE nodes SET {column} = json_extract(metadata, '$.{column}') WHERE {column} IS NULL"
+                ))
+        
+        # create_all does not add indexes to tables that already existed
+        await _apply_schema_versions(conn)
 
 
 async def init_db():
@@ -66,3 +157,9 @@ async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
 
+
+async def get_read_db():
+    """Read-only database session dependency for endpoints that never write"""
+    async with AsyncReadSessionLocal() as session:
+        yield session
+
@@ -1,11 +1,17 @@
 """FRP server management for panel"""
 import os
 import subprocess
-import time
+import threading
 import logging
 from pathlib import Path
 from typing import Dict, Optional
 
+from app.config import settings
+from app.pid_registry import pid_registry, stop_process
+from app.process_monitor import process_monitor
+from app.readiness import READY_PATTERNS, wait_for_ready
+from app.shared_cores import SharedFrpsServer, SharedServers
+
 logger = logging.getLogger(__name__)
 
 
@@ -16,7 +22,12 @@ class FrpServerManager:
         self.config_dir = Path("/app/data/frp")
         self.config_dir.mkdir(parents=True, exist_ok=True)
         self.active_servers: Dict[str, subprocess.Popen] = {}
+        self._lock = threading.RLock()
         self.server_configs: Dict[str, dict] = {}
+        self.shared = SharedServers(self._shared_instance) if settings.frp_shared_mode else None
+    
+    def _shared_instance(self, bind_port: int, params: dict) -> SharedFrpsServer:
+        return SharedFrpsServer(self.config_dir, self._resolve_binary_path(), bind_port, params)
     
     def _resolve_binary_path(self) -> Path:
         """Resolve frps binary path"""
@@ -55,78 +66,86 @@ class FrpServerManager:
         Returns:
             True if server started successfully, False otherwise
         """
-        try:
-            if tunnel_id in self.active_servers:
-                logger.warning(f"FRP server for tunnel {tunnel_id} already exists, stopping it first")
-                self.stop_server(tunnel_id)
-            
-            config_file = self.config_dir / f"frps_{tunnel_id}.yaml"
-            config_content = f"""bindPort: {bind_port}
+        with self._lock:
+            try:
+                if tunnel_id in self.active_servers:
+                    logger.warning(f"FRP server for tunnel {tunnel_id} already exists, stopping it first")
+                    self.stop_server(tunnel_id)
+                
+                if self.shared:
+                    # frps has a single token, so tunnels sharing a bind port must share it too
+                    self.shared.put(tunnel_id, int(bind_port), {"token": token}, [])
+                    logger.info(f"Tunnel {tunnel_id} uses shared FRP server on port {bind_port}")
+                    return True
+                
+                config_file = self.config_dir / f"frps_{tunnel_id}.yaml"
+                config_content = f"""bindPort: {bind_port}
 """
-            if token:
-                config_content += f"""auth:
+                if token:
+                    config_content += f"""auth:
   method: token
   token: "{token}"
 """
-            with open(config_file, 'w') as f:
-                f.write(config_content)
-            
-            logger.info(f"FRP server config file {config_file} content:\n{config_content}")
-            
-            binary_path = self._resolve_binary_path()
-            cmd = [
-                str(binary_path),
-                "-c", str(config_file)
-            ]
-            
-            self.server_configs[tunnel_id] = {
-                "bind_port": bind_port,
-                "token": token,
-                "config_file": str(config_file)
-            }
-            
-            log_file = self.config_dir / f"frps_{tunnel_id}.log"
-            log_f = open(log_file, 'w', buffering=1)
-            try:
-                log_f.write(f"Starting FRP server for tunnel {tunnel_id}\n")
-                log_f.write(f"Config: bind_port={bind_port}, token={'set' if token else 'none'}\n")
-                log_f.write(f"Command: {' '.join(cmd)}\n")
-                log_f.flush()
-                proc = subprocess.Popen(
-                    cmd,
-                    stdout=log_f,
-                    stderr=subprocess.STDOUT,
-                    cwd=str(self.config_dir),
-                    start_new_session=True
-                )
-            except FileNotFoundError:
-                log_f.write(f"Starting FRP server (system binary) for tunnel {tunnel_id}\n")
-                log_f.flush()
-                proc = subprocess.Popen(
-                    ["frps"] + cmd[1:],
-                    stdout=log_f,
-                    stderr=subprocess.STDOUT,
-                    cwd=str(self.config_dir),
-                    start_new_session=True
-                )
-            
-            self.active_servers[f"{tunnel_id}_log"] = log_f
-            self.active_servers[tunnel_id] = proc
-            
-            time.sleep(1.0)
-            if proc.poll() is not None:
+                with open(config_file, 'w') as f:
+                    f.write(config_content)
+                
+                logger.info(f"FRP server config file {config_file} content:\n{config_content}")
+                
+                binary_path = self._resolve_binary_path()
+                cmd = [
+                    str(binary_path),
+                    "-c", str(config_file)
+                ]
+                
+                self.server_configs[tunnel_id] = {
+                    "bind_port": bind_port,
+                    "token": token,
+                    "config_file": str(config_file)
+                }
+                
+                log_file = self.config_dir / f"frps_{tunnel_id}.log"
+                log_f = open(log_file, 'w', buffering=1)
                 try:
-                    if log_file.exists():
-                        with open(log_file, 'r') as f:
-                            error_output = f.read()
-                    else:
-                        error_output = "Log file not found"
-                    error_msg = f"FRP server failed to start (exit code: {proc.poll()}): {error_output[-500:] if len(error_output) > 500 else error_output}"
-                    logger.error(error_msg)
-                except Exception as e:
-                    error_msg = f"FRP server failed to start (exit code: {proc.poll()}), could not read log: {e}"
-                    logger.error(error_msg)
-                finally:
+                    log_f.write(f"Starting FRP server for tunnel {tunnel_id}\n")
+                    log_f.write(f"Config: bind_port={bind_port}, token={'set' if token else 'none'}\n")
+                    log_f.write(f"Command: {' '.join(cmd)}\n")
+                    log_f.flush()
+                    proc = subprocess.Popen(
+                        cmd,
+                        stdout=log_f,
+                        stderr=subprocess.STDOUT,
+                        cwd=str(self.config_dir),
+                        start_new_session=True
+                    )
+                except FileNotFoundError:
+                    log_f.write(f"Starting FRP server (system binary) for tunnel {tunnel_id}\n")
+                    log_f.flush()
+                    proc = subprocess.Popen(
+                        ["frps"] + cmd[1:],
+                        stdout=log_f,
+                        stderr=subprocess.STDOUT,
+                        cwd=str(self.config_dir),
+                        start_new_session=True
+                    )
+                
+                self.active_servers[f"{tunnel_id}_log"] = log_f
+                self.active_servers[tunnel_id] = proc
+                pid_registry.add(f"frp:{tunnel_id}", proc.pid, proc.args)
+                
+                ready, reason = wait_for_ready(
+                    proc,
+                    tcp_ports=[bind_port],
+                    log_path=log_file,
+                    patterns=READY_PATTERNS["frp"],
+                )
+                if not ready:
+                    try:
+                        error_output = log_file.read_text()[-500:] if log_file.exists() else "Log file not found"
+                    except Exception as e:
+                        error_output = f"could not read log: {e}"
+                    if proc.poll() is None:
+                        proc.kill()
+                        proc.wait()
                     del self.active_servers[tunnel_id]
                     if f"{tunnel_id}_log" in self.active_servers:
                         try:
@@ -136,88 +155,69 @@ class FrpServerManager:
                         del self.active_servers[f"{tunnel_id}_log"]
                     if tunnel_id in self.server_configs:
                         del self.server_configs[tunnel_id]
-                raise RuntimeError(error_msg)
-            
-            # Verify server is actually listening
-            try:
-                import socket
-                max_retries = 3
-                port_listening = False
-                for attempt in range(max_retries):
-                    time.sleep(0.5)
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(1)
-                    result = sock.connect_ex(('127.0.0.1', bind_port))
-                    sock.close()
-                    if result == 0:
-                        port_listening = True
-                        break
-                
-                if not port_listening:
-                    if proc.poll() is not None:
-                        error_msg = f"FRP server process exited (code: {proc.poll()}) before port verification"
-                        logger.error(error_msg)
-                        raise RuntimeError(error_msg)
-                    else:
-                        logger.warning(f"FRP server port {bind_port} not listening after {max_retries} attempts, but process is running. PID: {proc.pid}")
-                else:
-                    logger.info(f"FRP server port {bind_port} verified as listening")
-            except Exception as e:
-                if proc.poll() is not None:
-                    error_msg = f"FRP server process died during verification (code: {proc.poll()}): {e}"
+                    error_msg = f"FRP server failed to start ({reason}): {error_output}"
                     logger.error(error_msg)
                     raise RuntimeError(error_msg)
-                logger.warning(f"Could not verify FRP server port is listening: {e}")
-            
-            logger.info(f"Started FRP server for tunnel {tunnel_id} on port {bind_port} (PID: {proc.pid})")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Failed to start FRP server for tunnel {tunnel_id}: {e}")
-            raise
+                
+                process_monitor.watch(
+                    f"frp:{tunnel_id}",
+                    proc,
+                    lambda: self.start_server(tunnel_id, bind_port, token),
+                    lock=self._lock,
+                )
+                logger.info(f"Started FRP server for tunnel {tunnel_id} on port {bind_port} (PID: {proc.pid})")
+                return True
+                
+            except Exception as e:
+                logger.error(f"Failed to start FRP server for tunnel {tunnel_id}: {e}")
+                raise
     
     def stop_server(self, tunnel_id: str):
         """Stop FRP server for a tunnel"""
-        if tunnel_id in self.active_servers:
-            proc = self.active_servers[tunnel_id]
-            try:
-                proc.terminate()
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                proc.kill()
-                proc.wait()
-            except Exception as e:
-                logger.warning(f"Error stopping FRP server for tunnel {tunnel_id}: {e}")
-            finally:
-                del self.active_servers[tunnel_id]
-                log_key = f"{tunnel_id}_log"
-                if log_key in self.active_servers:
+        with self._lock:
+            if self.shared and self.shared.remove(tunnel_id):
+                logger.info(f"Released shared FRP server for tunnel {tunnel_id}")
+                return
+            process_monitor.unwatch(f"frp:{tunnel_id}")
+            if tunnel_id in self.active_servers:
+                proc = self.active_servers[tunnel_id]
+                try:
+                    stop_process(proc)
+                except Exception as e:
+                    logger.warning(f"Error stopping FRP server for tunnel {tunnel_id}: {e}")
+                finally:
+                    pid_registry.remove(f"frp:{tunnel_id}")
+                    del self.active_servers[tunnel_id]
+                    log_key = f"{tunnel_id}_log"
+                    if log_key in self.active_servers:
+                        try:
+                            self.active_servers[log_key].close()
+                        except:
+                            pass
+                        del self.active_servers[log_key]
+                
+                logger.info(f"Stopped FRP server for tunnel {tunnel_id}")
+            
+            if tunnel_id in self.server_configs:
+                config_file = Path(self.server_configs[tunnel_id].get("config_file", ""))
+                if config_file.exists():
                     try:
-                        self.active_servers[log_key].close()
+                        config_file.unlink()
                     except:
                         pass
-                    del self.active_servers[log_key]
+                del self.server_configs[tunnel_id]
             
-            logger.info(f"Stopped FRP server for tunnel {tunnel_id}")
-        
-        if tunnel_id in self.server_configs:
-            config_file = Path(self.server_configs[tunnel_id].get("config_file", ""))
-            if config_file.exists():
+            old_toml_config = self.config_dir / f"frps_{tunnel_id}.toml"
+            if old_toml_config.exists():
                 try:
-                    config_file.unlink()
+                    old_toml_config.unlink()
                 except:
                     pass
-            del self.server_configs[tunnel_id]
-        
-        old_toml_config = self.config_dir / f"frps_{tunnel_id}.toml"
-        if old_toml_config.exists():
-            try:
-                old_toml_config.unlink()
-            except:
-                pass
     
     def is_running(self, tunnel_id: str) -> bool:
         """Check if server is running for a tunnel"""
+        if self.shared and self.shared.owns(tunnel_id):
+            return self.shared.tunnel_running(tunnel_id)
         if tunnel_id not in self.active_servers:
             return False
         proc = self.active_servers[tunnel_id]
@@ -225,31 +225,37 @@ class FrpServerManager:
     
     def get_active_servers(self) -> list:
         """Get list of tunnel IDs with active servers"""
-        active = []
-        for tunnel_id, proc in list(self.active_servers.items()):
-            if tunnel_id.endswith("_log"):
-                continue
-            if isinstance(proc, subprocess.Popen):
-                if proc.poll() is None:
-                    active.append(tunnel_id)
-                else:
-                    del self.active_servers[tunnel_id]
-                    log_key = f"{tunnel_id}_log"
-                    if log_key in self.active_servers:
-                        try:
-                            self.active_servers[log_key].close()
-                        except:
-                            pass
-                        del self.active_servers[log_key]
-                    if tunnel_id in self.server_configs:
-                        del self.server_configs[tunnel_id]
-        return active
+        with self._lock:
+            active = []
+            for tunnel_id, proc in list(self.active_servers.items()):
+                if tunnel_id.endswith("_log"):
+                    continue
+                if isinstance(proc, subprocess.Popen):
+                    if proc.poll() is None:
+                        active.append(tunnel_id)
+                    else:
+                        del self.active_servers[tunnel_id]
+                        log_key = f"{tunnel_id}_log"
+                        if log_key in self.active_servers:
+                            try:
+                                self.active_servers[log_key].close()
+                            except:
+                                pass
+                            del self.active_servers[log_key]
+                        if tunnel_id in self.server_configs:
+                            del self.server_configs[tunnel_id]
+            if self.shared:
+                active.extend(self.shared.active_tunnels())
+            return active
     
     def cleanup_all(self):
         """Stop all FRP servers"""
-        tunnel_ids = [tid for tid in self.active_servers.keys() if not tid.endswith("_log")]
-        for tunnel_id in tunnel_ids:
-            self.stop_server(tunnel_id)
+        with self._lock:
+            tunnel_ids = [tid for tid in self.active_servers.keys() if not tid.endswith("_log")]
+            for tunnel_id in tunnel_ids:
+                self.stop_server(tunnel_id)
+            if self.shared:
+                self.shared.stop()
 
 
 frp_server_manager = FrpServerManager()
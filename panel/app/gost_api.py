@@ -0,0 +1,206 @@
+"""Shared GOST v3 instance driven through its localhost config API"""
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Set
+
+import httpx
+
+from app.config import settings
+from app.pid_registry import pid_registry, stop_process
+from app.process_monitor import process_monitor
+from app.readiness import wait_for_ready
+
+logger = logging.getLogger(__name__)
+
+SHARED_KEY = "gost:shared"
+
+# gost v2 URL scheme -> (v3 listener, v3 handler)
+LISTENER_TYPES = {
+    "tcp": ("tcp", "tcp"),
+    "udp": ("udp", "udp"),
+    "ws": ("ws", "tcp"),
+    "grpc": ("grpc", "tcp"),
+    "tcpmux": ("mtcp", "tcp"),
+}
+
+
+def build_service(name: str, tunnel_type: str, listen_addr: str, target_addr: str) -> Dict[str, Any]:
+    """Build a v3 forwarding service equivalent to `-L=<type>://<listen>/<target>`"""
+    if tunnel_type not in LISTENER_TYPES:
+        raise ValueError(f"Unsupported tunnel type: {tunnel_type}")
+    listener, handler = LISTENER_TYPES[tunnel_type]
+    return {
+        "name": name,
+        "addr": listen_addr,
+        "handler": {"type": handler},
+        "listener": {"type": listener},
+        "forwarder": {"nodes": [{"name": f"{name}-target", "addr": target_addr}]},
+    }
+
+
+class SharedGostInstance:
+    """One long-running gost process for the panel; forwards are services added over its API.
+
+    API calls are blocking and serialized by a thread lock. The instance is
+    only driven through GostForwarder, whose methods async code runs with
+    asyncio.to_thread, so these calls never run on the event loop.
+    """
+
+    STATUS_TTL = 1.0
+
+    def __init__(self, config_dir: Path):
+        self.config_dir = config_dir
+        self.api_port = settings.gost_api_port
+        self.services: Dict[str, List[Dict[str, Any]]] = {}
+        self.proc: Optional[subprocess.Popen] = None
+        self._log_f = None
+        self._lock = threading.RLock()
+        self._client: Optional[httpx.Client] = None
+        self._live_names: Set[str] = set()
+        self._live_checked_at = 0.0
+
+    def _resolve_binary_path(self) -> Path:
+        """Resolve the gost v3 binary path"""
+        env_path = os.environ.get("GOST_SHARED_BINARY")
+        if env_path and Path(env_path).is_file():
+            return Path(env_path)
+        for path in (Path("/usr/local/bin/gost3"), Path("/usr/bin/gost3")):
+            if path.is_file():
+                return path
+        resolved = shutil.which("gost3")
+        if resolved:
+            return Path(resolved)
+        raise FileNotFoundError(
+            "gost v3 binary not found. Expected at GOST_SHARED_BINARY, '/usr/local/bin/gost3', or in PATH."
+        )
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            self._client = httpx.Client(base_url=f"http://127.0.0.1:{self.api_port}", timeout=5.0)
+        return self._client
+
+    def is_running(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def ensure_running(self):
+        """Start the shared instance if needed and replay every known service into it"""
+        if self.is_running():
+            return
+        self._close_log()
+        cmd = [str(self._resolve_binary_path()), "-api", f"127.0.0.1:{self.api_port}"]
+        log_file = self.config_dir / "gost_shared.log"
+        self._log_f = open(log_file, 'w', buffering=1)
+        self._log_f.write(f"Starting shared gost with command: {' '.join(cmd)}\n")
+        self._log_f.flush()
+        self.proc = subprocess.Popen(
+            cmd,
+            stdout=self._log_f,
+            stderr=subprocess.STDOUT,
+            cwd=str(self.config_dir),
+            start_new_session=True
+        )
+        pid_registry.add(SHARED_KEY, self.proc.pid, cmd)
+        ready, reason = wait_for_ready(self.proc, tcp_ports=[self.api_port], log_path=log_file)
+        if not ready:
+            self.stop()
+            raise RuntimeError(f"Shared gost failed to start ({reason})")
+        for services in self.services.values():
+            for service in services:
+                self._upsert(service)
+        self._live_checked_at = 0.0
+        process_monitor.watch(SHARED_KEY, self.proc, self.restart, lock=self._lock)
+        logger.info(f"Shared gost instance ready on 127.0.0.1:{self.api_port}, PID={self.proc.pid}")
+
+    def restart(self):
+        """Bring a crashed instance back with all of its services"""
+        with self._lock:
+            self.ensure_running()
+
+    def put_services(self, tunnel_id: str, services: List[Dict[str, Any]]):
+        """Install the services of a forward, replacing any it had before"""
+        with self._lock:
+            self.ensure_running()
+            previous = {service["name"] for service in self.services.get(tunnel_id, [])}
+            for service in services:
+                self._upsert(service)
+            for name in previous - {service["name"] for service in services}:
+                self._delete(name)
+            self.services[tunnel_id] = services
+            self._live_checked_at = 0.0
+
+    def remove_services(self, tunnel_id: str):
+        """Remove every service belonging to a forward"""
+        with self._lock:
+            services = self.services.pop(tunnel_id, [])
+            if self.is_running():
+                for service in services:
+                    self._delete(service["name"])
+            self._live_checked_at = 0.0
+
+    def tunnel_running(self, tunnel_id: str) -> bool:
+        """Return True if all services of the forward are present in the live service list"""
+        with self._lock:
+            services = self.services.get(tunnel_id)
+            if not services or not self.is_running():
+                return False
+            live = self._service_names()
+            return all(service["name"] in live for service in services)
+
+    def stop(self):
+        with self._lock:
+            process_monitor.unwatch(SHARED_KEY)
+            if self.proc is not None:
+                try:
+                    stop_process(self.proc)
+                except Exception as e:
+                    logger.warning(f"Error stopping shared gost: {e}")
+                pid_registry.remove(SHARED_KEY)
+            self.proc = None
+            self._close_log()
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def _close_log(self):
+        if self._log_f:
+            try:
+                self._log_f.close()
+            except:
+                pass
+            self._log_f = None
+
+    def _service_names(self) -> Set[str]:
+        now = time.monotonic()
+        if now - self._live_checked_at < self.STATUS_TTL:
+            return self._live_names
+        try:
+            response = self.client.get("/config", params={"format": "json"})
+            response.raise_for_status()
+            services = response.json().get("services") or []
+            self._live_names = {service.get("name") for service in services}
+        except Exception as e:
+            logger.warning(f"Could not list shared gost services: {e}")
+            self._live_names = set()
+        self._live_checked_at = now
+        return self._live_names
+
+    def _upsert(self, service: Dict[str, Any]):
+        response = self.client.post("/config/services", json=service)
+        if response.status_code >= 400:
+            response = self.client.put(f"/config/services/{service['name']}", json=service)
+        if response.status_code >= 400:
+            raise RuntimeError(f"gost API rejected service {service['name']}: {response.text}")
+
+    def _delete(self, name: str):
+        try:
+            response = self.client.delete(f"/config/services/{name}")
+            if response.status_code >= 400 and response.status_code != 404:
+                logger.warning(f"gost API failed to delete service {name}: {response.text}")
+        except Exception as e:
+            logger.warning(f"gost API failed to delete service {name}: {e}")
@@ -0,0 +1,316 @@
+"""Persisted job queue for long-running panel mutations"""
+import asyncio
+import contextvars
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import select, update, delete, insert
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Job, JobEvent
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED = (SUCCEEDED, FAILED)
+
+MAX_EVENTS = 500
+# Request headers kept with a job so handlers see the same host information when it runs
+CONTEXT_HEADERS = ("host", "x-forwarded-host", "x-forwarded-proto")
+
+current_job: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_job", default=None)
+
+JobHandler = Callable[[Dict[str, Any], Request, Any], Awaitable[Any]]
+
+
+def job_dict(job: Job) -> Dict[str, Any]:
+    return {
+        "job_id": job.id,
+        "kind": job.kind,
+        "key": job.key,
+        "status": job.status,
+        "status_code": job.status_code,
+        "result": job.result,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+class JobLogHandler(logging.Handler):
+    """Copies log records emitted while a job runs into that job's events"""
+
+    def __init__(self, queue: "JobQueue"):
+        super().__init__()
+        self.queue = queue
+
+    def emit(self, record):
+        job_id = current_job.get()
+        if job_id:
+            self.queue.add_event(job_id, record.levelname, record.getMessage())
+
+
+class JobQueue:
+    """SQLite-backed queue of panel jobs run by a pool of worker tasks.
+
+    A job row is committed before its id is queued, so queued work survives
+    a restart. Jobs that share a key (e.g. the same tunnel) run one at a
+    time in submission order. Everything logged under the app package while
+    a job runs is captured as its progress events; events are served from
+    memory while the job runs and written to job_events when it finishes.
+    Jobs that were running when the panel stopped are marked failed rather
+    than replayed, since they may have been half applied.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.handlers: Dict[str, JobHandler] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+        self.prune_task: Optional[asyncio.Task] = None
+        self._events: Dict[str, List[Dict[str, Any]]] = {}
+        self._waiters: Dict[str, asyncio.Future] = {}
+        self._locks: Dict[str, list] = {}
+        self._log_handler = JobLogHandler(self)
+
+    def register(self, kind: str, handler: JobHandler):
+        """Register the coroutine that runs jobs of a kind; it gets (payload, request, db)"""
+        self.handlers[kind] = handler
+
+    async def start(self, app):
+        """Recover jobs from the database and start the workers"""
+        await self.stop()
+        self.app = app
+        self.queue = asyncio.Queue()
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(Job)
+                .where(Job.status == RUNNING)
+                .values(status=FAILED, status_code=500, error="Interrupted by panel restart", finished_at=datetime.utcnow())
+            )
+            await self._prune(session)
+            queued = (await session.execute(
+                select(Job.id).where(Job.status == QUEUED).order_by(Job.created_at)
+            )).scalars().all()
+            await session.commit()
+        for job_id in queued:
+            self.queue.put_nowait(job_id)
+        logging.getLogger("app").addHandler(self._log_handler)
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(max(1, settings.job_workers))]
+        self.prune_task = asyncio.create_task(self._prune_loop())
+        logger.info(f"Job queue started: {len(self.workers)} workers, {len(queued)} queued jobs")
+
+    async def stop(self):
+        """Stop the workers; jobs in flight are marked failed on the next start"""
+        tasks = self.workers + ([self.prune_task] if self.prune_task else [])
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if tasks:
+            logger.info("Job queue stopped")
+        self.workers = []
+        self.prune_task = None
+        logging.getLogger("app").removeHandler(self._log_handler)
+
+    async def submit(self, kind: str, payload: Dict[str, Any], request: Optional[Request] = None, key: Optional[str] = None) -> Job:
+        """Persist a job and queue it"""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        if self.queue is None:
+            raise RuntimeError("Job queue is not running")
+        context = None
+        if request is not None:
+            context = {
+                "scheme": request.url.scheme,
+                "path": request.url.path,
+                "headers": {name: request.headers[name] for name in CONTEXT_HEADERS if name in request.headers},
+            }
+        job = Job(kind=kind, key=key, status=QUEUED, payload=payload, context=context, created_at=datetime.utcnow())
+        async with AsyncSessionLocal() as session:
+            session.add(job)
+            await session.commit()
+        self._waiters[job.id] = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(job.id)
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        async with AsyncSessionLocal() as session:
+            return await session.get(Job, job_id)
+
+    async def list_jobs(self, status: Optional[str] = None, limit: int = 50) -> List[Job]:
+        query = select(Job).order_by(Job.created_at.desc()).limit(limit)
+        if status:
+            query = query.where(Job.status == status)
+        async with AsyncSessionLocal() as session:
+            return (await session.execute(query)).scalars().all()
+
+    async def wait(self, job_id: str) -> Optional[Job]:
+        """Wait for a job submitted by this process to finish and return it"""
+        future = self._waiters.get(job_id)
+        if future is not None:
+            # Shielded so a client that disconnects does not cancel the job's completion signal
+            await asyncio.shield(future)
+        return await self.get(job_id)
+
+    async def respond(self, job: Job, request: Request) -> Any:
+        """Answer a mutating request: 202 if the client sent Prefer: respond-async, else the job's result"""
+        if "respond-async" in request.headers.get("prefer", "").lower():
+            return JSONResponse(
+                status_code=202,
+                content=jsonable_encoder(job_dict(job)),
+                headers={"Location": f"/api/jobs/{job.id}", "Preference-Applied": "respond-async"},
+            )
+        job = await self.wait(job.id)
+        if job.status != SUCCEEDED:
+            detail = (job.result or {}).get("detail", job.error)
+            raise HTTPException(status_code=job.status_code or 500, detail=detail)
+        return job.result
+
+    def add_event(self, job_id: str, level: str, message: str):
+        events = self._events.get(job_id)
+        if events is None or len(events) >= MAX_EVENTS:
+            return
+        events.append({"seq": len(events) + 1, "timestamp": datetime.utcnow(), "level": level, "message": message})
+
+    async def events(self, job_id: str, after: int = 0) -> List[Dict[str, Any]]:
+        """Return a job's events with seq greater than `after`"""
+        buffered = self._events.get(job_id)
+        if buffered is not None:
+            return buffered[after:]
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(JobEvent).where(JobEvent.job_id == job_id, JobEvent.seq > after).order_by(JobEvent.seq)
+            )
+            return [
+                {"seq": event.seq, "timestamp": event.timestamp, "level": event.level, "message": event.message}
+                for event in result.scalars().all()
+            ]
+
+    @asynccontextmanager
+    async def _serialized(self, key: Optional[str]):
+        if not key:
+            yield
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+    def _request(self, context: Optional[Dict[str, Any]]) -> Request:
+        """Rebuild a request carrying the app and the submitter's host headers"""
+        context = context or {}
+        headers = [
+            (name.encode("latin-1"), value.encode("latin-1"))
+            for name, value in (context.get("headers") or {}).items()
+        ]
+        return Request(scope={
+            "type": "http",
+            "app": self.app,
+            "method": "POST",
+            "scheme": context.get("scheme", "http"),
+            "path": context.get("path", "/"),
+            "headers": headers,
+            "query_string": b"",
+            "server": None,
+        })
+
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self._execute(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job {job_id} could not be run: {e}", exc_info=True)
+
+    async def _execute(self, job_id: str):
+        async with AsyncSessionLocal() as session:
+            job = await session.get(Job, job_id)
+        if not job or job.status != QUEUED:
+            return
+
+        async with self._serialized(job.key):
+            async with AsyncSessionLocal() as session:
+                await session.execute(
+                    update(Job).where(Job.id == job_id).values(status=RUNNING, started_at=datetime.utcnow())
+                )
+                await session.commit()
+
+            self._events[job_id] = []
+            token = current_job.set(job_id)
+            status, status_code, result, error = SUCCEEDED, 200, None, None
+            try:
+                handler = self.handlers.get(job.kind)
+                if handler is None:
+                    raise HTTPException(status_code=400, detail=f"Unknown job kind: {job.kind}")
+                logger.info(f"Job {job_id} started: {job.kind}")
+                async with AsyncSessionLocal() as db:
+                    result = jsonable_encoder(await handler(job.payload, self._request(job.context), db))
+            except HTTPException as e:
+                status, status_code, result, error = FAILED, e.status_code, jsonable_encoder({"detail": e.detail}), str(e.detail)
+            except Exception as e:
+                logger.error(f"Job {job_id} ({job.kind}) failed: {e}", exc_info=True)
+                status, status_code, result, error = FAILED, 500, None, f"Error: {str(e)}"
+            finally:
+                current_job.reset(token)
+
+            self.add_event(job_id, "INFO" if status == SUCCEEDED else "ERROR", f"Job {status}" + (f": {error}" if error else ""))
+            events = self._events.get(job_id) or []
+            async with AsyncSessionLocal() as session:
+                await session.execute(
+                    update(Job).where(Job.id == job_id).values(
+                        status=status,
+                        status_code=status_code,
+                        result=result,
+                        error=error,
+                        finished_at=datetime.utcnow(),
+                    )
+                )
+                if events:
+                    await session.execute(insert(JobEvent), [{"job_id": job_id, **event} for event in events])
+                await session.commit()
+            self._events.pop(job_id, None)
+
+        future = self._waiters.pop(job_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def _prune(self, session):
+        """Delete finished jobs and their events past retention"""
+        cutoff = datetime.utcnow() - timedelta(days=settings.job_retention_days)
+        expired = select(Job.id).where(Job.status.in_(FINISHED), Job.finished_at < cutoff)
+        await session.execute(delete(JobEvent).where(JobEvent.job_id.in_(expired)))
+        await session.execute(delete(Job).where(Job.status.in_(FINISHED), Job.finished_at < cutoff))
+
+    async def _prune_loop(self):
+        while True:
+            await asyncio.sleep(3600)
+            try:
+                async with AsyncSessionLocal() as session:
+                    await self._prune(session)
+                    await session.commit()
+            except Exception as e:
+                logger.error(f"Job pruning failed: {e}", exc_info=True)
+
+
+job_queue = JobQueue()
@@ -0,0 +1,82 @@
+"""Keyset pagination and field projection for list endpoints"""
+import base64
+import json
+from datetime import datetime
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import and_, or_
+
+MAX_PAGE_SIZE = 500
+CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(sort_value: datetime, row_id: str) -> str:
+    """Opaque cursor pointing just past a row"""
+    raw = json.dumps([sort_value.isoformat() if sort_value else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+        return (datetime.fromisoformat(sort_value) if sort_value else None), str(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def page_size(limit: Optional[int]) -> Optional[int]:
+    if limit is None:
+        return None
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def keyset(query, sort_column, id_column, cursor: Optional[str], limit: Optional[int]):
+    """Order by (sort_column, id_column) and start after the cursor's row.
+
+    One extra row is fetched past `limit` so the caller can tell whether
+    another page follows without a count query.
+    """
+    query = query.order_by(sort_column, id_column)
+    if cursor:
+        sort_value, row_id = decode_cursor(cursor)
+        if sort_value is None:
+            query = query.where(or_(sort_column.isnot(None), and_(sort_column.is_(None), id_column > row_id)))
+        else:
+            query = query.where(or_(
+                sort_column > sort_value,
+                and_(sort_column == sort_value, id_column > row_id),
+            ))
+    if limit:
+        query = query.limit(limit + 1)
+    return query
+
+
+def split_page(rows: Sequence[Any], limit: Optional[int], sort_attr: str) -> Tuple[List[Any], Optional[str]]:
+    """Trim the look-ahead row and return the page with the cursor for the next one"""
+    rows = list(rows)
+    if not limit or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, sort_attr), last.id)
+
+
+def parse_fields(fields: Optional[str], allowed: Iterable[str]) -> Optional[List[str]]:
+    """Parse a `fields=a,b` projection; None means every field. `id` is always included."""
+    if not fields:
+        return None
+    allowed = list(allowed)
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in allowed]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}"
+        )
+    if "id" not in requested:
+        requested.insert(0, "id")
+    return list(dict.fromkeys(requested))
@@ -1,5 +1,5 @@
 """Database models"""
-from sqlalchemy import Column, String, Integer, DateTime, Float, JSON, Boolean, Text
+from sqlalchemy import Column, String, Integer, DateTime, Float, JSON, Boolean, Text, Index, UniqueConstraint
 from sqlalchemy.dialects.sqlite import DATETIME as SQLiteDATETIME
 from datetime import datetime
 from app.database import Base
@@ -12,6 +12,11 @@ def generate_uuid():
 
 class Node(Base):
     __tablename__ = "nodes"
+    __table_args__ = (
+        Index("ix_nodes_role", "role"),
+        Index("ix_nodes_ip_address", "ip_address"),
+        Index("ix_nodes_registered", "registered_at", "id"),
+    )
     
     id = Column(String, primary_key=True, default=generate_uuid)
     name = Column(String, nullable=False)
@@ -19,11 +24,20 @@ class Node(Base):
     status = Column(String, default="pending")
     registered_at = Column(DateTime, default=datetime.utcnow)
     last_seen = Column(DateTime, default=datetime.utcnow)
+    # Copied out of metadata at registration so role and address lookups can use an index
+    role = Column(String, nullable=True)
+    ip_address = Column(String, nullable=True)
+    api_address = Column(String, nullable=True)
     node_metadata = Column("metadata", JSON, default=dict)
     
 
 class Tunnel(Base):
     __tablename__ = "tunnels"
+    __table_args__ = (
+        Index("ix_tunnels_status_core", "status", "core"),
+        Index("ix_tunnels_node_status", "node_id", "status"),
+        Index("ix_tunnels_created", "created_at", "id"),
+    )
     
     id = Column(String, primary_key=True, default=generate_uuid)
     name = Column(String, nullable=False)
@@ -53,7 +67,12 @@ class Admin(Base):
 
 
 class Usage(Base):
+    """Raw traffic samples; rolled up into UsageRollup and pruned by retention"""
     __tablename__ = "usage"
+    __table_args__ = (
+        Index("ix_usage_tunnel_timestamp", "tunnel_id", "timestamp"),
+        Index("ix_usage_timestamp", "timestamp"),
+    )
     
     id = Column(String, primary_key=True, default=generate_uuid)
     tunnel_id = Column(String, nullable=False)
@@ -62,8 +81,37 @@ class Usage(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
 
 
+class UsageRollup(Base):
+    """Traffic per tunnel aggregated into minute, hour or day buckets"""
+    __tablename__ = "usage_rollups"
+    __table_args__ = (
+        UniqueConstraint("resolution", "tunnel_id", "bucket", name="uq_usage_rollups_bucket"),
+        Index("ix_usage_rollups_tunnel_bucket", "tunnel_id", "bucket"),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    tunnel_id = Column(String, nullable=False)
+    resolution = Column(String, nullable=False)  # minute, hour, day
+    bucket = Column(DateTime, nullable=False)
+    bytes_used = Column(Integer, default=0)
+
+
+class UsageCounter(Base):
+    """Last cumulative node counter seen per tunnel, used to turn counters into deltas"""
+    __tablename__ = "usage_counters"
+    
+    node_id = Column(String, primary_key=True)
+    tunnel_id = Column(String, primary_key=True)
+    total_bytes = Column(Integer, default=0)
+    installed_at = Column(Float, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
 class CoreResetConfig(Base):
     __tablename__ = "core_reset_config"
+    __table_args__ = (
+        Index("ix_core_reset_config_enabled_next", "enabled", "next_reset"),
+    )
     
     id = Column(String, primary_key=True, default=generate_uuid)
     core = Column(String, nullable=False, unique=True)
@@ -84,3 +132,39 @@ class Settings(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+
+
+class Job(Base):
+    """A queued mutation run by the job workers"""
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index("ix_jobs_status_created", "status", "created_at"),
+    )
+    
+    id = Column(String, primary_key=True, default=generate_uuid)
+    kind = Column(String, nullable=False)  # e.g. tunnel.create
+    key = Column(String, nullable=True)  # jobs with the same key run one at a time, in order
+    status = Column(String, default="queued")  # queued, running, succeeded, failed
+    payload = Column(JSON, nullable=False)
+    context = Column(JSON, nullable=True)  # request headers needed to replay the call
+    result = Column(JSON, nullable=True)
+    status_code = Column(Integer, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class JobEvent(Base):
+    """Progress message logged while a job ran"""
+    __tablename__ = "job_events"
+    __table_args__ = (
+        Index("ix_job_events_job_seq", "job_id", "seq"),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String, nullable=False)
+    seq = Column(Integer, nullable=False)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    level = Column(String, nullable=False)
+    message = Column(Text, nullable=False)
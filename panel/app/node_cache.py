@@ -0,0 +1,102 @@
+"""In-process cache of the node fields the panel needs to dispatch requests"""
+import asyncio
+import logging
+from typing import Dict, Any, Optional
+
+from sqlalchemy import select
+
+from app.database import AsyncSessionLocal
+from app.models import Node, Settings
+
+logger = logging.getLogger(__name__)
+
+_UNLOADED = object()
+
+
+class NodeRecord:
+    """The subset of a Node row used to reach it"""
+    
+    def __init__(self, id: str, api_address: str, role: str, frp_remote_port: Optional[int]):
+        self.id = id
+        self.api_address = api_address
+        self.role = role
+        self.frp_remote_port = frp_remote_port
+
+
+def node_record(node: Node) -> NodeRecord:
+    metadata = node.node_metadata or {}
+    return NodeRecord(
+        id=node.id,
+        api_address=node.api_address or metadata.get("api_address", "http://localhost:8888"),
+        role=node.role or metadata.get("role", "iran"),
+        frp_remote_port=metadata.get("frp_remote_port"),
+    )
+
+
+class NodeCache:
+    """Node addresses, roles and FRP remote ports, plus the FRP setting.
+
+    Entries are loaded from the database on first use and kept until the
+    node or the settings change, so sending a request to a node does not
+    touch SQLite. Writers call invalidate()/invalidate_settings() after
+    committing.
+    """
+
+    def __init__(self):
+        self.nodes: Dict[str, NodeRecord] = {}
+        self._frp_settings: Any = _UNLOADED
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self, node_id: str) -> Optional[NodeRecord]:
+        """Return a node's dispatch record, loading it on a miss"""
+        record = self.nodes.get(node_id)
+        if record is not None:
+            return record
+        generation = self._generation
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(select(Node).where(Node.id == node_id))
+            node = result.scalar_one_or_none()
+        if not node:
+            return None
+        record = node_record(node)
+        # Do not cache a row read before an invalidation that raced with the load
+        if generation == self._generation:
+            self.nodes[node_id] = record
+        return record
+
+    async def frp_settings(self) -> Optional[Dict[str, Any]]:
+        """Return the FRP communication settings if FRP is enabled"""
+        if self._frp_settings is not _UNLOADED:
+            return self._frp_settings
+        async with self._lock:
+            if self._frp_settings is not _UNLOADED:
+                return self._frp_settings
+            generation = self._generation
+            async with AsyncSessionLocal() as session:
+                result = await session.execute(select(Settings).where(Settings.key == "frp"))
+                setting = result.scalar_one_or_none()
+            value = setting.value if setting and setting.value and setting.value.get("enabled") else None
+            if generation == self._generation:
+                self._frp_settings = value
+            return value
+
+    @property
+    def generation(self) -> int:
+        """Bumped on every invalidation; lets other node caches expire with this one"""
+        return self._generation
+
+    def invalidate(self, node_id: Optional[str] = None):
+        """Drop one node, or every node when node_id is None"""
+        self._generation += 1
+        if node_id is None:
+            self.nodes.clear()
+        else:
+            self.nodes.pop(node_id, None)
+
+    def invalidate_settings(self):
+        self._generation += 1
+        self._frp_settings = _UNLOADED
+
+
+node_cache = NodeCache()
@@ -3,15 +3,132 @@ import httpx
 import ssl
 import logging
 import asyncio
-from typing import Dict, Any, Optional, Tuple
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional, Tuple
 from pathlib import Path
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from app.database import AsyncSessionLocal
-from app.models import Node, Settings
+from app.config import settings
+from app.node_cache import NodeRecord, node_cache
+from app.node_health import NodeHealth, NodeUnavailable, node_health
+from app.node_server import node_server
 
 logger = logging.getLogger(__name__)
 
+try:
+    import h2  # noqa: F401  # type: ignore
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class PooledClient:
+    """A pooled httpx client and its health bookkeeping"""
+    
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.in_flight = 0
+        self.failures = 0
+        self.last_used = time.monotonic()
+        self.retired = False
+
+
+class NodeConnectionPool:
+    """Long-lived httpx clients keyed by node address.
+    
+    Every NodeClient shares these clients, so requests to a node reuse
+    kept-alive connections (multiplexed over HTTP/2 when enabled and h2 is
+    installed). A client is retired after a connection or protocol error, or
+    after repeated timeouts, and closed once its in-flight requests finish;
+    clients left idle are closed by a periodic sweep.
+    """
+    
+    def __init__(self):
+        self.entries: Dict[str, PooledClient] = {}
+        self.http2 = settings.node_http2 and HTTP2_AVAILABLE
+        self._last_sweep = time.monotonic()
+        if settings.node_http2 and not HTTP2_AVAILABLE:
+            logger.warning("node_http2 is enabled but the h2 package is not installed, using HTTP/1.1")
+    
+    def _new_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0),
+            verify=False,
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=settings.node_pool_max_connections,
+                max_keepalive_connections=settings.node_pool_max_connections,
+                keepalive_expiry=settings.node_keepalive_expiry,
+            ),
+        )
+    
+    async def _close(self, entry: PooledClient):
+        try:
+            await entry.client.aclose()
+        except Exception as e:
+            logger.debug(f"Error closing pooled node client: {e}")
+    
+    def _retire(self, address: str, entry: PooledClient):
+        entry.retired = True
+        if self.entries.get(address) is entry:
+            del self.entries[address]
+    
+    async def _sweep_idle(self):
+        now = time.monotonic()
+        if now - self._last_sweep < settings.node_pool_idle_timeout / 2:
+            return
+        self._last_sweep = now
+        for address, entry in list(self.entries.items()):
+            if entry.in_flight == 0 and now - entry.last_used > settings.node_pool_idle_timeout:
+                self._retire(address, entry)
+                await self._close(entry)
+    
+    @asynccontextmanager
+    async def connection(self, address: str):
+        """Borrow the shared client for a node address"""
+        await self._sweep_idle()
+        entry = self.entries.get(address)
+        if entry is None:
+            entry = PooledClient(self._new_client())
+            self.entries[address] = entry
+        entry.in_flight += 1
+        try:
+            yield entry.client
+        except httpx.TimeoutException:
+            entry.failures += 1
+            if entry.failures >= settings.node_pool_max_failures:
+                logger.info(f"Evicting pooled client for {address} after {entry.failures} timeouts")
+                self._retire(address, entry)
+            raise
+        except httpx.TransportError as e:
+            logger.info(f"Evicting pooled client for {address}: {type(e).__name__}")
+            self._retire(address, entry)
+            raise
+        else:
+            entry.failures = 0
+        finally:
+            entry.in_flight -= 1
+            entry.last_used = time.monotonic()
+            if entry.retired and entry.in_flight == 0:
+                await self._close(entry)
+    
+    async def evict(self, address: str):
+        """Drop the client for an address, e.g. after the node moved"""
+        entry = self.entries.get(address)
+        if entry:
+            self._retire(address, entry)
+            if entry.in_flight == 0:
+                await self._close(entry)
+    
+    async def aclose(self):
+        """Close every pooled client"""
+        for address, entry in list(self.entries.items()):
+            self._retire(address, entry)
+            await self._close(entry)
+
+
+node_pool = NodeConnectionPool()
+
 
 class NodeClient:
     """Client to send requests to nodes via HTTP/HTTPS or FRP"""
@@ -19,24 +136,38 @@ class NodeClient:
     def __init__(self):
         self.timeout = httpx.Timeout(30.0)
     
-    async def _get_frp_settings(self) -> Optional[Dict[str, Any]]:
-        """Get FRP communication settings"""
-        async with AsyncSessionLocal() as session:
-            result = await session.execute(select(Settings).where(Settings.key == "frp"))
-            setting = result.scalar_one_or_none()
-            if setting and setting.value and setting.value.get("enabled"):
-                return setting.value
-        return None
+    async def _channel_request(
+        self,
+        node_id: str,
+        method: str,
+        path: str,
+        body: Optional[Dict[str, Any]] = None,
+        timeout: float = 30.0,
+    ) -> Optional[httpx.Response]:
+        """Call the node over its control channel; None means it is not connected and HTTP should be used"""
+        if not node_server.is_connected(node_id):
+            return None
+        try:
+            reply = await node_server.request(node_id, method, path, body, timeout=timeout)
+        except ConnectionError:
+            return None
+        except asyncio.TimeoutError:
+            raise httpx.ReadTimeout(f"node {node_id} did not answer {path} within {timeout}s over the control channel")
+        return httpx.Response(
+            reply.get("status_code", 500),
+            json=reply.get("body"),
+            request=httpx.Request(method, f"channel://{node_id}{path}"),
+        )
     
-    async def _get_node_address(self, node: Node) -> Tuple[str, bool]:
+    async def _get_node_address(self, node: NodeRecord) -> Tuple[str, bool]:
         """
         Get node address (direct or via FRP)
         Returns: (address, using_frp)
         """
-        frp_settings = await self._get_frp_settings()
+        frp_settings = await node_cache.frp_settings()
         
         if frp_settings and frp_settings.get("enabled"):
-            frp_remote_port = node.node_metadata.get("frp_remote_port") if node.node_metadata else None
+            frp_remote_port = node.frp_remote_port
             if frp_remote_port:
                 # Verify FRP server is running before using FRP
                 from app.frp_comm_manager import frp_comm_manager
@@ -54,104 +185,144 @@ class NodeClient:
                 logger.warning(f"[HTTP] This should only happen during node registration. After FRP setup, all communication will use FRP.")
         
         # FRP is not enabled or not available - use HTTP
-        node_address = node.node_metadata.get("api_address", f"http://localhost:8888") if node.node_metadata else f"http://localhost:8888"
+        node_address = node.api_address
         if not node_address.startswith("http"):
             node_address = f"http://{node_address}"
         logger.info(f"[HTTP] Using direct HTTP to communicate with node {node.id} at {node_address}")
         return (node_address, False)
     
-    async def send_to_node(self, node_id: str, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
-        """
-        Send request to node via HTTPS or FRP
+    async def _request(
+        self,
+        node_id: str,
+        method: str,
+        path: str,
+        body: Optional[Dict[str, Any]] = None,
+        timeout: float = 30.0,
+        connect_timeout: Optional[float] = None,
+        frp_retries: int = 1,
+    ) -> Dict[str, Any]:
+        """Call a node agent endpoint behind its circuit breaker and bulkhead.
+        
+        Transport failures are recorded against the node's breaker, and
+        timeouts are derived from its observed latency, so a dead node costs
+        one slow call before further calls fail fast.
         """
-        async with AsyncSessionLocal() as session:
-            result = await session.execute(select(Node).where(Node.id == node_id))
-            node = result.scalar_one_or_none()
-            
-            if not node:
-                return {"status": "error", "message": f"Node {node_id} not found"}
-            
-            node_address, using_frp = await self._get_node_address(node)
-            url = f"{node_address.rstrip('/')}{endpoint}"
-            
-            comm_type = "FRP" if using_frp else "HTTP"
-            logger.debug(f"[{comm_type}] Sending request to node {node_id}: {endpoint}")
-            
-            try:
-                # Retry logic for FRP connections which may need a moment to stabilize
-                max_retries = 5 if using_frp else 1
-                last_error = None
+        node = await node_cache.get(node_id)
+        if not node:
+            return {"status": "error", "message": f"Node {node_id} not found"}
+        
+        health = node_health.get(node_id)
+        try:
+            async with health.slot(timeout):
+                health.check()
+                try:
+                    return await self._guarded_request(node, health, method, path, body, timeout, connect_timeout, frp_retries)
+                except asyncio.CancelledError:
+                    # Let the next call probe instead of leaving the breaker stuck half-open
+                    health.probing = False
+                    raise
+        except NodeUnavailable as e:
+            return {"status": "error", "message": str(e)}
+    
+    async def _guarded_request(
+        self,
+        node: NodeRecord,
+        health: NodeHealth,
+        method: str,
+        path: str,
+        body: Optional[Dict[str, Any]],
+        timeout: float,
+        connect_timeout: Optional[float],
+        frp_retries: int,
+    ) -> Dict[str, Any]:
+        node_id = node.id
+        connect, read = health.timeouts(path, timeout, idempotent=(method == "GET"))
+        if connect_timeout is not None:
+            connect = min(connect, connect_timeout)
+        started = time.monotonic()
+        
+        try:
+            response = await self._channel_request(node_id, method, path, body, timeout=read)
+            using_frp = False
+            if response is None:
+                node_address, using_frp = await self._get_node_address(node)
+                url = f"{node_address.rstrip('/')}{path}"
+                comm_type = "FRP" if using_frp else "HTTP"
+                logger.debug(f"[{comm_type}] Sending {method} {path} to node {node_id}")
                 
+                # Retry logic for FRP connections which may need a moment to stabilize
+                max_retries = frp_retries if using_frp else 1
                 for attempt in range(max_retries):
                     try:
-                        # For FRP, use a new connection each time to avoid connection reuse issues
+                        # A failed FRP connection evicts the pooled client, so retries get fresh connections
                         if using_frp and attempt > 0:
                             await asyncio.sleep(2.0)  # Longer delay for FRP retries
                             logger.info(f"[FRP] Retry {attempt + 1}/{max_retries} for node {node_id} via FRP tunnel")
                         
-                        async with httpx.AsyncClient(
-                            timeout=self.timeout, 
-                            verify=False,
-                            limits=httpx.Limits(max_keepalive_connections=0 if using_frp else 5)  # Disable keep-alive for FRP
-                        ) as client:
-                            response = await client.post(url, json=data)
-                            response.raise_for_status()
-                            return response.json()
+                        async with node_pool.connection(node_address) as client:
+                            response = await client.request(
+                                method,
+                                url,
+                                json=body if method != "GET" else None,
+                                timeout=httpx.Timeout(read, connect=connect),
+                            )
+                        break
                     except httpx.RequestError as e:
-                        last_error = e
                         if attempt < max_retries - 1:
-                            if not using_frp:
-                                await asyncio.sleep(0.5)
                             continue
-                        else:
-                            error_msg = f"Network error: {str(e)}"
-                            if using_frp:
-                                remote_port = url.split(":")[-1].split("/")[0] if ":" in url else "unknown"
-                                error_msg += f" (FRP tunnel connection failed after {max_retries} attempts. The panel may not be able to reach FRP server on 127.0.0.1:{remote_port}. Check if panel and FRP server are in the same network namespace, or check FRP server logs.)"
-                            return {"status": "error", "message": error_msg}
-                
-                # Should not reach here, but just in case
-                return {"status": "error", "message": f"Network error: {str(last_error)}"}
-            except httpx.HTTPStatusError as e:
-                try:
-                    error_detail = e.response.json().get("detail", str(e))
-                except:
-                    error_detail = str(e)
-                return {"status": "error", "message": f"Node error (HTTP {e.response.status_code}): {error_detail}"}
-            except Exception as e:
-                return {"status": "error", "message": f"Error: {str(e)}"}
+                        # One failure per call: FRP retries are part of the same request
+                        health.record_failure(f"{type(e).__name__}: {e}")
+                        error_msg = f"Network error: {str(e)}"
+                        if using_frp:
+                            remote_port = url.split(":")[-1].split("/")[0] if ":" in url else "unknown"
+                            error_msg += f" (FRP tunnel connection failed after {attempt + 1} attempts. The panel may not be able to reach FRP server on 127.0.0.1:{remote_port}. Check if panel and FRP server are in the same network namespace, or check FRP server logs.)"
+                        return {"status": "error", "message": error_msg}
+            
+            health.record_success(path, time.monotonic() - started)
+            response.raise_for_status()
+            return response.json()
+        except httpx.RequestError as e:
+            health.record_failure(f"{type(e).__name__}: {e}")
+            return {"status": "error", "message": f"Network error: {str(e)}"}
+        except httpx.HTTPStatusError as e:
+            try:
+                error_detail = e.response.json().get("detail", str(e))
+            except:
+                error_detail = str(e)
+            return {"status": "error", "message": f"Node error (HTTP {e.response.status_code}): {error_detail}"}
+        except Exception as e:
+            if health.probing:
+                health.record_failure(str(e))
+            return {"status": "error", "message": f"Error: {str(e)}"}
+    
+    async def send_to_node(self, node_id: str, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Send request to node via HTTPS or FRP
+        """
+        return await self._request(node_id, "POST", endpoint, data, timeout=30.0, frp_retries=5)
+    
+    async def send_batch(self, node_id: str, operations: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Run many tunnel apply/remove operations on a node in one request"""
+        return await self._request(
+            node_id,
+            "POST",
+            "/api/agent/tunnels/batch",
+            {"operations": operations},
+            timeout=30.0 + 2.0 * len(operations),
+            frp_retries=5,
+        )
     
     async def get_tunnel_status(self, node_id: str, tunnel_id: str = "") -> Dict[str, Any]:
         """Get tunnel status from node"""
-        async with AsyncSessionLocal() as session:
-            result = await session.execute(select(Node).where(Node.id == node_id))
-            node = result.scalar_one_or_none()
-            
-            if not node:
-                return {"status": "error", "message": f"Node {node_id} not found"}
-            
-            node_address, using_frp = await self._get_node_address(node)
-            url = f"{node_address.rstrip('/')}/api/agent/status"
-            
-            comm_type = "FRP" if using_frp else "HTTP"
-            logger.debug(f"[{comm_type}] Getting tunnel status from node {node_id}")
-            
-            try:
-                timeout = httpx.Timeout(3.0, connect=2.0)
-                async with httpx.AsyncClient(timeout=timeout, verify=False) as client:
-                    response = await client.get(url)
-                    response.raise_for_status()
-                    return response.json()
-            except httpx.RequestError as e:
-                return {"status": "error", "message": f"Network error: {str(e)}"}
-            except httpx.HTTPStatusError as e:
-                try:
-                    error_detail = e.response.json().get("detail", str(e))
-                except:
-                    error_detail = str(e)
-                return {"status": "error", "message": f"Node error (HTTP {e.response.status_code}): {error_detail}"}
-            except Exception as e:
-                return {"status": "error", "message": f"Error: {str(e)}"}
+        return await self._request(node_id, "GET", "/api/agent/status", timeout=3.0, connect_timeout=2.0)
+    
+    async def get_tunnel_states(self, node_id: str) -> Dict[str, Any]:
+        """Get spec hash and process state of every tunnel on a node"""
+        return await self._request(node_id, "GET", "/api/agent/tunnels/state", timeout=10.0, connect_timeout=2.0)
+    
+    async def get_traffic(self, node_id: str) -> Dict[str, Any]:
+        """Get cumulative per-tunnel traffic counters from node"""
+        return await self._request(node_id, "GET", "/api/agent/traffic", timeout=5.0, connect_timeout=2.0)
     
     async def apply_tunnel(self, node_id: str, tunnel_data: Dict[str, Any]) -> Dict[str, Any]:
         """Apply tunnel to node"""
@@ -0,0 +1,176 @@
+"""Per-node circuit breaker, RTT-based timeouts and concurrency limits"""
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, Tuple
+
+from app.config import settings
+from app.change_sequence import change_sequence
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class NodeUnavailable(Exception):
+    """Raised instead of calling a node whose circuit is open or whose bulkhead is full"""
+
+
+class RttEstimator:
+    """Smoothed RTT and variance as in RFC 6298"""
+
+    def __init__(self):
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+        self.samples = 0
+
+    def add(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples += 1
+
+    def timeout(self) -> Optional[float]:
+        if self.srtt is None or self.samples < settings.node_rtt_min_samples:
+            return None
+        return self.srtt + 4 * self.rttvar
+
+
+class NodeHealth:
+    """Breaker state, latency estimates and a bulkhead for one node.
+
+    Transport failures (connect errors, resets, timeouts) count against the
+    breaker; HTTP error replies mean the node is alive and do not. After
+    node_breaker_threshold consecutive failures the circuit opens and calls
+    fail immediately; once node_breaker_reset_timeout has passed a single
+    probe is let through (half-open) and its outcome closes or re-opens it.
+    """
+
+    def __init__(self, node_id: str):
+        self.node_id = node_id
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.last_error: Optional[str] = None
+        self.rtt: Dict[str, RttEstimator] = {}
+        self.bulkhead = asyncio.Semaphore(settings.node_max_concurrency)
+        self.in_flight = 0
+
+    def check(self):
+        """Raise NodeUnavailable if the node must not be called right now"""
+        if self.state == CLOSED:
+            return
+        if self.state == OPEN:
+            remaining = self.opened_at + settings.node_breaker_reset_timeout - time.monotonic()
+            if remaining > 0:
+                raise NodeUnavailable(
+                    f"Node {self.node_id} is unavailable (circuit open after {self.failures} failures, "
+                    f"retrying in {remaining:.0f}s): {self.last_error}"
+                )
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.probing:
+            raise NodeUnavailable(f"Node {self.node_id} is being probed after failures: {self.last_error}")
+        self.probing = True
+
+    def record_success(self, key: str, elapsed: float):
+        self.rtt.setdefault(key, RttEstimator()).add(elapsed)
+        if self.state != CLOSED:
+            logger.info(f"Node {self.node_id} recovered, closing circuit")
+            change_sequence.bump()
+        self.state = CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self, error: str):
+        self.failures += 1
+        self.last_error = error
+        self.probing = False
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= settings.node_breaker_threshold):
+            if self.state == CLOSED:
+                logger.warning(f"Opening circuit for node {self.node_id} after {self.failures} failures: {error}")
+                change_sequence.bump()
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def timeouts(self, key: str, default: float, idempotent: bool) -> Tuple[float, float]:
+        """Return (connect, read) timeouts learned from this node's latency.
+
+        The connect timeout always adapts. The whole-request timeout adapts
+        only for idempotent reads, since mutating calls may legitimately
+        wait on core startup on the node.
+        """
+        floor = settings.node_timeout_min
+        estimate = self.rtt.get(key).timeout() if key in self.rtt else None
+        connect_estimate = min(
+            (rtt.timeout() for rtt in self.rtt.values() if rtt.timeout() is not None),
+            default=None,
+        )
+        connect = min(default, max(floor, connect_estimate)) if connect_estimate is not None else min(default, 10.0)
+        read = min(default, max(floor, estimate)) if estimate is not None and idempotent else default
+        return connect, read
+
+    @asynccontextmanager
+    async def slot(self, wait: float):
+        """Hold one of the node's concurrency slots"""
+        try:
+            if self.bulkhead.locked():
+                await asyncio.wait_for(self.bulkhead.acquire(), timeout=wait)
+            else:
+                await self.bulkhead.acquire()
+        except asyncio.TimeoutError:
+            raise NodeUnavailable(f"Node {self.node_id} is busy ({settings.node_max_concurrency} requests in flight)")
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.bulkhead.release()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "in_flight": self.in_flight,
+            "rtt": {
+                key: {"srtt": rtt.srtt, "rttvar": rtt.rttvar, "samples": rtt.samples}
+                for key, rtt in self.rtt.items()
+            },
+        }
+
+
+class NodeHealthRegistry:
+    """NodeHealth per node id, created on first use"""
+
+    def __init__(self):
+        self.nodes: Dict[str, NodeHealth] = {}
+
+    def get(self, node_id: str) -> NodeHealth:
+        health = self.nodes.get(node_id)
+        if health is None:
+            health = self.nodes[node_id] = NodeHealth(node_id)
+        return health
+
+    def mark_alive(self, node_id: str):
+        """Close a node's circuit when it proves it is up, e.g. by re-registering"""
+        health = self.nodes.get(node_id)
+        if health and health.state != CLOSED:
+            logger.info(f"Node {node_id} checked in, closing circuit")
+            change_sequence.bump()
+            health.state = CLOSED
+            health.failures = 0
+            health.probing = False
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {node_id: health.to_dict() for node_id, health in self.nodes.items()}
+
+
+node_health = NodeHealthRegistry()
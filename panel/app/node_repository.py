@@ -0,0 +1,84 @@
+"""Node lookups by role and address on the indexed node columns"""
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Node
+from app.node_cache import node_cache
+
+logger = logging.getLogger(__name__)
+
+IRAN = "iran"
+FOREIGN = "foreign"
+
+
+class NodeRepository:
+    """Queries for picking the nodes a tunnel runs on.
+
+    The ids of the nodes holding each role are cached and expire together
+    with node_cache, which node writers already invalidate, so choosing the
+    iran or foreign side of a tunnel is a primary key lookup in the calling
+    session instead of a load of the whole nodes table.
+    """
+
+    def __init__(self):
+        self._role_ids: Dict[str, Tuple[int, List[str]]] = {}
+
+    async def get(self, db: AsyncSession, node_id: Optional[str]) -> Optional[Node]:
+        if not node_id:
+            return None
+        return await db.get(Node, node_id)
+
+    async def role_ids(self, db: AsyncSession, role: str) -> List[str]:
+        """Ids of the nodes with a role, oldest registration first"""
+        generation = node_cache.generation
+        cached = self._role_ids.get(role)
+        if cached and cached[0] == generation:
+            return cached[1]
+        result = await db.execute(
+            select(Node.id).where(Node.role == role).order_by(Node.registered_at, Node.id)
+        )
+        ids = list(result.scalars().all())
+        if generation == node_cache.generation:
+            self._role_ids[role] = (generation, ids)
+        return ids
+
+    async def first_with_role(self, db: AsyncSession, role: str) -> Optional[Node]:
+        """The node used by default for a role when a tunnel does not name one"""
+        for node_id in await self.role_ids(db, role):
+            node = await db.get(Node, node_id)
+            if node is not None and node.role == role:
+                return node
+        return None
+
+    async def with_role(self, db: AsyncSession, role: str) -> List[Node]:
+        result = await db.execute(
+            select(Node).where(Node.role == role).order_by(Node.registered_at, Node.id)
+        )
+        return list(result.scalars().all())
+
+    async def by_ip(self, db: AsyncSession, ip_address: str) -> List[Node]:
+        result = await db.execute(select(Node).where(Node.ip_address == ip_address))
+        return list(result.scalars().all())
+
+    async def tunnel_sides(self, db: AsyncSession, node_id: Optional[str]) -> Tuple[Optional[Node], Optional[Node]]:
+        """Return (iran node, foreign node) for a reverse tunnel whose node_id may be either side"""
+        node = await self.get(db, node_id)
+        if node is not None and node.role != IRAN:
+            return await self.first_with_role(db, IRAN), node
+        if node is None:
+            node = await self.first_with_role(db, IRAN)
+        return node, await self.first_with_role(db, FOREIGN)
+
+    async def reverse_nodes(self, db: AsyncSession, tunnel) -> Tuple[Optional[Node], Optional[Node]]:
+        """Return (iran node, foreign node) of a reverse tunnel, preferring the sides stored at creation"""
+        iran, foreign = await self.get(db, tunnel.iran_node_id), await self.get(db, tunnel.foreign_node_id)
+        if iran is not None and foreign is not None:
+            return iran, foreign
+        fallback_iran, fallback_foreign = await self.tunnel_sides(db, tunnel.node_id)
+        return iran or fallback_iran, foreign or fallback_foreign
+
+
+node_repository = NodeRepository()
@@ -1,23 +1,78 @@
 """Node server for panel-node communication"""
 import asyncio
+import hashlib
+import hmac
+import itertools
+import secrets
 import ssl
 import logging
+import time
+from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Any, Optional
 from app.config import settings
 
 logger = logging.getLogger(__name__)
 
 
+def channel_secret(node_id: str) -> str:
+    """Secret a node proves its control channel with; issued to it at registration"""
+    return hmac.new(settings.secret_key.encode(), f"node-channel:{node_id}".encode(), hashlib.sha256).hexdigest()
+
+
+def channel_signature(secret: str, node_id: str, nonce: str) -> str:
+    return hmac.new(secret.encode(), f"{node_id}:{nonce}".encode(), hashlib.sha256).hexdigest()
+
+
+class NodeChannel:
+    """A node's open control channel and the RPCs waiting on it"""
+    
+    def __init__(self, node_id: str, websocket):
+        self.node_id = node_id
+        self.websocket = websocket
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.connected_at = time.time()
+        self.last_heartbeat = time.time()
+        self.info: Dict[str, Any] = {}
+        self._send_lock = asyncio.Lock()
+    
+    async def send(self, message: Dict[str, Any]):
+        async with self._send_lock:
+            await self.websocket.send_json(message)
+    
+    async def close(self, code: int = 1000):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+    
+    def fail_pending(self, error: Exception):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+
+
 class NodeServer:
-    """Node server for secure panel-node communication"""
+    """Node server for secure panel-node communication.
+    
+    Nodes open one long-lived WebSocket to node_port and keep it up. The
+    channel carries their heartbeats (which drive Node.last_seen) and
+    panel->node RPCs: each request is a frame with an id, and replies can
+    arrive in any order, so many calls share the one connection. Nodes
+    behind NAT are reachable this way without FRP.
+    """
     
     def __init__(self):
         self.port = settings.node_port
         self.cert_path = settings.node_cert_path
         self.key_path = settings.node_key_path
-        self.server: Optional[asyncio.Server] = None
-        self.clients = {}
+        self.server = None
+        self.clients: Dict[str, NodeChannel] = {}
+        self._serve_task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._request_ids = itertools.count(1)
+        self._seen: Dict[str, datetime] = {}
     
     async def start(self):
         """Start Node server"""
@@ -27,13 +82,193 @@ class NodeServer:
         if not cert_path.exists() or not key_path.exists():
             await self._generate_certs()
         
+        if not settings.node_channel_enabled:
+            logger.info("Node control channel disabled")
+            return
+        
+        import uvicorn
+        from fastapi import FastAPI
+        
+        class EmbeddedServer(uvicorn.Server):
+            def install_signal_handlers(self):
+                # The main panel server owns the process signal handlers
+                pass
+        
+        channel_app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+        channel_app.add_api_websocket_route("/channel", self.handle_channel)
+        config = uvicorn.Config(
+            channel_app,
+            host=settings.panel_host,
+            port=self.port,
+            ssl_certfile=self.cert_path,
+            ssl_keyfile=self.key_path,
+            lifespan="off",
+            log_level="warning",
+        )
+        self.server = EmbeddedServer(config)
+        self._serve_task = asyncio.create_task(self._serve())
+        self._flush_task = asyncio.create_task(self._flush_loop())
         logger.info(f"Node server starting on port {self.port}")
     
     async def stop(self):
         """Stop Node server"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        for channel in list(self.clients.values()):
+            channel.fail_pending(ConnectionError("Node server stopping"))
+            await channel.close(code=1001)
+        self.clients.clear()
         if self.server:
-            self.server.close()
-            await self.server.wait_closed()
+            self.server.should_exit = True
+            if self._serve_task:
+                try:
+                    await asyncio.wait_for(self._serve_task, timeout=5.0)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    self._serve_task.cancel()
+            self.server = None
+            self._serve_task = None
+    
+    async def _serve(self):
+        try:
+            await self.server.serve()
+        except SystemExit:
+            # uvicorn exits when it cannot bind; keep the panel itself running
+            logger.error(f"Node server could not listen on port {self.port}, nodes will be reached over HTTP/FRP only")
+    
+    def is_connected(self, node_id: str) -> bool:
+        return node_id in self.clients
+    
+    async def handle_channel(self, websocket):
+        """Serve one node's control channel until it disconnects"""
+        from fastapi import WebSocketDisconnect
+        from app.node_cache import node_cache
+        from app.node_health import node_health
+        from app.change_sequence import change_sequence
+        
+        await websocket.accept()
+        # The node signs a fresh nonce with its channel secret, so knowing a node id is not enough
+        nonce = secrets.token_hex(16)
+        try:
+            await websocket.send_json({"type": "challenge", "nonce": nonce})
+            hello = await asyncio.wait_for(websocket.receive_json(), timeout=10.0)
+        except Exception:
+            await websocket.close(code=1002)
+            return
+        node_id = hello.get("node_id") if isinstance(hello, dict) and hello.get("type") == "hello" else None
+        if not node_id or not await node_cache.get(node_id):
+            logger.warning(f"Rejected control channel from {websocket.client}: unknown node {node_id}")
+            await websocket.close(code=4403)
+            return
+        signature = hello.get("signature")
+        expected = channel_signature(channel_secret(node_id), node_id, nonce)
+        if not isinstance(signature, str) or not hmac.compare_digest(signature, expected):
+            logger.warning(f"Rejected control channel from {websocket.client}: bad signature for node {node_id}")
+            await websocket.close(code=4401)
+            return
+        
+        channel = NodeChannel(node_id, websocket)
+        previous = self.clients.get(node_id)
+        self.clients[node_id] = channel
+        if previous:
+            previous.fail_pending(ConnectionError("Control channel replaced"))
+            await previous.close()
+        self._seen[node_id] = datetime.utcnow()
+        node_health.mark_alive(node_id)
+        await channel.send({"type": "welcome", "heartbeat_interval": settings.node_heartbeat_interval})
+        change_sequence.bump()
+        logger.info(f"Node {node_id} connected control channel from {websocket.client}")
+        
+        try:
+            while True:
+                message = await websocket.receive_json()
+                kind = message.get("type")
+                if kind == "response":
+                    future = channel.pending.pop(message.get("id"), None)
+                    if future and not future.done():
+                        future.set_result(message)
+                elif kind == "heartbeat":
+                    channel.last_heartbeat = time.time()
+                    channel.info = message.get("data") or {}
+                    self._seen[node_id] = datetime.utcnow()
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.warning(f"Control channel for node {node_id} failed: {e}")
+        finally:
+            if self.clients.get(node_id) is channel:
+                del self.clients[node_id]
+                change_sequence.bump()
+            channel.fail_pending(ConnectionError("Control channel closed"))
+            logger.info(f"Node {node_id} control channel closed")
+    
+    async def request(
+        self,
+        node_id: str,
+        method: str,
+        path: str,
+        body: Optional[Dict[str, Any]] = None,
+        timeout: float = 30.0,
+    ) -> Dict[str, Any]:
+        """Call a node agent endpoint over its control channel.
+        
+        Returns the reply frame ({"status_code", "body"}). Raises
+        ConnectionError if the node has no open channel and
+        asyncio.TimeoutError if it does not answer in time.
+        """
+        channel = self.clients.get(node_id)
+        if not channel:
+            raise ConnectionError(f"Node {node_id} has no control channel")
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        channel.pending[request_id] = future
+        try:
+            await channel.send({"type": "request", "id": request_id, "method": method, "path": path, "body": body})
+            return await asyncio.wait_for(future, timeout=timeout)
+        except (RuntimeError, OSError) as e:
+            raise ConnectionError(f"Control channel to node {node_id} is not writable: {e}")
+        finally:
+            channel.pending.pop(request_id, None)
+    
+    async def _flush_loop(self):
+        """Persist heartbeat liveness in batches and drop silent channels"""
+        from sqlalchemy import update, bindparam
+        from app.database import AsyncSessionLocal
+        from app.models import Node
+        from app.change_sequence import change_sequence
+        
+        nodes_table = Node.__table__
+        while True:
+            await asyncio.sleep(settings.node_heartbeat_interval)
+            try:
+                deadline = time.time() - settings.node_heartbeat_interval * 3
+                for node_id, channel in list(self.clients.items()):
+                    if channel.last_heartbeat < deadline:
+                        logger.warning(f"Node {node_id} missed heartbeats, closing its control channel")
+                        await channel.close(code=4408)
+                
+                seen, self._seen = self._seen, {}
+                if not seen:
+                    continue
+                async with AsyncSessionLocal() as session:
+                    conn = await session.connection()
+                    await conn.execute(
+                        update(nodes_table)
+                        .where(nodes_table.c.id == bindparam("nid"))
+                        .values(last_seen=bindparam("seen"), status="active"),
+                        [{"nid": node_id, "seen": when} for node_id, when in seen.items()],
+                    )
+                    await session.commit()
+                # Core update, so the session hooks do not see it; last_seen is shown in the node listing
+                change_sequence.bump()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to record node heartbeats: {e}", exc_info=True)
     
     async def _generate_certs(self, common_name: str = "CIMEX CA"):
         """Generate CA certificate and key"""
@@ -122,3 +357,5 @@ class NodeServer:
         
         logger.info(f"Generated CA certificate at {cert_path}")
 
+
+node_server = NodeServer()
@@ -0,0 +1,301 @@
+"""Crash detection and restart with backoff for panel core processes"""
+import logging
+import os
+import random
+import select
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable, Deque, Dict, List, Optional, Any
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Exit polling interval when the kernel has no pidfd support
+FALLBACK_POLL_INTERVAL = 1.0
+
+
+def _pidfd_supported() -> bool:
+    if not hasattr(os, "pidfd_open"):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+        return True
+    except OSError:
+        return False
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with jitter for the given restart attempt"""
+    delay = min(settings.restart_backoff_max, settings.restart_backoff_base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RestartStats:
+    """Crash and restart history of one watched process key"""
+
+    def __init__(self):
+        self.restarts = 0
+        self.consecutive = 0
+        self.crashes: Deque[float] = deque()
+        self.last_exit_code: Optional[int] = None
+        self.last_crash_at: Optional[float] = None
+        self.flapping = False
+
+    def record_crash(self, exit_code: Optional[int], uptime: float):
+        now = time.monotonic()
+        if uptime >= settings.restart_stable_after:
+            self.consecutive = 0
+        self.crashes.append(now)
+        while self.crashes and now - self.crashes[0] > settings.restart_flap_window:
+            self.crashes.popleft()
+        self.last_exit_code = exit_code
+        self.last_crash_at = time.time()
+        self.flapping = len(self.crashes) >= settings.restart_flap_threshold
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "restarts": self.restarts,
+            "recent_crashes": len(self.crashes),
+            "last_exit_code": self.last_exit_code,
+            "last_crash_at": self.last_crash_at,
+            "flapping": self.flapping,
+        }
+
+
+class _Watch:
+    def __init__(self, key: str, proc: subprocess.Popen, restart: Callable[[], Any], lock=None):
+        self.key = key
+        self.proc: Optional[subprocess.Popen] = proc
+        self.restart = restart
+        self.lock = lock
+        self.started_at = time.monotonic()
+        self.pidfd: Optional[int] = None
+        self.due: Optional[float] = None
+
+
+class ProcessMonitor:
+    """Reaps panel core processes as soon as they exit and restarts crashed ones.
+
+    One background thread waits on a pidfd per process, so exits are noticed
+    (and the child reaped) immediately instead of on the next status check.
+    Restarts run on a small worker pool, spaced by exponential backoff.
+    """
+
+    def __init__(self):
+        self._watches: Dict[str, _Watch] = {}
+        self._stats: Dict[str, RestartStats] = {}
+        self._restarting: set = set()
+        self._retired: List[_Watch] = []
+        self._lock = threading.Lock()
+        self._use_pidfd = _pidfd_supported()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_w, False)
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="core-restart")
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def watch(self, key: str, proc: subprocess.Popen, restart: Callable[[], Any], lock=None):
+        """Watch a ready process; `restart` is called to bring it back after a crash.
+
+        `lock` is the owning manager's lock. Restarts hold it, so a stop
+        that unwatches under the same lock cannot be undone by a restart
+        already queued on the worker pool.
+        """
+        entry = _Watch(key, proc, restart, lock)
+        if self._use_pidfd:
+            try:
+                entry.pidfd = os.pidfd_open(proc.pid)
+            except OSError:
+                entry.pidfd = None
+        with self._lock:
+            previous = self._watches.get(key)
+            if previous:
+                self._retired.append(previous)
+            self._watches[key] = entry
+            if key not in self._restarting:
+                self._stats.pop(key, None)
+            self._ensure_thread()
+        self._wake()
+
+    def unwatch(self, key: str):
+        """Stop watching a process before it is intentionally stopped"""
+        with self._lock:
+            entry = self._watches.pop(key, None)
+            if entry:
+                self._retired.append(entry)
+            if key not in self._restarting:
+                self._stats.pop(key, None)
+        if entry:
+            self._wake()
+
+    def restart_info(self, key: str) -> Dict[str, Any]:
+        """Return the restart history of a process key"""
+        with self._lock:
+            stats = self._stats.get(key)
+            return stats.to_dict() if stats else RestartStats().to_dict()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Return liveness and restart history of every watched process"""
+        with self._lock:
+            watches = list(self._watches.values())
+            stats = dict(self._stats)
+        return {
+            entry.key: {
+                "pid": entry.proc.pid if entry.proc else None,
+                "running": entry.proc is not None and entry.proc.returncode is None,
+                "restart_pending": entry.due is not None,
+                **(stats[entry.key].to_dict() if entry.key in stats else RestartStats().to_dict()),
+            }
+            for entry in watches
+        }
+
+    def shutdown(self):
+        """Stop the monitor thread; watched processes are left to their managers"""
+        with self._lock:
+            self._stopping = True
+            self._retired.extend(self._watches.values())
+            self._watches.clear()
+        self._wake()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self._executor.shutdown(wait=False)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="process-monitor", daemon=True)
+            self._thread.start()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._wake_r, select.POLLIN)
+        registered: Dict[int, _Watch] = {}
+
+        while True:
+            with self._lock:
+                if self._stopping:
+                    break
+                retired, self._retired = self._retired, []
+                watches = list(self._watches.values())
+
+            for entry in retired:
+                self._close_pidfd(poller, registered, entry)
+            for entry in watches:
+                if entry.pidfd is not None and entry.pidfd not in registered:
+                    poller.register(entry.pidfd, select.POLLIN)
+                    registered[entry.pidfd] = entry
+
+            now = time.monotonic()
+            timeout = None
+            due = [entry.due for entry in watches if entry.due is not None]
+            if due:
+                timeout = max(0.0, min(due) - now)
+            if not self._use_pidfd and any(entry.proc for entry in watches):
+                timeout = FALLBACK_POLL_INTERVAL if timeout is None else min(timeout, FALLBACK_POLL_INTERVAL)
+
+            events = poller.poll(None if timeout is None else int(timeout * 1000) + 1)
+            for fd, _ in events:
+                if fd == self._wake_r:
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except OSError:
+                        pass
+                    continue
+                entry = registered.get(fd)
+                if entry:
+                    self._close_pidfd(poller, registered, entry)
+                    self._check_exit(entry)
+
+            if not self._use_pidfd:
+                for entry in watches:
+                    self._check_exit(entry)
+
+            now = time.monotonic()
+            for entry in watches:
+                if entry.due is not None and entry.due <= now:
+                    entry.due = None
+                    self._executor.submit(self._restart, entry)
+
+        for entry in list(registered.values()):
+            self._close_pidfd(poller, registered, entry)
+
+    def _close_pidfd(self, poller, registered: Dict[int, _Watch], entry: _Watch):
+        if entry.pidfd is None:
+            return
+        if registered.pop(entry.pidfd, None) is not None:
+            poller.unregister(entry.pidfd)
+        try:
+            os.close(entry.pidfd)
+        except OSError:
+            pass
+        entry.pidfd = None
+
+    def _check_exit(self, entry: _Watch):
+        """Reap an exited process and schedule its restart"""
+        proc = entry.proc
+        if proc is None or proc.poll() is None:
+            return
+        with self._lock:
+            if self._watches.get(entry.key) is not entry:
+                return
+            stats = self._stats.setdefault(entry.key, RestartStats())
+            stats.record_crash(proc.returncode, time.monotonic() - entry.started_at)
+            entry.proc = None
+            self._schedule(entry, stats, proc.returncode)
+        if stats.flapping:
+            logger.error(
+                f"Process {entry.key} is flapping: {len(stats.crashes)} crashes in the last "
+                f"{settings.restart_flap_window:g}s (exit code {proc.returncode})"
+            )
+
+    def _schedule(self, entry: _Watch, stats: RestartStats, exit_code: Optional[int]):
+        delay = backoff_delay(stats.consecutive)
+        stats.consecutive += 1
+        entry.due = time.monotonic() + delay
+        logger.warning(
+            f"Process {entry.key} exited with code {exit_code}, "
+            f"restarting in {delay:.1f}s (attempt {stats.consecutive})"
+        )
+
+    def _restart(self, entry: _Watch):
+        with entry.lock or nullcontext():
+            self._restart_locked(entry)
+
+    def _restart_locked(self, entry: _Watch):
+        with self._lock:
+            if self._watches.get(entry.key) is not entry:
+                return
+            self._restarting.add(entry.key)
+            stats = self._stats.setdefault(entry.key, RestartStats())
+        try:
+            entry.restart()
+            with self._lock:
+                stats.restarts += 1
+            logger.info(f"Restarted process {entry.key} (restart #{stats.restarts})")
+        except Exception as e:
+            logger.error(f"Failed to restart process {entry.key}: {e}")
+            with self._lock:
+                current = self._watches.get(entry.key)
+                if current is None or current is entry:
+                    self._watches[entry.key] = entry
+                    self._stats[entry.key] = stats
+                    self._schedule(entry, stats, stats.last_exit_code)
+            self._wake()
+        finally:
+            with self._lock:
+                self._restarting.discard(entry.key)
+
+
+process_monitor = ProcessMonitor()
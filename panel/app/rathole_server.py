@@ -1,10 +1,16 @@
 """Rathole server management for panel"""
+import shutil
 import subprocess
-import time
+import threading
 import logging
 from pathlib import Path
 from typing import Dict, Optional
 
+from app.config import settings
+from app.pid_registry import pid_registry, stop_process
+from app.process_monitor import process_monitor
+from app.readiness import READY_PATTERNS, wait_for_ready
+from app.shared_cores import SharedRatholeServer, SharedServers
 from app.utils import parse_address_port, format_address_port
 
 logger = logging.getLogger(__name__)
@@ -17,7 +23,15 @@ class RatholeServerManager:
         self.config_dir = Path("/app/data/rathole")
         self.config_dir.mkdir(parents=True, exist_ok=True)
         self.active_servers: Dict[str, subprocess.Popen] = {}
+        self._lock = threading.RLock()
         self.server_configs: Dict[str, dict] = {}
+        self.shared = SharedServers(self._shared_instance) if settings.rathole_shared_mode else None
+    
+    def _shared_instance(self, bind_port: int, params: dict) -> SharedRatholeServer:
+        binary = Path("/usr/local/bin/rathole")
+        if not binary.exists():
+            binary = Path(shutil.which("rathole") or "rathole")
+        return SharedRatholeServer(self.config_dir, binary, bind_port, params)
     
     def start_server(self, tunnel_id: str, remote_addr: str, token: str, proxy_port: int, use_ipv6: bool = False) -> bool:
         """
@@ -33,82 +47,95 @@ class RatholeServerManager:
         Returns:
             True if server started successfully, False otherwise
         """
-        try:
-            _, port, _ = parse_address_port(remote_addr)
-            if port is None:
-                raise ValueError(f"Invalid remote_addr format: {remote_addr} (port required)")
-            
-            bind_addr = f"0.0.0.0:{port}"
-            proxy_bind_addr = f"0.0.0.0:{proxy_port}"
-            
-            if tunnel_id in self.active_servers:
-                logger.warning(f"Rathole server for tunnel {tunnel_id} already exists, stopping it first")
-                self.stop_server(tunnel_id)
-            
-            config = f"""[server]
+        with self._lock:
+            try:
+                _, port, _ = parse_address_port(remote_addr)
+                if port is None:
+                    raise ValueError(f"Invalid remote_addr format: {remote_addr} (port required)")
+                
+                bind_addr = f"0.0.0.0:{port}"
+                proxy_bind_addr = f"0.0.0.0:{proxy_port}"
+                
+                if tunnel_id in self.active_servers:
+                    logger.warning(f"Rathole server for tunnel {tunnel_id} already exists, stopping it first")
+                    self.stop_server(tunnel_id)
+                
+                if self.shared:
+                    # Each service carries its own token, so any tunnel can join the instance on its port
+                    self.shared.put(tunnel_id, int(port), {}, [{
+                        "name": tunnel_id,
+                        "token": token,
+                        "bind_addr": proxy_bind_addr,
+                        "port": int(proxy_port),
+                    }])
+                    logger.info(f"Added tunnel {tunnel_id} to shared Rathole server on {bind_addr}, proxy port: {proxy_port}")
+                    return True
+                
+                config = f"""[server]
 bind_addr = "{bind_addr}"
 default_token = "{token}"
 
 [server.services.{tunnel_id}]
 bind_addr = "{proxy_bind_addr}"
 """
-            
-            config_path = self.config_dir / f"{tunnel_id}.toml"
-            with open(config_path, "w") as f:
-                f.write(config)
-            
-            self.server_configs[tunnel_id] = {
-                "remote_addr": remote_addr,
-                "token": token,
-                "proxy_port": proxy_port,
-                "bind_addr": bind_addr,
-                "config_path": str(config_path)
-            }
-            
-            log_file = self.config_dir / f"rathole_{tunnel_id}.log"
-            try:
-                log_f = open(log_file, 'w', buffering=1)
-                log_f.write(f"Starting rathole server for tunnel {tunnel_id}\n")
-                log_f.write(f"Config: bind_addr={bind_addr}, proxy_port={proxy_port}\n")
-                log_f.write(f"Config file: {config_path}\n")
-                log_f.write(f"Config content:\n{config}\n")
-                log_f.flush()
-                proc = subprocess.Popen(
-                    ["/usr/local/bin/rathole", "-s", str(config_path)],
-                    stdout=log_f,
-                    stderr=subprocess.STDOUT,
-                    cwd=str(self.config_dir),
-                    start_new_session=True
-                )
-            except FileNotFoundError:
-                log_f = open(log_file, 'w', buffering=1)
-                log_f.write(f"Starting rathole server (system binary) for tunnel {tunnel_id}\n")
-                log_f.flush()
-                proc = subprocess.Popen(
-                    ["rathole", "-s", str(config_path)],
-                    stdout=log_f,
-                    stderr=subprocess.STDOUT,
-                    cwd=str(self.config_dir),
-                    start_new_session=True
-                )
-            
-            self.active_servers[f"{tunnel_id}_log"] = log_f
-            self.active_servers[tunnel_id] = proc
-            
-            time.sleep(1.0)
-            if proc.poll() is not None:
+                
+                config_path = self.config_dir / f"{tunnel_id}.toml"
+                with open(config_path, "w") as f:
+                    f.write(config)
+                
+                self.server_configs[tunnel_id] = {
+                    "remote_addr": remote_addr,
+                    "token": token,
+                    "proxy_port": proxy_port,
+                    "bind_addr": bind_addr,
+                    "config_path": str(config_path)
+                }
+                
+                log_file = self.config_dir / f"rathole_{tunnel_id}.log"
                 try:
-                    if log_file.exists():
-                        with open(log_file, 'r') as f:
-                            error_output = f.read()
-                    else:
-                        error_output = "Log file not found"
-                    error_msg = f"rathole server failed to start (exit code: {proc.poll()}): {error_output[-500:] if len(error_output) > 500 else error_output}"
-                    logger.error(error_msg)
-                except Exception as e:
-                    error_msg = f"rathole server failed to start (exit code: {proc.poll()}), could not read log: {e}"
-                    logger.error(error_msg)
-                finally:
+                    log_f = open(log_file, 'w', buffering=1)
+                    log_f.write(f"Starting rathole server for tunnel {tunnel_id}\n")
+                    log_f.write(f"Config: bind_addr={bind_addr}, proxy_port={proxy_port}\n")
+                    log_f.write(f"Config file: {config_path}\n")
+                    log_f.write(f"Config content:\n{config}\n")
+                    log_f.flush()
+                    proc = subprocess.Popen(
+                        ["/usr/local/bin/rathole", "-s", str(config_path)],
+                        stdout=log_f,
+                        stderr=subprocess.STDOUT,
+                        cwd=str(self.config_dir),
+                        start_new_session=True
+                    )
+                except FileNotFoundError:
+                    log_f = open(log_file, 'w', buffering=1)
+                    log_f.write(f"Starting rathole server (system binary) for tunnel {tunnel_id}\n")
+                    log_f.flush()
+                    proc = subprocess.Popen(
+                        ["rathole", "-s", str(config_path)],
+                        stdout=log_f,
+                        stderr=subprocess.STDOUT,
+                        cwd=str(self.config_dir),
+                        start_new_session=True
+                    )
+                
+                self.active_servers[f"{tunnel_id}_log"] = log_f
+                self.active_servers[tunnel_id] = proc
+                pid_registry.add(f"rathole:{tunnel_id}", proc.pid, proc.args)
+                
+                ready, reason = wait_for_ready(
+                    proc,
+                    tcp_ports=[port],
+                    log_path=log_file,
+                    patterns=READY_PATTERNS["rathole"],
+                )
+                if not ready:
+                    try:
+                        error_output = log_file.read_text()[-500:] if log_file.exists() else "Log file not found"
+                    except Exception as e:
+                        error_output = f"could not read log: {e}"
+                    if proc.poll() is None:
+                        proc.kill()
+                        proc.wait()
                     del self.active_servers[tunnel_id]
                     if f"{tunnel_id}_log" in self.active_servers:
                         try:
@@ -118,63 +145,62 @@ bind_addr = "{proxy_bind_addr}"
                         del self.active_servers[f"{tunnel_id}_log"]
                     if tunnel_id in self.server_configs:
                         del self.server_configs[tunnel_id]
-                raise RuntimeError(error_msg)
-            
-            try:
-                import socket
-                _, port, _ = parse_address_port(bind_addr)
-                if port:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(1)
-                    result = sock.connect_ex(('127.0.0.1', port))
-                    sock.close()
-                    if result != 0:
-                        logger.warning(f"Rathole server port {port} not listening after start, but process is running. PID: {proc.pid}")
+                    error_msg = f"rathole server failed to start ({reason}): {error_output}"
+                    logger.error(error_msg)
+                    raise RuntimeError(error_msg)
+                
+                process_monitor.watch(
+                    f"rathole:{tunnel_id}",
+                    proc,
+                    lambda: self.start_server(tunnel_id, remote_addr, token, proxy_port, use_ipv6),
+                    lock=self._lock,
+                )
+                logger.info(f"Started Rathole server for tunnel {tunnel_id} on {bind_addr}, proxy port: {proxy_port}")
+                return True
+                
             except Exception as e:
-                logger.warning(f"Could not verify rathole server port is listening: {e}")
-            
-            logger.info(f"Started Rathole server for tunnel {tunnel_id} on {bind_addr}, proxy port: {proxy_port}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Failed to start Rathole server for tunnel {tunnel_id}: {e}")
-            raise
+                logger.error(f"Failed to start Rathole server for tunnel {tunnel_id}: {e}")
+                raise
     
     def stop_server(self, tunnel_id: str):
         """Stop Rathole server for a tunnel"""
-        if tunnel_id in self.active_servers:
-            proc = self.active_servers[tunnel_id]
-            try:
-                proc.terminate()
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                proc.kill()
-                proc.wait()
-            except Exception as e:
-                logger.warning(f"Error stopping Rathole server for tunnel {tunnel_id}: {e}")
-            finally:
-                del self.active_servers[tunnel_id]
-                log_key = f"{tunnel_id}_log"
-                if log_key in self.active_servers:
-                    try:
-                        self.active_servers[log_key].close()
-                    except:
-                        pass
-                    del self.active_servers[log_key]
-            
-            logger.info(f"Stopped Rathole server for tunnel {tunnel_id}")
-        
-        if tunnel_id in self.server_configs:
-            config_path = Path(self.server_configs[tunnel_id]["config_path"])
-            if config_path.exists():
+        with self._lock:
+            if self.shared and self.shared.remove(tunnel_id):
+                logger.info(f"Removed tunnel {tunnel_id} from shared Rathole server")
+                return
+            process_monitor.unwatch(f"rathole:{tunnel_id}")
+            if tunnel_id in self.active_servers:
+                proc = self.active_servers[tunnel_id]
                 try:
-                    config_path.unlink()
+                    stop_process(proc)
                 except Exception as e:
-                    logger.warning(f"Failed to delete config file {config_path}: {e}")
-            del self.server_configs[tunnel_id]
+                    logger.warning(f"Error stopping Rathole server for tunnel {tunnel_id}: {e}")
+                finally:
+                    pid_registry.remove(f"rathole:{tunnel_id}")
+                    del self.active_servers[tunnel_id]
+                    log_key = f"{tunnel_id}_log"
+                    if log_key in self.active_servers:
+                        try:
+                            self.active_servers[log_key].close()
+                        except:
+                            pass
+                        del self.active_servers[log_key]
+                
+                logger.info(f"Stopped Rathole server for tunnel {tunnel_id}")
+            
+            if tunnel_id in self.server_configs:
+                config_path = Path(self.server_configs[tunnel_id]["config_path"])
+                if config_path.exists():
+                    try:
+                        config_path.unlink()
+                    except Exception as e:
+                        logger.warning(f"Failed to delete config file {config_path}: {e}")
+                del self.server_configs[tunnel_id]
     
     def is_running(self, tunnel_id: str) -> bool:
         """Check if server is running for a tunnel"""
+        if self.shared and self.shared.owns(tunnel_id):
+            return self.shared.tunnel_running(tunnel_id)
         if tunnel_id not in self.active_servers:
             return False
         proc = self.active_servers[tunnel_id]
@@ -182,21 +208,27 @@ bind_addr = "{proxy_bind_addr}"
     
     def get_active_servers(self) -> list:
         """Get list of tunnel IDs with active servers"""
-        active = []
-        for tunnel_id, proc in list(self.active_servers.items()):
-            if proc.poll() is None:
-                active.append(tunnel_id)
-            else:
-                del self.active_servers[tunnel_id]
-                if tunnel_id in self.server_configs:
-                    del self.server_configs[tunnel_id]
-        return active
+        with self._lock:
+            active = []
+            for tunnel_id, proc in list(self.active_servers.items()):
+                if proc.poll() is None:
+                    active.append(tunnel_id)
+                else:
+                    del self.active_servers[tunnel_id]
+                    if tunnel_id in self.server_configs:
+                        del self.server_configs[tunnel_id]
+            if self.shared:
+                active.extend(self.shared.active_tunnels())
+            return active
     
     def cleanup_all(self):
         """Stop all Rathole servers"""
-        tunnel_ids = list(self.active_servers.keys())
-        for tunnel_id in tunnel_ids:
-            self.stop_server(tunnel_id)
+        with self._lock:
+            tunnel_ids = list(self.active_servers.keys())
+            for tunnel_id in tunnel_ids:
+                self.stop_server(tunnel_id)
+            if self.shared:
+                self.shared.stop()
 
 
 rathole_server_manager = RatholeServerManager()
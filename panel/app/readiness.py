@@ -0,0 +1,191 @@
+"""Readiness detection for tunnel core processes"""
+import logging
+import os
+import re
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROC = Path("/proc")
+PROC_NET = PROC / "net"
+TCP_LISTEN = "0A"
+UDP_UNCONNECTED = "07"
+SOCKET_TABLE_TTL = 0.05
+
+# Log lines server cores print once they are serving
+READY_PATTERNS = {
+    "rathole": [r"Listening at"],
+    "chisel": [r"Listening on"],
+    "frp": [r"frps tcp listen on"],
+    "backhaul": [r"server started successfully"],
+}
+
+_socket_cache: dict = {}
+
+
+def _read_socket_table(name: str, state: str) -> Optional[Dict[int, Set[int]]]:
+    path = PROC_NET / name
+    try:
+        with open(path, "r") as f:
+            next(f, None)
+            ports: Dict[int, Set[int]] = {}
+            for line in f:
+                fields = line.split()
+                if len(fields) < 10 or fields[3] != state:
+                    continue
+                port = int(fields[1].rsplit(":", 1)[1], 16)
+                ports.setdefault(port, set()).add(int(fields[9]))
+            return ports
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug(f"Could not read socket table {path}: {e}")
+        return None
+
+
+def bound_ports(udp: bool = False) -> Optional[Dict[int, Set[int]]]:
+    """Map local ports in LISTEN (TCP) or bound (UDP) state to their socket inodes, or None if unavailable.
+
+    Results are cached for SOCKET_TABLE_TTL so concurrent waiters share one read.
+    """
+    key = "udp" if udp else "tcp"
+    cached = _socket_cache.get(key)
+    now = time.monotonic()
+    if cached and now - cached[0] < SOCKET_TABLE_TTL:
+        return cached[1]
+
+    state = UDP_UNCONNECTED if udp else TCP_LISTEN
+    ports: Optional[Dict[int, Set[int]]] = None
+    for name in (key, f"{key}6"):
+        table = _read_socket_table(name, state)
+        if table is not None:
+            ports = ports if ports is not None else {}
+            for port, inodes in table.items():
+                ports.setdefault(port, set()).update(inodes)
+
+    _socket_cache[key] = (now, ports)
+    return ports
+
+
+class LogWatcher:
+    """Incrementally scans a process log for readiness lines"""
+
+    def __init__(self, log_path: Optional[Path], patterns: Iterable[str]):
+        self.log_path = Path(log_path) if log_path else None
+        self.regex = re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE) if patterns else None
+        self.offset = 0
+
+    def matched(self) -> bool:
+        if not self.regex or not self.log_path:
+            return False
+        try:
+            with open(self.log_path, "r", encoding="utf-8", errors="replace") as f:
+                f.seek(self.offset)
+                chunk = f.read()
+                self.offset = f.tell()
+        except Exception:
+            return False
+        return bool(chunk) and self.regex.search(chunk) is not None
+
+
+def group_socket_inodes(pgid: int) -> Optional[Set[int]]:
+    """Inodes of the sockets held open by a process group, or None if /proc cannot be read"""
+    inodes: Set[int] = set()
+    try:
+        entries = os.listdir(PROC)
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            stat = (PROC / entry / "stat").read_text()
+            # Fields after the parenthesized command: state, ppid, pgrp
+            if int(stat.rsplit(")", 1)[1].split()[2]) != pgid:
+                continue
+            fd_dir = PROC / entry / "fd"
+            for fd in os.listdir(fd_dir):
+                target = os.readlink(fd_dir / fd)
+                if target.startswith("socket:["):
+                    inodes.add(int(target[8:-1]))
+        except (OSError, ValueError, IndexError):
+            continue
+    return inodes
+
+
+def missing_ports(tcp_ports: Set[int], udp_ports: Set[int], pgid: Optional[int] = None) -> Optional[List[str]]:
+    """Return the expected ports not yet bound, or None if the socket table is unreadable.
+
+    With a `pgid`, a port only counts once a socket of that process group
+    holds it, so a port some other process already had is still missing.
+    """
+    missing: List[str] = []
+    owned: Optional[Set[int]] = None
+    for ports, udp in ((tcp_ports, False), (udp_ports, True)):
+        if not ports:
+            continue
+        bound = bound_ports(udp=udp)
+        if bound is None:
+            return None
+        proto = "udp" if udp else "tcp"
+        for port in sorted(ports):
+            if port not in bound:
+                missing.append(f"{proto}/{port}")
+                continue
+            if pgid is None:
+                continue
+            if owned is None:
+                owned = group_socket_inodes(pgid)
+            if owned is not None and not bound[port] & owned:
+                missing.append(f"{proto}/{port} (held by another process)")
+    return missing
+
+
+def wait_for_ready(
+    proc: subprocess.Popen,
+    tcp_ports: Iterable[int] = (),
+    udp_ports: Iterable[int] = (),
+    log_path: Optional[Path] = None,
+    patterns: Iterable[str] = (),
+    timeout: float = 10.0,
+    settle: float = 0.5,
+    interval: float = SOCKET_TABLE_TTL,
+) -> Tuple[bool, str]:
+    """Wait until a freshly spawned core is serving.
+
+    The core is ready as soon as all expected ports are bound or a readiness
+    log line appears. Cores without expected ports are also ready once they
+    have stayed up for `settle` seconds. Returns (ready, reason); a core that
+    exits, or is still not bound after `timeout`, is not ready. Ports only
+    count once the core's own process group (cores run in a new session)
+    holds them, not when another process already had them.
+    """
+    tcp = {int(p) for p in tcp_ports if str(p).isdigit()}
+    udp = {int(p) for p in udp_ports if str(p).isdigit()}
+    watcher = LogWatcher(log_path, list(patterns))
+    started = time.monotonic()
+
+    while True:
+        if proc.poll() is not None:
+            return False, f"exit code {proc.returncode}"
+        if watcher.matched():
+            return True, "log"
+
+        elapsed = time.monotonic() - started
+        if tcp or udp:
+            missing = missing_ports(tcp, udp, proc.pid)
+            if missing is None:
+                # No kernel socket table to look at; fall back to the settle period
+                if elapsed >= settle:
+                    return True, "settled"
+            elif not missing:
+                return True, "listening"
+            elif elapsed >= timeout:
+                return False, f"not listening on {', '.join(missing)} after {timeout:g}s"
+        elif elapsed >= settle:
+            return True, "settled"
+
+        time.sleep(interval)
@@ -0,0 +1,438 @@
+"""Background reapply of many tunnels, batched per node"""
+import asyncio
+import logging
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Tunnel, Node
+from app.node_client import NodeClient
+from app.tunnel_specs import REVERSE_CORES, PlanError, plan_reverse
+from app.tunnel_enforcer import tunnel_enforcer, DISABLED_STATUSES
+from app.utils import spec_hash
+
+logger = logging.getLogger(__name__)
+
+# Reverse tunnels start their server side before the client dials in
+SERVER_PHASE = 0
+CLIENT_PHASE = 1
+
+MAX_JOBS = 20
+MAX_ERRORS = 50
+# Tunnels the reconciler keeps in their desired state on the nodes
+RECONCILED_STATUSES = ("active", "error")
+
+
+def index_nodes(nodes: List[Node]) -> Tuple[Dict[str, Node], Dict[str, List[Node]]]:
+    """Map nodes by id and by role in one pass"""
+    by_id: Dict[str, Node] = {}
+    by_role: Dict[str, List[Node]] = {}
+    for node in nodes:
+        by_id[node.id] = node
+        by_role.setdefault(node.role, []).append(node)
+    return by_id, by_role
+
+
+def _operation(tunnel: Tunnel, spec: Dict[str, Any]) -> Dict[str, Any]:
+    return {"op": "apply", "tunnel_id": tunnel.id, "core": tunnel.core, "type": tunnel.type, "spec": spec}
+
+
+def plan_tunnel(
+    tunnel: Tunnel,
+    nodes: Dict[str, Node],
+    foreign_node: Optional[Node],
+    request,
+) -> Tuple[List[Tuple[int, str, Dict[str, Any]]], Dict[str, Any]]:
+    """Return the (phase, node id, operation) triples that apply a tunnel, and spec fields to store back.
+
+    Mirrors the per-tunnel apply endpoint: reverse tunnels get a server
+    spec on their iran node and a client spec on their foreign node, the
+    ones stored at creation or else the node_id and the default foreign node.
+    """
+    if tunnel.core in REVERSE_CORES:
+        iran_node = nodes.get(tunnel.iran_node_id) or nodes.get(tunnel.node_id)
+        foreign_node = nodes.get(tunnel.foreign_node_id) or foreign_node
+        if not iran_node:
+            raise PlanError(f"Iran node {tunnel.iran_node_id or tunnel.node_id} not found")
+        if not foreign_node:
+            raise PlanError("No foreign node found. Please ensure at least one node has role='foreign' (set NODE_ROLE=foreign on the foreign node).")
+        role = iran_node.role
+        if role != "iran":
+            raise PlanError(f"Node {iran_node.id} is not an iran node (role={role}). Set NODE_ROLE=iran on the Iran node.")
+        server_spec, client_spec, updates = plan_reverse(tunnel, iran_node)
+        return [
+            (SERVER_PHASE, iran_node.id, _operation(tunnel, server_spec)),
+            (CLIENT_PHASE, foreign_node.id, _operation(tunnel, client_spec)),
+        ], updates
+
+    node = nodes.get(tunnel.node_id)
+    if not node:
+        raise PlanError("Node not found")
+    spec = dict(tunnel.spec or {})
+    if tunnel.core == "gost":
+        spec["type"] = tunnel.type
+    if tunnel.core == "frp":
+        from app.routers.tunnels import prepare_frp_spec_for_node
+        try:
+            spec = prepare_frp_spec_for_node(spec, node, request)
+        except Exception as e:
+            raise PlanError(f"Failed to prepare FRP spec: {str(e)}")
+    return [(SERVER_PHASE, node.id, _operation(tunnel, spec))], {}
+
+
+def background_request():
+    """A stand-in request for jobs not started from an HTTP call"""
+    from starlette.requests import Request as StarletteRequest
+    from starlette.datastructures import Headers
+
+    return StarletteRequest(
+        scope={
+            "type": "http",
+            "method": "POST",
+            "path": "/api/tunnels/reapply",
+            "headers": Headers({}).raw,
+            "query_string": b"",
+        }
+    )
+
+
+class ReapplyJob:
+    """Progress of one reapply run"""
+
+    def __init__(self, only_active: bool, kind: str = "reapply"):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.only_active = only_active
+        self.status = "pending"
+        self.total = 0
+        self.applied = 0
+        self.failed = 0
+        self.unchanged = 0
+        self.errors: List[str] = []
+        self.nodes: Dict[str, Dict[str, int]] = {}
+        self.created_at = datetime.utcnow()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+        self.names: Dict[str, str] = {}
+        self.pending: Dict[str, int] = {}
+        self.outcomes: Dict[str, Optional[str]] = {}
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def record(self, tunnel_id: str, error: Optional[str] = None):
+        """Count one finished operation; a tunnel is applied once all of its operations succeed"""
+        if tunnel_id in self.outcomes:
+            return
+        if error:
+            self.outcomes[tunnel_id] = error
+            self.failed += 1
+            if len(self.errors) < MAX_ERRORS:
+                self.errors.append(f"Tunnel {self.names.get(tunnel_id, tunnel_id)}: {error}")
+            return
+        self.pending[tunnel_id] -= 1
+        if self.pending[tunnel_id] <= 0:
+            self.outcomes[tunnel_id] = None
+            self.applied += 1
+
+    def message(self) -> str:
+        return f"Reapplied {self.applied} tunnels, {self.failed} failed"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "message": self.message(),
+            "total": self.total,
+            "applied": self.applied,
+            "failed": self.failed,
+            "unchanged": self.unchanged,
+            "remaining": max(0, self.total - self.applied - self.failed),
+            "errors": self.errors,
+            "nodes": self.nodes,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class ReapplyEngine:
+    """Reapplies tunnels as a background job.
+
+    Every tunnel is planned up front from one read of the tunnels and
+    nodes tables. Operations are grouped by node and sent in chunks to the
+    node's batch endpoint, with at most reapply_node_concurrency chunks in
+    flight per node and reapply_concurrency overall. Reverse tunnels run in
+    two phases so server sides are up before clients connect. Statuses
+    are written back in a single transaction at the end.
+    """
+
+    def __init__(self):
+        self.node_client = NodeClient()
+        self.jobs: "OrderedDict[str, ReapplyJob]" = OrderedDict()
+
+    def get(self, job_id: str) -> Optional[ReapplyJob]:
+        return self.jobs.get(job_id)
+
+    def start(self, only_active: bool = False, request=None) -> ReapplyJob:
+        """Start a reapply job, or return the one already running"""
+        for job in self.jobs.values():
+            if not job.done:
+                return job
+        job = ReapplyJob(only_active)
+        self.jobs[job.id] = job
+        while len(self.jobs) > MAX_JOBS:
+            self.jobs.popitem(last=False)
+        job.task = asyncio.create_task(self._run(job, request or background_request()))
+        return job
+
+    async def _run(self, job: ReapplyJob, request):
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+        try:
+            await self._execute(job, request)
+            job.status = "completed"
+            logger.info(f"Reapply job {job.id} finished: {job.message()}")
+        except Exception as e:
+            job.status = "failed"
+            job.errors.append(f"Error: {str(e)}")
+            logger.error(f"Reapply job {job.id} failed: {e}", exc_info=True)
+        finally:
+            job.finished_at = datetime.utcnow()
+
+    async def _execute(self, job: ReapplyJob, request):
+        query = select(Tunnel).where(Tunnel.status.notin_(DISABLED_STATUSES))
+        if job.only_active:
+            query = query.where(Tunnel.status == "active")
+        async with AsyncSessionLocal() as session:
+            tunnels = (await session.execute(query)).scalars().all()
+            nodes = (await session.execute(select(Node))).scalars().all()
+
+        nodes_by_id, nodes_by_role = index_nodes(nodes)
+        foreign_node = next(iter(nodes_by_role.get("foreign", [])), None)
+        phases: Tuple[List[Tuple[str, Dict[str, Any]]], ...] = ([], [])
+        spec_updates: Dict[str, Dict[str, Any]] = {}
+        job.total = len(tunnels)
+        for tunnel in tunnels:
+            job.names[tunnel.id] = tunnel.name
+            try:
+                operations, updates = plan_tunnel(tunnel, nodes_by_id, foreign_node, request)
+            except PlanError as e:
+                job.record(tunnel.id, str(e))
+                continue
+            if updates:
+                spec_updates[tunnel.id] = updates
+            job.pending[tunnel.id] = len(operations)
+            for phase, node_id, operation in operations:
+                phases[phase].append((node_id, operation))
+
+        logger.info(f"Reapply job {job.id}: {len(tunnels)} tunnels on {len({n for p in phases for n, _ in p})} nodes")
+        for phase in phases:
+            operations = [(node_id, op) for node_id, op in phase if op["tunnel_id"] not in job.outcomes]
+            await self._dispatch(job, operations, nodes_by_id)
+
+        await self._store(job, spec_updates)
+
+    async def _dispatch(self, job: ReapplyJob, operations: List[Tuple[str, Dict[str, Any]]], nodes: Dict[str, Node]):
+        by_node: Dict[str, List[Dict[str, Any]]] = {}
+        for node_id, operation in operations:
+            by_node.setdefault(node_id, []).append(operation)
+        size = max(1, settings.reapply_batch_size)
+        limit = asyncio.Semaphore(max(1, settings.reapply_concurrency))
+
+        async def run_node(node_id: str, node_operations: List[Dict[str, Any]]):
+            node_limit = asyncio.Semaphore(max(1, settings.reapply_node_concurrency))
+            progress = job.nodes.setdefault(node_id, {"total": 0, "done": 0, "failed": 0})
+            progress["total"] += len(node_operations)
+            node_name = nodes[node_id].name
+
+            async def run_chunk(chunk: List[Dict[str, Any]]):
+                async with node_limit:
+                    async with limit:
+                        results = await self._send_chunk(node_id, chunk)
+                by_tunnel = {result.get("tunnel_id"): result for result in results}
+                for operation in chunk:
+                    result = by_tunnel.get(operation["tunnel_id"]) or {"status": "error", "message": "No result from node"}
+                    error = None
+                    if result.get("status") != "success":
+                        error = f"Node {node_name}: {result.get('message') or 'Unknown error'}"
+                        progress["failed"] += 1
+                    elif result.get("result") == "unchanged":
+                        # Node already ran this exact spec and left the process alone
+                        job.unchanged += 1
+                    progress["done"] += 1
+                    job.record(operation["tunnel_id"], error)
+
+            await asyncio.gather(*(
+                run_chunk(node_operations[i:i + size]) for i in range(0, len(node_operations), size)
+            ))
+
+        await asyncio.gather(*(run_node(node_id, node_operations) for node_id, node_operations in by_node.items()))
+
+    async def _send_chunk(self, node_id: str, chunk: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        response = await self.node_client.send_batch(node_id, chunk)
+        if response.get("status") != "error":
+            return response.get("results") or []
+        message = response.get("message", "Unknown error")
+        if "HTTP 404" in message:
+            # Node agents that predate the batch endpoint
+            return [await self._apply_one(node_id, operation) for operation in chunk]
+        return [{"tunnel_id": operation["tunnel_id"], "status": "error", "message": message} for operation in chunk]
+
+    async def _apply_one(self, node_id: str, operation: Dict[str, Any]) -> Dict[str, Any]:
+        response = await self.node_client.send_to_node(
+            node_id=node_id,
+            endpoint="/api/agent/tunnels/apply",
+            data={key: operation[key] for key in ("tunnel_id", "core", "type", "spec")},
+        )
+        return {"tunnel_id": operation["tunnel_id"], "status": response.get("status"), "message": response.get("message")}
+
+    async def _store(self, job: ReapplyJob, spec_updates: Dict[str, Dict[str, Any]]):
+        """Write statuses and generated spec fields for every tunnel in one transaction"""
+        tunnel_ids = list(job.outcomes)
+        async with AsyncSessionLocal() as session:
+            tunnels = []
+            for i in range(0, len(tunnel_ids), 500):
+                result = await session.execute(select(Tunnel).where(Tunnel.id.in_(tunnel_ids[i:i + 500])))
+                tunnels.extend(result.scalars().all())
+            for tunnel in tunnels:
+                updates = spec_updates.get(tunnel.id)
+                if updates:
+                    tunnel.spec = {**(tunnel.spec or {}), **updates}
+                # The enforcer may have disabled the tunnel while the job ran
+                if tunnel.status in DISABLED_STATUSES:
+                    continue
+                error = job.outcomes[tunnel.id]
+                tunnel.status = "error" if error else "active"
+                tunnel.error_message = error
+            await session.commit()
+        for tunnel in tunnels:
+            tunnel_enforcer.track(tunnel)
+
+    async def reconcile(self, request=None) -> Dict[str, Any]:
+        """Push only the tunnels that nodes report missing, drifted or not running.
+
+        Each node is asked once for the spec hash and process state of its
+        tunnels. A tunnel is left alone when every node it lives on runs
+        the spec this panel would send and the process is up, so a healthy
+        fleet costs one request per node and no restarts.
+        """
+        for job in self.jobs.values():
+            if not job.done:
+                return {"status": "skipped", "message": f"{job.kind.title()} job {job.id} is running"}
+        job = ReapplyJob(only_active=False, kind="reconcile")
+        self.jobs[job.id] = job
+        while len(self.jobs) > MAX_JOBS:
+            self.jobs.popitem(last=False)
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+        try:
+            summary = await self._reconcile(job, request or background_request())
+            job.status = "completed"
+        except Exception:
+            job.status = "failed"
+            raise
+        finally:
+            job.finished_at = datetime.utcnow()
+        if job.total or summary["unreachable"]:
+            logger.info(
+                f"Reconciled tunnels: {summary['in_sync']} in sync, {job.applied} pushed, "
+                f"{job.failed} failed, {summary['unreachable']} on unreachable nodes"
+            )
+        return summary
+
+    async def _reconcile(self, job: ReapplyJob, request) -> Dict[str, Any]:
+        async with AsyncSessionLocal() as session:
+            tunnels = (await session.execute(
+                select(Tunnel).where(Tunnel.status.in_(RECONCILED_STATUSES))
+            )).scalars().all()
+            nodes = (await session.execute(select(Node))).scalars().all()
+
+        nodes_by_id, nodes_by_role = index_nodes(nodes)
+        foreign_node = next(iter(nodes_by_role.get("foreign", [])), None)
+        planned: Dict[str, List[Tuple[int, str, Dict[str, Any]]]] = {}
+        spec_updates: Dict[str, Dict[str, Any]] = {}
+        for tunnel in tunnels:
+            try:
+                planned[tunnel.id], updates = plan_tunnel(tunnel, nodes_by_id, foreign_node, request)
+            except PlanError:
+                # Nothing valid to compare against; a full reapply reports the error
+                continue
+            if updates:
+                spec_updates[tunnel.id] = updates
+
+        states = await self._node_states({node_id for operations in planned.values() for _, node_id, _ in operations})
+
+        phases: Tuple[List[Tuple[str, Dict[str, Any]]], ...] = ([], [])
+        in_sync = 0
+        unreachable = 0
+        for tunnel in tunnels:
+            operations = planned.get(tunnel.id)
+            if not operations:
+                continue
+            if any(states.get(node_id) is None for _, node_id, _ in operations):
+                unreachable += 1
+                continue
+            pushes = []
+            for phase, node_id, operation in operations:
+                actual = states[node_id].get(tunnel.id) or {}
+                if actual.get("state") == "running" and actual.get("spec_hash") == spec_hash(operation["core"], operation["spec"]):
+                    continue
+                pushes.append((phase, node_id, operation))
+            if not pushes:
+                in_sync += 1
+                if tunnel.status != "active":
+                    # Healthy on every node; clear the stale error below
+                    job.outcomes[tunnel.id] = None
+                continue
+            job.names[tunnel.id] = tunnel.name
+            job.pending[tunnel.id] = len(pushes)
+            for phase, node_id, operation in pushes:
+                phases[phase].append((node_id, operation))
+        job.total = len(job.pending)
+
+        for phase in phases:
+            operations = [(node_id, op) for node_id, op in phase if op["tunnel_id"] not in job.outcomes]
+            await self._dispatch(job, operations, nodes_by_id)
+
+        if job.outcomes:
+            await self._store(job, {tunnel_id: spec_updates[tunnel_id] for tunnel_id in job.pending if tunnel_id in spec_updates})
+        return {
+            "status": "success",
+            "in_sync": in_sync,
+            "pushed": job.applied,
+            "failed": job.failed,
+            "unreachable": unreachable,
+            "errors": job.errors,
+        }
+
+    async def _node_states(self, node_ids) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Tunnel states per node; None for nodes that could not be asked or are still restoring"""
+        async def fetch(node_id: str):
+            response = await self.node_client.get_tunnel_states(node_id)
+            if response.get("status") == "success":
+                return node_id, (response.get("data") or {}) if response.get("ready", True) else None
+            if "HTTP 404" in (response.get("message") or ""):
+                # Node agents that cannot report state get every tunnel pushed, as before
+                return node_id, {}
+            logger.debug(f"No tunnel state from node {node_id}: {response.get('message')}")
+            return node_id, None
+
+        results = await asyncio.gather(*(fetch(node_id) for node_id in node_ids))
+        return dict(results)
+
+    async def wait(self, job: ReapplyJob):
+        """Wait for a job to finish"""
+        if job.task:
+            await asyncio.shield(job.task)
+
+
+reapply_engine = ReapplyEngine()
@@ -9,9 +9,13 @@ import logging
 import asyncio
 import httpx
 
-from app.database import get_db
-from app.models import Tunnel, Node, CoreResetConfig
+from app.database import get_db, get_read_db
+from app.models import Tunnel, CoreResetConfig
 from app.node_client import NodeClient
+from app.node_health import OPEN, node_health
+from app.node_repository import node_repository
+from app.process_monitor import process_monitor
+from app.tunnel_specs import PlanError, plan_reverse
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -39,15 +43,12 @@ class ResetConfigUpdate(BaseModel):
 
 
 @router.get("/health", response_model=List[CoreHealthResponse])
-async def get_core_health(request: Request, db: AsyncSession = Depends(get_db)):
+async def get_core_health(request: Request, db: AsyncSession = Depends(get_read_db)):
     """Get health status for all cores"""
     health_data = []
     
-    result = await db.execute(select(Node))
-    all_nodes = result.scalars().all()
-    
-    iran_nodes_all = {n.id: n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "iran"}
-    foreign_nodes_all = {n.id: n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "foreign"}
+    iran_nodes_all = {n.id: n for n in await node_repository.with_role(db, "iran")}
+    foreign_nodes_all = {n.id: n for n in await node_repository.with_role(db, "foreign")}
     
     for core in CORES:
         result = await db.execute(select(Tunnel).where(Tunnel.core == core, Tunnel.status == "active"))
@@ -159,6 +160,28 @@ async def get_core_health(request: Request, db: AsyncSession = Depends(get_db)):
     return health_data
 
 
+@router.get("/restarts")
+async def get_panel_restarts():
+    """Get crash/restart history of core processes running on the panel"""
+    processes = process_monitor.snapshot()
+    return {
+        "status": "success",
+        "flapping": [key for key, info in processes.items() if info["flapping"]],
+        "data": processes
+    }
+
+
+@router.get("/node-circuits")
+async def get_node_circuits():
+    """Get circuit breaker state, latency estimates and in-flight calls per node"""
+    nodes = node_health.snapshot()
+    return {
+        "status": "success",
+        "open": [node_id for node_id, info in nodes.items() if info["state"] == OPEN],
+        "data": nodes
+    }
+
+
 @router.get("/reset-config", response_model=List[ResetConfigResponse])
 async def get_reset_configs(db: AsyncSession = Depends(get_db)):
     """Get reset timer configuration for all cores"""
@@ -288,185 +311,20 @@ async def _reset_core(core: str, app_or_request, db: AsyncSession):
     
     for tunnel in active_tunnels:
         try:
-            iran_node = None
-            foreign_node = None
-            
-            if tunnel.node_id:
-                result = await db.execute(select(Node).where(Node.id == tunnel.node_id))
-                iran_node = result.scalar_one_or_none()
-                if iran_node and iran_node.node_metadata.get("role") != "iran":
-                    foreign_node = iran_node
-                    iran_node = None
-            
-            if not foreign_node:
-                result = await db.execute(select(Node))
-                all_nodes = result.scalars().all()
-                foreign_nodes = [n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "foreign"]
-                if foreign_nodes:
-                    foreign_node = foreign_nodes[0]
-            
-            if not iran_node:
-                if tunnel.node_id:
-                    result = await db.execute(select(Node).where(Node.id == tunnel.node_id))
-                    iran_node = result.scalar_one_or_none()
-                if not iran_node:
-                    result = await db.execute(select(Node))
-                    all_nodes = result.scalars().all()
-                    iran_nodes = [n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "iran"]
-                    if iran_nodes:
-                        iran_node = iran_nodes[0]
+            iran_node, foreign_node = await node_repository.reverse_nodes(db, tunnel)
             
             if not foreign_node or not iran_node:
                 logger.warning(f"Tunnel {tunnel.id}: Missing foreign or iran node, skipping reset")
                 continue
             
-            server_spec = tunnel.spec.copy() if tunnel.spec else {}
-            server_spec["mode"] = "server"
-            
-            client_spec = tunnel.spec.copy() if tunnel.spec else {}
-            client_spec["mode"] = "client"
-            
-            if core == "rathole":
-                transport = server_spec.get("transport") or server_spec.get("type") or "tcp"
-                proxy_port = server_spec.get("remote_port") or server_spec.get("listen_port")
-                token = server_spec.get("token")
-                if not proxy_port or not token:
-                    logger.warning(f"Tunnel {tunnel.id}: Missing remote_port or token, skipping")
-                    continue
-                
-                remote_addr = server_spec.get("remote_addr", "0.0.0.0:23333")
-                from app.utils import parse_address_port
-                _, control_port, _ = parse_address_port(remote_addr)
-                if not control_port:
-                    control_port = 23333
-                server_spec["bind_addr"] = f"0.0.0.0:{control_port}"
-                server_spec["proxy_port"] = proxy_port
-                server_spec["transport"] = transport
-                server_spec["type"] = transport
-                if "websocket_tls" in server_spec:
-                    server_spec["websocket_tls"] = server_spec["websocket_tls"]
-                elif "tls" in server_spec:
-                    server_spec["websocket_tls"] = server_spec["tls"]
-                
-                iran_node_ip = iran_node.node_metadata.get("ip_address")
-                if not iran_node_ip:
-                    logger.warning(f"Tunnel {tunnel.id}: Iran node has no IP address, skipping")
-                    continue
-                transport_lower = transport.lower()
-                if transport_lower in ("websocket", "ws"):
-                    use_tls = bool(server_spec.get("websocket_tls") or server_spec.get("tls"))
-                    protocol = "wss://" if use_tls else "ws://"
-                    client_spec["remote_addr"] = f"{protocol}{iran_node_ip}:{control_port}"
-                else:
-                    client_spec["remote_addr"] = f"{iran_node_ip}:{control_port}"
-                client_spec["transport"] = transport
-                client_spec["type"] = transport
-                client_spec["token"] = token
-                if "websocket_tls" in server_spec:
-                    client_spec["websocket_tls"] = server_spec["websocket_tls"]
-                elif "tls" in server_spec:
-                    client_spec["websocket_tls"] = server_spec["tls"]
-                local_addr = client_spec.get("local_addr")
-                if not local_addr:
-                    local_addr = f"{iran_node_ip}:{proxy_port}"
-                client_spec["local_addr"] = local_addr
-            
-            elif core == "chisel":
-                listen_port = server_spec.get("listen_port") or server_spec.get("remote_port")
-                if not listen_port:
-                    logger.warning(f"Tunnel {tunnel.id}: Missing listen_port, skipping")
-                    continue
-                
-                iran_node_ip = iran_node.node_metadata.get("ip_address")
-                if not iran_node_ip:
-                    logger.warning(f"Tunnel {tunnel.id}: Iran node has no IP address, skipping")
-                    continue
-                server_control_port = server_spec.get("control_port") or (int(listen_port) + 10000)
-                server_spec["server_port"] = server_control_port
-                server_spec["reverse_port"] = listen_port
-                auth = server_spec.get("auth")
-                if auth:
-                    server_spec["auth"] = auth
-                fingerprint = server_spec.get("fingerprint")
-                if fingerprint:
-                    server_spec["fingerprint"] = fingerprint
-                
-                client_spec["server_url"] = f"http://{iran_node_ip}:{server_control_port}"
-                client_spec["reverse_port"] = listen_port
-                if auth:
-                    client_spec["auth"] = auth
-                if fingerprint:
-                    client_spec["fingerprint"] = fingerprint
-                local_addr = client_spec.get("local_addr")
-                if not local_addr:
-                    local_addr = f"{iran_node_ip}:{listen_port}"
-                client_spec["local_addr"] = local_addr
-            
-            elif core == "frp":
-                bind_port = server_spec.get("bind_port", 7000)
-                token = server_spec.get("token")
-                server_spec["mode"] = "server"
-                server_spec["bind_port"] = bind_port
-                if token:
-                    server_spec["token"] = token
-                
-                iran_node_ip = iran_node.node_metadata.get("ip_address")
-                if not iran_node_ip:
-                    logger.warning(f"Tunnel {tunnel.id}: Iran node has no IP address, skipping")
-                    continue
-                client_spec["mode"] = "client"
-                client_spec["server_addr"] = iran_node_ip
-                client_spec["server_port"] = bind_port
-                if token:
-                    client_spec["token"] = token
-                tunnel_type = tunnel.type.lower() if tunnel.type else "tcp"
-                if tunnel_type not in ["tcp", "udp"]:
-                    tunnel_type = "tcp"
-                client_spec["type"] = tunnel_type
-                local_ip = client_spec.get("local_ip") or iran_node_ip
-                local_port = client_spec.get("local_port") or bind_port
-                client_spec["local_ip"] = local_ip
-                client_spec["local_port"] = local_port
-            
-            elif core == "backhaul":
-                transport = server_spec.get("transport") or server_spec.get("type") or "tcp"
-                control_port = server_spec.get("control_port") or server_spec.get("listen_port") or 3080
-                public_port = server_spec.get("public_port") or server_spec.get("remote_port") or server_spec.get("listen_port")
-                target_host = server_spec.get("target_host", "127.0.0.1")
-                target_port = server_spec.get("target_port") or public_port
-                token = server_spec.get("token")
-                
-                if not public_port:
-                    logger.warning(f"Tunnel {tunnel.id}: Missing public_port, skipping")
-                    continue
-                
-                bind_ip = server_spec.get("bind_ip") or server_spec.get("listen_ip") or "0.0.0.0"
-                server_spec["bind_addr"] = f"{bind_ip}:{control_port}"
-                server_spec["transport"] = transport
-                server_spec["type"] = transport
-                if target_port:
-                    target_addr = f"{target_host}:{target_port}"
-                    server_spec["ports"] = [f"{public_port}={target_addr}"]
-                else:
-                    server_spec["ports"] = [str(public_port)]
-                if token:
-                    server_spec["token"] = token
-                
-                iran_node_ip = iran_node.node_metadata.get("ip_address")
-                if not iran_node_ip:
-                    logger.warning(f"Tunnel {tunnel.id}: Iran node has no IP address, skipping")
-                    continue
-                transport_lower = transport.lower()
-                if transport_lower in ("ws", "wsmux"):
-                    use_tls = bool(server_spec.get("tls_cert") or server_spec.get("server_options", {}).get("tls_cert"))
-                    protocol = "wss://" if use_tls else "ws://"
-                    client_spec["remote_addr"] = f"{protocol}{iran_node_ip}:{control_port}"
-                else:
-                    client_spec["remote_addr"] = f"{iran_node_ip}:{control_port}"
-                client_spec["transport"] = transport
-                client_spec["type"] = transport
-                if token:
-                    client_spec["token"] = token
+            try:
+                server_spec, client_spec, spec_updates = plan_reverse(tunnel, iran_node)
+            except PlanError as e:
+                logger.warning(f"Tunnel {tunnel.id}: {e}, skipping")
+                continue
+            if spec_updates:
+                tunnel.spec = {**tunnel.spec, **spec_updates}
+                await db.commit()
             
             if not iran_node.node_metadata.get("api_address"):
                 iran_node.node_metadata["api_address"] = f"http://{iran_node.node_metadata.get('ip_address', iran_node.fingerprint)}:{iran_node.node_metadata.get('api_port', 8888)}"
@@ -480,7 +338,9 @@ async def _reset_core(core: str, app_or_request, db: AsyncSession):
                     "tunnel_id": tunnel.id,
                     "core": core,
                     "type": tunnel.type,
-                    "spec": server_spec
+                    "spec": server_spec,
+                    # Same spec as the running one, so the node would skip it without force
+                    "force": True
                 }
             )
             
@@ -501,7 +361,8 @@ async def _reset_core(core: str, app_or_request, db: AsyncSession):
                     "tunnel_id": tunnel.id,
                     "core": core,
                     "type": tunnel.type,
-                    "spec": client_spec
+                    "spec": client_spec,
+                    "force": True
                 }
             )
             
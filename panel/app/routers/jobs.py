@@ -0,0 +1,60 @@
+"""Jobs API endpoints"""
+from fastapi import APIRouter, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from typing import Optional
+import asyncio
+import json
+
+from app.job_queue import job_queue, job_dict, FINISHED
+
+
+router = APIRouter()
+
+
+@router.get("")
+async def list_jobs(status: Optional[str] = None, limit: int = 50):
+    """List recent jobs, newest first"""
+    jobs = await job_queue.list_jobs(status=status, limit=min(max(limit, 1), 500))
+    return {"jobs": [job_dict(job) for job in jobs]}
+
+
+@router.get("/{job_id}")
+async def get_job(job_id: str):
+    """Get a job's status and result"""
+    job = await job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_dict(job)
+
+
+@router.get("/{job_id}/events")
+async def get_job_events(job_id: str, after: int = 0):
+    """Get a job's progress events after the given sequence number"""
+    job = await job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"job_id": job_id, "status": job.status, "events": await job_queue.events(job_id, after)}
+
+
+@router.get("/{job_id}/stream")
+async def stream_job_events(job_id: str, after: int = 0):
+    """Stream a job's progress events as server-sent events until it finishes"""
+    if not await job_queue.get(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def generate():
+        seq = after
+        while True:
+            # Read the status first: events are stored in the same commit that finishes the job
+            job = await job_queue.get(job_id)
+            for event in await job_queue.events(job_id, seq):
+                seq = event["seq"]
+                yield f"id: {seq}\nevent: progress\ndata: {json.dumps(jsonable_encoder(event))}\n\n"
+            if not job or job.status in FINISHED:
+                if job:
+                    yield f"event: done\ndata: {json.dumps(jsonable_encoder(job_dict(job)))}\n\n"
+                return
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
@@ -1,16 +1,22 @@
 """Nodes API endpoints"""
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 from pydantic import BaseModel
 import httpx
 import logging
 
-from app.database import get_db
+from app.database import get_db, get_read_db
 from app.models import Node, Settings
+from app.node_cache import node_cache
+from app.node_health import node_health
 from app.node_client import NodeClient
+from app.node_server import channel_secret
+from app.listing import CURSOR_HEADER, keyset, page_size, parse_fields, split_page
 
 logger = logging.getLogger(__name__)
 
@@ -76,10 +82,16 @@ async def create_node(node: NodeCreate, db: AsyncSession = Depends(get_db)):
         existing.status = "active"
         existing.node_metadata.update(metadata)
         existing.node_metadata["role"] = existing_role
+        existing.role = existing_role
+        existing.ip_address = node.ip_address
+        existing.api_address = metadata["api_address"]
         await db.commit()
         await db.refresh(existing)
+        node_cache.invalidate(existing.id)
+        node_health.mark_alive(existing.id)
         
         response_metadata = existing.node_metadata.copy() if existing.node_metadata else {}
+        response_metadata["channel_secret"] = channel_secret(existing.id)
         
         result = await db.execute(select(Settings).where(Settings.key == "frp"))
         frp_setting = result.scalar_one_or_none()
@@ -116,13 +128,18 @@ async def create_node(node: NodeCreate, db: AsyncSession = Depends(get_db)):
         name=node.name,
         fingerprint=fingerprint,
         status="active",
+        role=incoming_role,
+        ip_address=node.ip_address,
+        api_address=metadata["api_address"],
         node_metadata=metadata
     )
     db.add(db_node)
     await db.commit()
     await db.refresh(db_node)
+    node_cache.invalidate(db_node.id)
     
     response_metadata = db_node.node_metadata.copy() if db_node.node_metadata else {}
+    response_metadata["channel_secret"] = channel_secret(db_node.id)
     
     result = await db.execute(select(Settings).where(Settings.key == "frp"))
     frp_setting = result.scalar_one_or_none()
@@ -157,11 +174,37 @@ async def create_node(node: NodeCreate, db: AsyncSession = Depends(get_db)):
 
 
 @router.get("", response_model=List[NodeResponse])
-async def list_nodes(db: AsyncSession = Depends(get_db)):
-    """List all nodes with connection state"""
+async def list_nodes(
+    http_response: Response,
+    status: Optional[str] = None,
+    role: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(get_read_db)
+):
+    """List nodes with connection state, optionally filtered and paginated by cursor.
+    
+    With `limit`, the cursor for the next page is returned in the X-Next-Cursor
+    header. Nodes are only probed for their connection state when `metadata`
+    is among the requested `fields`.
+    """
     import asyncio
-    result = await db.execute(select(Node))
-    nodes = result.scalars().all()
+    projection = parse_fields(fields, NodeResponse.model_fields)
+    query = select(Node)
+    if status:
+        query = query.where(Node.status == status)
+    if role:
+        query = query.where(Node.role == role)
+    limit = page_size(limit)
+    query = keyset(query, Node.registered_at, Node.id, cursor, limit)
+    result = await db.execute(query)
+    nodes, next_cursor = split_page(result.scalars().all(), limit, "registered_at")
+    headers = {CURSOR_HEADER: next_cursor} if next_cursor else {}
+    
+    if projection and "metadata" not in projection:
+        items = [{name: getattr(node, name) for name in projection} for node in nodes]
+        return JSONResponse(content=jsonable_encoder(items), headers=headers)
     
     client = NodeClient()
     node_responses = []
@@ -231,11 +274,15 @@ async def list_nodes(db: AsyncSession = Depends(get_db)):
         else:
             results.append(response)
     
+    if projection:
+        items = [item.model_dump(include=set(projection)) for item in results]
+        return JSONResponse(content=jsonable_encoder(items), headers=headers)
+    http_response.headers.update(headers)
     return results
 
 
 @router.get("/{node_id}", response_model=NodeResponse)
-async def get_node(node_id: str, db: AsyncSession = Depends(get_db)):
+async def get_node(node_id: str, db: AsyncSession = Depends(get_read_db)):
     """Get node by ID"""
     result = await db.execute(select(Node).where(Node.id == node_id))
     node = result.scalar_one_or_none()
@@ -279,6 +326,7 @@ async def update_frp_status(node_id: str, frp_status: dict, db: AsyncSession = D
     
     await db.commit()
     await db.refresh(node)
+    node_cache.invalidate(node_id)
     return {"status": "success"}
 
 
@@ -292,5 +340,6 @@ async def delete_node(node_id: str, db: AsyncSession = Depends(get_db)):
     
     await db.delete(node)
     await db.commit()
+    node_cache.invalidate(node_id)
     return {"status": "deleted"}
 
@@ -7,6 +7,7 @@ from typing import Optional, Dict, Any, List
 from datetime import datetime
 from app.database import get_db, AsyncSessionLocal
 from app.models import Settings
+from app.node_cache import node_cache
 import logging
 
 logger = logging.getLogger(__name__)
@@ -102,6 +103,7 @@ async def update_settings(settings_update: SettingsUpdate, request: Request, db:
         
         await db.commit()
         await db.refresh(setting)
+        node_cache.invalidate_settings()
         
         if new_enabled and not old_enabled:
             try:
@@ -4,7 +4,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func
 import psutil
 
-from app.database import get_db
+from app.database import get_read_db
 from app.models import Tunnel, Node
 
 
@@ -84,7 +84,7 @@ async def get_version():
 
 
 @router.get("")
-async def get_status(db: AsyncSession = Depends(get_db)):
+async def get_status(db: AsyncSession = Depends(get_read_db)):
     """Get system status"""
     cpu_percent = psutil.cpu_percent(interval=1)
     memory = psutil.virtual_memory()
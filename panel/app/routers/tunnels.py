@@ -1,21 +1,35 @@
 """Tunnels API endpoints"""
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from typing import List
+from sqlalchemy import select, func, and_, or_, case, cast, exists, literal, Integer
+from typing import List, Optional
 from datetime import datetime
 from pydantic import BaseModel
+import asyncio
 import logging
-import time
 
-from app.database import get_db
+from app.database import get_db, get_read_db
 from app.models import Tunnel, Node
 from app.node_client import NodeClient
+from app.usage_collector import usage_collector
+from app.tunnel_enforcer import tunnel_enforcer
+from app.reapply_engine import reapply_engine
+from app.job_queue import job_queue
+from app.node_repository import node_repository
+from app.tunnel_specs import PlanError, gost_forward_ids, parse_ports_from_spec, plan_reverse
+from app.listing import CURSOR_HEADER, keyset, page_size, parse_fields, split_page
 
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Single-port spec keys matched by the `port` filter, besides the `ports` list
+SPEC_PORT_KEYS = ("listen_port", "remote_port", "public_port", "bind_port", "control_port")
+# Keys of object entries in `ports`, e.g. FRP's {"local": 8081, "remote": 8081}
+PORT_ENTRY_KEYS = ("local", "remote", "listen_port", "public_port")
+
 
 def prepare_frp_spec_for_node(spec: dict, node: Node, request: Request) -> dict:
     """Prepare FRP spec for node by determining correct server_addr from node metadata"""
@@ -101,6 +115,8 @@ class TunnelCreate(BaseModel):
 class TunnelUpdate(BaseModel):
     name: str | None = None
     spec: dict | None = None
+    quota_mb: float | None = None
+    expires_at: datetime | None = None
 
 
 class TunnelResponse(BaseModel):
@@ -117,6 +133,7 @@ class TunnelResponse(BaseModel):
     revision: int
     used_mb: float = 0.0
     quota_mb: float = 0.0
+    expires_at: datetime | None = None
     created_at: datetime
     updated_at: datetime
     
@@ -124,20 +141,14 @@ class TunnelResponse(BaseModel):
         from_attributes = True
 
 
-def parse_ports_from_spec(spec: dict) -> list:
-    """Parse ports from spec - supports both comma-separated string and list formats"""
-    ports = spec.get("ports", [])
-    if isinstance(ports, str):
-        # Comma-separated string: "8080,8081,8082"
-        ports = [int(p.strip()) for p in ports.split(",") if p.strip().isdigit()]
-    elif isinstance(ports, list) and ports:
-        # List of numbers or strings
-        ports = [int(p) if isinstance(p, (int, str)) and str(p).isdigit() else p for p in ports]
-    return ports if ports else []
+@router.post("", response_model=TunnelResponse)
+async def create_tunnel(tunnel: TunnelCreate, request: Request):
+    """Create a new tunnel; runs as a job (202 with Prefer: respond-async)"""
+    job = await job_queue.submit("tunnel.create", tunnel.model_dump(mode="json"), request)
+    return await job_queue.respond(job, request)
 
 
-@router.post("", response_model=TunnelResponse)
-async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession = Depends(get_db)):
+async def _create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession):
     """Create a new tunnel and auto-apply it"""
     from app.node_client import NodeClient
     
@@ -163,7 +174,7 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
             foreign_node = result.scalar_one_or_none()
             if not foreign_node:
                 raise HTTPException(status_code=404, detail=f"Foreign node {foreign_node_id_val} not found")
-            if foreign_node.node_metadata.get("role") != "foreign":
+            if foreign_node.role != "foreign":
                 raise HTTPException(status_code=400, detail=f"Node {foreign_node_id_val} is not a foreign node")
         
         iran_node_id_val = tunnel.iran_node_id if tunnel.iran_node_id and (not isinstance(tunnel.iran_node_id, str) or tunnel.iran_node_id.strip()) else None
@@ -172,7 +183,7 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
             iran_node = result.scalar_one_or_none()
             if not iran_node:
                 raise HTTPException(status_code=404, detail=f"Iran node {iran_node_id_val} not found")
-            if iran_node.node_metadata.get("role") != "iran":
+            if iran_node.role != "iran":
                 raise HTTPException(status_code=400, detail=f"Node {iran_node_id_val} is not an iran node")
         
         node_id_val = tunnel.node_id if tunnel.node_id and (not isinstance(tunnel.node_id, str) or tunnel.node_id.strip()) else None
@@ -182,24 +193,16 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
             if not provided_node:
                 raise HTTPException(status_code=404, detail="Node not found")
             
-            node_role = provided_node.node_metadata.get("role", "iran")
+            node_role = provided_node.role or "iran"
             if node_role == "foreign":
                 foreign_node = provided_node
-                result = await db.execute(select(Node))
-                all_nodes = result.scalars().all()
-                iran_nodes = [n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "iran"]
-                if iran_nodes:
-                    iran_node = iran_nodes[0]
-                else:
+                iran_node = await node_repository.first_with_role(db, "iran")
+                if not iran_node:
                     raise HTTPException(status_code=400, detail="No iran node found. Please specify iran_node_id or register an iran node.")
             else:
                 iran_node = provided_node
-                result = await db.execute(select(Node))
-                all_nodes = result.scalars().all()
-                foreign_nodes = [n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "foreign"]
-                if foreign_nodes:
-                    foreign_node = foreign_nodes[0]
-                else:
+                foreign_node = await node_repository.first_with_role(db, "foreign")
+                if not foreign_node:
                     raise HTTPException(status_code=400, detail="No foreign node found. Please specify foreign_node_id or register a foreign node.")
         
         if not foreign_node or not iran_node:
@@ -253,265 +256,18 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
         if is_reverse_tunnel and foreign_node and iran_node:
             client = NodeClient()
             
-            server_spec = db_tunnel.spec.copy() if db_tunnel.spec else {}
-            server_spec["mode"] = "server"
-            
-            if "ports" in db_tunnel.spec and "ports" not in server_spec:
-                server_spec["ports"] = db_tunnel.spec.get("ports", [])
-            
-            client_spec = db_tunnel.spec.copy() if db_tunnel.spec else {}
-            client_spec["mode"] = "client"
-            
-            if db_tunnel.core == "rathole":
-                transport = server_spec.get("transport") or server_spec.get("type") or "tcp"
-                token = server_spec.get("token")
-                if not token:
-                    from app.utils import generate_token
-                    token = generate_token()
-                    server_spec["token"] = token
-                    db_tunnel.spec["token"] = token
-                    from sqlalchemy.orm.attributes import flag_modified
-                    flag_modified(db_tunnel, "spec")
-                
-                ports = parse_ports_from_spec(db_tunnel.spec)
-                if not ports:
-                    proxy_port = server_spec.get("remote_port") or server_spec.get("listen_port")
-                    if proxy_port:
-                        ports = [int(proxy_port) if isinstance(proxy_port, (int, str)) and str(proxy_port).isdigit() else proxy_port]
-                
-                if not ports:
-                    db_tunnel.status = "error"
-                    db_tunnel.error_message = "Rathole requires ports"
-                    await db.commit()
-                    await db.refresh(db_tunnel)
-                    return db_tunnel
-                
-                remote_addr = server_spec.get("remote_addr", "0.0.0.0:23333")
-                from app.utils import parse_address_port
-                _, control_port, _ = parse_address_port(remote_addr)
-                if not control_port:
-                    import hashlib
-                    port_hash = int(hashlib.md5(db_tunnel.id.encode()).hexdigest()[:8], 16)
-                    control_port = 23333 + (port_hash % 1000)
-                server_spec["bind_addr"] = f"0.0.0.0:{control_port}"
-                server_spec["ports"] = ports
-                server_spec["transport"] = transport
-                server_spec["type"] = transport
-                if "websocket_tls" in server_spec:
-                    server_spec["websocket_tls"] = server_spec["websocket_tls"]
-                elif "tls" in server_spec:
-                    server_spec["websocket_tls"] = server_spec["tls"]
-                
-                iran_node_ip = iran_node.node_metadata.get("ip_address")
-                if not iran_node_ip:
-                    db_tunnel.status = "error"
-                    db_tunnel.error_message = "Iran node has no IP address"
-                    await db.commit()
-                    await db.refresh(db_tunnel)
-                    return db_tunnel
-                transport_lower = transport.lower()
-                if transport_lower in ("websocket", "ws"):
-                    use_tls = bool(server_spec.get("websocket_tls") or server_spec.get("tls"))
-                    protocol = "wss://" if use_tls else "ws://"
-                    client_spec["remote_addr"] = f"{protocol}{iran_node_ip}:{control_port}"
-                else:
-                    client_spec["remote_addr"] = f"{iran_node_ip}:{control_port}"
-                client_spec["transport"] = transport
-                client_spec["type"] = transport
-                client_spec["token"] = token
-                client_spec["ports"] = ports  # Pass ports to client
-                if "websocket_tls" in server_spec:
-                    client_spec["websocket_tls"] = server_spec["websocket_tls"]
-                elif "tls" in server_spec:
-                    client_spec["websocket_tls"] = server_spec["tls"]
-                
-            elif db_tunnel.core == "chisel":
-                ports = parse_ports_from_spec(db_tunnel.spec)
-                if not ports:
-                    listen_port = server_spec.get("listen_port") or server_spec.get("remote_port")
-                    if listen_port:
-                        ports = [int(listen_port) if isinstance(listen_port, (int, str)) and str(listen_port).isdigit() else listen_port]
-                
-                if not ports:
-                    db_tunnel.status = "error"
-                    db_tunnel.error_message = "Chisel requires ports"
-                    await db.commit()
-                    await db.refresh(db_tunnel)
-                    return db_tunnel
-                
-                iran_node_ip = iran_node.node_metadata.get("ip_address")
-                if not iran_node_ip:
-                    db_tunnel.status = "error"
-                    db_tunnel.error_message = "Iran node has no IP address"
-                    await db.commit()
-                    await db.refresh(db_tunnel)
-                    return db_tunnel
-                import hashlib
-                port_hash = int(hashlib.md5(db_tunnel.id.encode()).hexdigest()[:8], 16)
-                first_port = int(ports[0]) if isinstance(ports[0], (int, str)) and str(ports[0]).isdigit() else ports[0]
-                server_control_port = server_spec.get("control_port") or (int(first_port) + 10000 + (port_hash % 1000))
-                server_spec["server_port"] = server_control_port
-                server_spec["reverse_port"] = first_port
-                auth = server_spec.get("auth")
-                if not auth:
-                    from app.utils import generate_token
-                    auth = generate_token()
-                    server_spec["auth"] = auth
-                    db_tunnel.spec["auth"] = auth
-                    from sqlalchemy.orm.attributes import flag_modified
-                    flag_modified(db_tunnel, "spec")
-                server_spec["auth"] = auth
-                fingerprint = server_spec.get("fingerprint")
-                if fingerprint:
-                    server_spec["fingerprint"] = fingerprint
-                
-                client_spec["server_url"] = f"http://{iran_node_ip}:{server_control_port}"
-                client_spec["ports"] = ports
-                client_spec["auth"] = auth
-                if fingerprint:
-                    client_spec["fingerprint"] = fingerprint
-                
-            elif db_tunnel.core == "frp":
-                import hashlib
-                port_hash = int(hashlib.md5(db_tunnel.id.encode()).hexdigest()[:8], 16)
-                bind_port = server_spec.get("bind_port") or (7000 + (port_hash % 1000))
-                token = server_spec.get("token")
-                if not token:
-                    from app.utils import generate_token
-                    token = generate_token()
-                    server_spec["token"] = token
-                    db_tunnel.spec["token"] = token
-                    from sqlalchemy.orm.attributes import flag_modified
-                    flag_modified(db_tunnel, "spec")
-                server_spec["bind_port"] = bind_port
-                server_spec["token"] = token
-                
-                iran_node_ip = iran_node.node_metadata.get("ip_address")
-                if not iran_node_ip:
-                    db_tunnel.status = "error"
-                    db_tunnel.error_message = "Iran node has no IP address"
-                    await db.commit()
-                    await db.refresh(db_tunnel)
-                    return db_tunnel
-                client_spec["server_addr"] = iran_node_ip
-                client_spec["server_port"] = bind_port
-                client_spec["token"] = token
-                tunnel_type = db_tunnel.type.lower() if db_tunnel.type else "tcp"
-                if tunnel_type not in ["tcp", "udp"]:
-                    tunnel_type = "tcp"  # Default to tcp if invalid
-                client_spec["type"] = tunnel_type
-                local_ip = client_spec.get("local_ip") or iran_node_ip
-                
-                ports = parse_ports_from_spec(db_tunnel.spec)
-                if ports:
-                    client_spec["ports"] = [{"local": int(p), "remote": int(p)} for p in ports]
-                else:
-                    local_port = client_spec.get("local_port")
-                    if not local_port:
-                        local_port = db_tunnel.spec.get("listen_port") or db_tunnel.spec.get("remote_port") or bind_port
-                    client_spec["local_ip"] = local_ip
-                    client_spec["local_port"] = local_port
-                    if "remote_port" not in client_spec:
-                        client_spec["remote_port"] = db_tunnel.spec.get("remote_port") or db_tunnel.spec.get("listen_port") or bind_port
-                
-            elif db_tunnel.core == "backhaul":
-                transport = server_spec.get("transport") or server_spec.get("type") or "tcp"
-                import hashlib
-                port_hash = int(hashlib.md5(db_tunnel.id.encode()).hexdigest()[:8], 16)
-                control_port = server_spec.get("control_port") or server_spec.get("listen_port") or (3080 + (port_hash % 1000))
-                target_host = server_spec.get("target_host", "127.0.0.1")
-                token = server_spec.get("token")
-                if not token:
-                    from app.utils import generate_token
-                    token = generate_token()
-                    server_spec["token"] = token
-                    db_tunnel.spec["token"] = token
-                    from sqlalchemy.orm.attributes import flag_modified
-                    flag_modified(db_tunnel, "spec")
-                
-                ports = server_spec.get("ports", [])
-                if not ports:
-                    ports = db_tunnel.spec.get("ports", [])
-                logger.info(f"Backhaul tunnel {db_tunnel.id}: received ports from server_spec: {server_spec.get('ports')}, from db_tunnel.spec: {db_tunnel.spec.get('ports')}, final: {ports} (type: {type(ports)}, length: {len(ports) if isinstance(ports, list) else 'N/A'})")
-                
-                if not ports or (isinstance(ports, list) and len(ports) == 0):
-                    public_port = server_spec.get("public_port") or server_spec.get("remote_port") or server_spec.get("listen_port")
-                    target_port = server_spec.get("target_port") or public_port
-                    if not public_port:
-                        db_tunnel.status = "error"
-                        db_tunnel.error_message = "Backhaul requires ports array or public_port/remote_port"
-                        await db.commit()
-                        await db.refresh(db_tunnel)
-                        return db_tunnel
-                    if target_port:
-                        target_addr = f"{target_host}:{target_port}"
-                        ports = [f"{public_port}={target_addr}"]
-                    else:
-                        ports = [str(public_port)]
-                else:
-                    if isinstance(ports, list) and ports:
-                        processed_ports = []
-                        for p in ports:
-                            if not p:
-                                continue
-                            if isinstance(p, str):
-                                if '=' in p:
-                                    processed_ports.append(p)
-                                elif p.isdigit():
-                                    processed_ports.append(f"{p}={target_host}:{p}")
-                                else:
-                                    processed_ports.append(p)
-                            elif isinstance(p, int):
-                                processed_ports.append(f"{p}={target_host}:{p}")
-                            elif isinstance(p, dict):
-                                local = p.get("local") or p.get("listen_port") or p.get("public_port")
-                                tgt_host = p.get("target_host") or target_host
-                                tgt_port = p.get("target_port") or p.get("remote_port") or local
-                                if local:
-                                    processed_ports.append(f"{local}={tgt_host}:{tgt_port}")
-                            else:
-                                processed_ports.append(str(p))
-                        ports = processed_ports
-                
-                logger.info(f"Backhaul tunnel {db_tunnel.id}: processed ports: {ports} (count: {len(ports)})")
-                
-                bind_ip = server_spec.get("bind_ip") or server_spec.get("listen_ip") or "0.0.0.0"
-                server_spec["bind_addr"] = f"{bind_ip}:{control_port}"
-                server_spec["transport"] = transport
-                server_spec["type"] = transport
-                server_spec["ports"] = ports
-                server_spec["mode"] = "server"
-                server_spec["token"] = token
-                
-                # CRITICAL: Update the database spec with processed ports so they're preserved
-                if "ports" not in db_tunnel.spec:
-                    db_tunnel.spec["ports"] = []
-                db_tunnel.spec["ports"] = ports.copy() if isinstance(ports, list) else ports
-                from sqlalchemy.orm.attributes import flag_modified
-                flag_modified(db_tunnel, "spec")
+            try:
+                server_spec, client_spec, spec_updates = plan_reverse(db_tunnel, iran_node)
+            except PlanError as e:
+                db_tunnel.status = "error"
+                db_tunnel.error_message = str(e)
+                await db.commit()
+                await db.refresh(db_tunnel)
+                return db_tunnel
+            if spec_updates:
+                db_tunnel.spec = {**db_tunnel.spec, **spec_updates}
                 await db.commit()
                 await db.refresh(db_tunnel)
-                logger.info(f"Backhaul tunnel {db_tunnel.id}: saved ports to database: {db_tunnel.spec.get('ports')} (count: {len(db_tunnel.spec.get('ports', []))})")
-                
-                iran_node_ip = iran_node.node_metadata.get("ip_address")
-                if not iran_node_ip:
-                    db_tunnel.status = "error"
-                    db_tunnel.error_message = "Iran node has no IP address"
-                    await db.commit()
-                    await db.refresh(db_tunnel)
-                    return db_tunnel
-                transport_lower = transport.lower()
-                if transport_lower in ("ws", "wsmux"):
-                    use_tls = bool(server_spec.get("tls_cert") or server_spec.get("server_options", {}).get("tls_cert"))
-                    protocol = "wss://" if use_tls else "ws://"
-                    client_spec["remote_addr"] = f"{protocol}{iran_node_ip}:{control_port}"
-                else:
-                    client_spec["remote_addr"] = f"{iran_node_ip}:{control_port}"
-                client_spec["transport"] = transport
-                client_spec["type"] = transport
-                client_spec["mode"] = "client"  # Ensure mode is set
-                if token:
-                    client_spec["token"] = token
             
             if not iran_node.node_metadata.get("api_address"):
                 iran_node.node_metadata["api_address"] = f"http://{iran_node.node_metadata.get('ip_address', iran_node.fingerprint)}:{iran_node.node_metadata.get('api_port', 8888)}"
@@ -606,7 +362,8 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
             if remote_addr and token and proxy_port and hasattr(request.app.state, 'rathole_server_manager'):
                 try:
                     logger.info(f"Starting Rathole server for tunnel {db_tunnel.id}: remote_addr={remote_addr}, token={token}, proxy_port={proxy_port}, use_ipv6={use_ipv6}")
-                    request.app.state.rathole_server_manager.start_server(
+                    await asyncio.to_thread(
+                        request.app.state.rathole_server_manager.start_server,
                         tunnel_id=db_tunnel.id,
                         remote_addr=remote_addr,
                         token=token,
@@ -667,14 +424,15 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
                     else:
                         server_control_port = int(listen_port) + 10000
                     logger.info(f"Starting Chisel server for tunnel {db_tunnel.id}: server_control_port={server_control_port}, reverse_port={listen_port}, auth={auth is not None}, fingerprint={fingerprint is not None}, use_ipv6={use_ipv6}")
-                    request.app.state.chisel_server_manager.start_server(
+                    await asyncio.to_thread(
+                        request.app.state.chisel_server_manager.start_server,
                         tunnel_id=db_tunnel.id,
                         server_port=server_control_port,
                         auth=auth,
                         fingerprint=fingerprint,
                         use_ipv6=bool(use_ipv6)
                     )
-                    time.sleep(1.0)
+                    await asyncio.sleep(1.0)
                     if not request.app.state.chisel_server_manager.is_running(db_tunnel.id):
                         raise RuntimeError("Chisel server process started but is not running")
                     chisel_started = True
@@ -720,12 +478,13 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
             if bind_port and hasattr(request.app.state, 'frp_server_manager'):
                 try:
                     logger.info(f"Starting FRP server for tunnel {db_tunnel.id}: bind_port={bind_port}, token={'set' if token else 'none'}")
-                    request.app.state.frp_server_manager.start_server(
+                    await asyncio.to_thread(
+                        request.app.state.frp_server_manager.start_server,
                         tunnel_id=db_tunnel.id,
                         bind_port=int(bind_port),
                         token=token
                     )
-                    time.sleep(1.0)
+                    await asyncio.sleep(1.0)
                     if not request.app.state.frp_server_manager.is_running(db_tunnel.id):
                         raise RuntimeError("FRP server process started but is not running")
                     frp_started = True
@@ -843,22 +602,22 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
                 logger.error(f"Tunnel {db_tunnel.id}: {error_msg}")
                 if needs_rathole_server and hasattr(request.app.state, 'rathole_server_manager'):
                     try:
-                        request.app.state.rathole_server_manager.stop_server(db_tunnel.id)
+                        await asyncio.to_thread(request.app.state.rathole_server_manager.stop_server, db_tunnel.id)
                     except:
                         pass
                 if needs_backhaul_server and hasattr(request.app.state, "backhaul_manager"):
                     try:
-                        request.app.state.backhaul_manager.stop_server(db_tunnel.id)
+                        await asyncio.to_thread(request.app.state.backhaul_manager.stop_server, db_tunnel.id)
                     except Exception:
                         pass
                 if needs_chisel_server and hasattr(request.app.state, 'chisel_server_manager'):
                     try:
-                        request.app.state.chisel_server_manager.stop_server(db_tunnel.id)
+                        await asyncio.to_thread(request.app.state.chisel_server_manager.stop_server, db_tunnel.id)
                     except Exception:
                         pass
                 if needs_frp_server and hasattr(request.app.state, 'frp_server_manager'):
                     try:
-                        request.app.state.frp_server_manager.stop_server(db_tunnel.id)
+                        await asyncio.to_thread(request.app.state.frp_server_manager.stop_server, db_tunnel.id)
                     except Exception:
                         pass
                 await db.commit()
@@ -871,22 +630,22 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
                 logger.error(f"Tunnel {db_tunnel.id}: Failed to apply to node")
                 if needs_rathole_server and hasattr(request.app.state, 'rathole_server_manager'):
                     try:
-                        request.app.state.rathole_server_manager.stop_server(db_tunnel.id)
+                        await asyncio.to_thread(request.app.state.rathole_server_manager.stop_server, db_tunnel.id)
                     except:
                         pass
                 if needs_backhaul_server and hasattr(request.app.state, "backhaul_manager"):
                     try:
-                        request.app.state.backhaul_manager.stop_server(db_tunnel.id)
+                        await asyncio.to_thread(request.app.state.backhaul_manager.stop_server, db_tunnel.id)
                     except Exception:
                         pass
                 if needs_chisel_server and hasattr(request.app.state, 'chisel_server_manager'):
                     try:
-                        request.app.state.chisel_server_manager.stop_server(db_tunnel.id)
+                        await asyncio.to_thread(request.app.state.chisel_server_manager.stop_server, db_tunnel.id)
                     except Exception:
                         pass
                 if needs_frp_server and hasattr(request.app.state, 'frp_server_manager'):
                     try:
-                        request.app.state.frp_server_manager.stop_server(db_tunnel.id)
+                        await asyncio.to_thread(request.app.state.frp_server_manager.stop_server, db_tunnel.id)
                     except Exception:
                         pass
                 await db.commit()
@@ -920,7 +679,7 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
                         await db.refresh(db_tunnel)
                         return db_tunnel
                     
-                    foreign_ip = foreign_node.node_metadata.get("ip_address")
+                    foreign_ip = foreign_node.ip_address
                     if not foreign_ip:
                         db_tunnel.status = "error"
                         db_tunnel.error_message = "Foreign server has no IP address"
@@ -1008,7 +767,8 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
                                 
                                 tunnel_id_for_port = f"{db_tunnel.id}_{port_num}" if len(ports) > 1 else db_tunnel.id
                                 logger.info(f"Starting gost forwarding on panel for tunnel {db_tunnel.id}: {db_tunnel.type}://:{port_num} -> {forward_to_port}, use_ipv6={use_ipv6}")
-                                request.app.state.gost_forwarder.start_forward(
+                                await asyncio.to_thread(
+                                    request.app.state.gost_forwarder.start_forward,
                                     tunnel_id=tunnel_id_for_port,
                                     local_port=port_num,
                                     forward_to=forward_to_port,
@@ -1016,7 +776,6 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
                                     use_ipv6=bool(use_ipv6)
                                 )
                             
-                            time.sleep(2)
                             logger.info(f"Successfully started gost forwarding on panel for tunnel {db_tunnel.id} with {len(ports)} ports")
                         except Exception as e:
                             error_msg = str(e)
@@ -1052,30 +811,98 @@ async def create_tunnel(tunnel: TunnelCreate, request: Request, db: AsyncSession
         db_tunnel.error_message = f"Tunnel creation error: {error_msg}"
         try:
             if needs_rathole_server and hasattr(request.app.state, "rathole_server_manager"):
-                request.app.state.rathole_server_manager.stop_server(db_tunnel.id)
+                await asyncio.to_thread(request.app.state.rathole_server_manager.stop_server, db_tunnel.id)
         except Exception:
             pass
         try:
             if needs_backhaul_server and hasattr(request.app.state, "backhaul_manager"):
-                request.app.state.backhaul_manager.stop_server(db_tunnel.id)
+                await asyncio.to_thread(request.app.state.backhaul_manager.stop_server, db_tunnel.id)
         except Exception:
             pass
         await db.commit()
         await db.refresh(db_tunnel)
     
+    tunnel_enforcer.track(db_tunnel)
     return db_tunnel
 
 
+def port_filter(port: int):
+    """Match tunnels exposing or controlled through `port`, whether it sits in `ports` or a single port key.
+
+    `ports` may be a list of numbers, numeric or "public=host:target" strings
+    and objects, or one comma-separated string such as "8080,8081".
+    """
+    ports = func.json_each(Tunnel.spec, "$.ports").table_valued("value", "type").alias("spec_ports")
+    entry = ports.c.value
+    entry_matches = [
+        cast(entry, Integer) == port,
+        and_(
+            ports.c.type == "text",
+            literal(",").concat(func.replace(entry, " ", "")).concat(",").like(f"%,{port},%"),
+        ),
+        *[
+            cast(case((ports.c.type == "object", func.json_extract(entry, f"$.{key}"))), Integer) == port
+            for key in PORT_ENTRY_KEYS
+        ],
+    ]
+    return or_(
+        *[cast(func.json_extract(Tunnel.spec, f"$.{key}"), Integer) == port for key in SPEC_PORT_KEYS],
+        exists(select(literal(1)).select_from(ports).where(or_(*entry_matches))),
+    )
+
+
 @router.get("", response_model=List[TunnelResponse])
-async def list_tunnels(db: AsyncSession = Depends(get_db)):
-    """List all tunnels"""
-    result = await db.execute(select(Tunnel))
-    tunnels = result.scalars().all()
-    return tunnels
+async def list_tunnels(
+    http_response: Response,
+    core: Optional[str] = None,
+    status: Optional[str] = None,
+    node: Optional[str] = None,
+    tunnel_type: Optional[str] = Query(None, alias="type"),
+    port: Optional[int] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(get_read_db)
+):
+    """List tunnels, optionally filtered and paginated by cursor.
+    
+    With `limit`, the cursor for the next page is returned in the X-Next-Cursor
+    header. `fields=id,name,status` returns only those fields, so the spec
+    JSON is neither read nor sent.
+    """
+    projection = parse_fields(fields, TunnelResponse.model_fields)
+    if projection:
+        columns = dict.fromkeys(projection + ["created_at"])
+        query = select(*[getattr(Tunnel, name) for name in columns])
+    else:
+        query = select(Tunnel)
+    
+    if core:
+        query = query.where(Tunnel.core == core)
+    if status:
+        query = query.where(Tunnel.status == status)
+    if tunnel_type:
+        query = query.where(Tunnel.type == tunnel_type)
+    if node:
+        query = query.where(or_(Tunnel.node_id == node, Tunnel.foreign_node_id == node, Tunnel.iran_node_id == node))
+    if port is not None:
+        query = query.where(port_filter(port))
+    
+    limit = page_size(limit)
+    query = keyset(query, Tunnel.created_at, Tunnel.id, cursor, limit)
+    result = await db.execute(query)
+    rows, next_cursor = split_page(result.all() if projection else result.scalars().all(), limit, "created_at")
+    headers = {CURSOR_HEADER: next_cursor} if next_cursor else {}
+    
+    if projection:
+        items = [{name: getattr(row, name) for name in projection} for row in rows]
+        return JSONResponse(content=jsonable_encoder(items), headers=headers)
+    http_response.headers.update(headers)
+    return rows
 
 
 @router.get("/{tunnel_id}", response_model=TunnelResponse)
-async def get_tunnel(tunnel_id: str, db: AsyncSession = Depends(get_db)):
+async def get_tunnel(tunnel_id: str, db: AsyncSession = Depends(get_read_db)):
     """Get tunnel by ID"""
     result = await db.execute(select(Tunnel).where(Tunnel.id == tunnel_id))
     tunnel = result.scalar_one_or_none()
@@ -1084,13 +911,45 @@ async def get_tunnel(tunnel_id: str, db: AsyncSession = Depends(get_db)):
     return tunnel
 
 
-@router.put("/{tunnel_id}", response_model=TunnelResponse)
-async def update_tunnel(
+@router.get("/{tunnel_id}/usage")
+async def get_tunnel_usage(
     tunnel_id: str,
-    tunnel_update: TunnelUpdate,
-    request: Request,
-    db: AsyncSession = Depends(get_db)
+    resolution: str = "hour",
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_read_db)
 ):
+    """Get bucketed traffic usage for a tunnel"""
+    if resolution not in ("minute", "hour", "day"):
+        raise HTTPException(status_code=400, detail="resolution must be one of: minute, hour, day")
+    result = await db.execute(select(Tunnel.used_mb, Tunnel.quota_mb).where(Tunnel.id == tunnel_id))
+    row = result.first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Tunnel not found")
+    
+    buckets = await usage_collector.get_usage(tunnel_id, resolution, since, until)
+    return {
+        "tunnel_id": tunnel_id,
+        "resolution": resolution,
+        "used_mb": row.used_mb or 0,
+        "quota_mb": row.quota_mb or 0,
+        "buckets": [{"bucket": bucket, "bytes": bytes_used} for bucket, bytes_used in buckets]
+    }
+
+
+@router.put("/{tunnel_id}", response_model=TunnelResponse)
+async def update_tunnel(tunnel_id: str, tunnel_update: TunnelUpdate, request: Request):
+    """Update a tunnel; runs as a job (202 with Prefer: respond-async)"""
+    job = await job_queue.submit(
+        "tunnel.update",
+        {"tunnel_id": tunnel_id, "update": tunnel_update.model_dump(mode="json", exclude_unset=True)},
+        request,
+        key=f"tunnel:{tunnel_id}",
+    )
+    return await job_queue.respond(job, request)
+
+
+async def _update_tunnel(tunnel_id: str, tunnel_update: TunnelUpdate, request: Request, db: AsyncSession):
     """Update a tunnel and re-apply if spec changed"""
     from app.node_client import NodeClient
     
@@ -1100,6 +959,8 @@ async def update_tunnel(
         raise HTTPException(status_code=404, detail="Tunnel not found")
     
     spec_changed = tunnel_update.spec is not None and tunnel_update.spec != tunnel.spec
+    # Forwards started for the old spec, which may have used other ports
+    previous_forward_ids = gost_forward_ids(tunnel)
     
     if tunnel_update.name is not None:
         tunnel.name = tunnel_update.name
@@ -1110,6 +971,10 @@ async def update_tunnel(
             ports = tunnel_update.spec.get("ports", [])
             logger.info(f"Backhaul tunnel update {tunnel_id}: preserving ports from update: {ports} (count: {len(ports) if isinstance(ports, list) else 'N/A'})")
         tunnel.spec = tunnel_update.spec
+    if tunnel_update.quota_mb is not None:
+        tunnel.quota_mb = tunnel_update.quota_mb
+    if tunnel_update.expires_at is not None:
+        tunnel.expires_at = tunnel_update.expires_at
     
     tunnel.revision += 1
     tunnel.updated_at = datetime.utcnow()
@@ -1122,10 +987,6 @@ async def update_tunnel(
     if spec_changed:
         try:
             needs_gost_forwarding = tunnel.type in ["tcp", "udp", "ws", "grpc", "tcpmux"] and tunnel.core == "gost"
-            needs_rathole_server = tunnel.core == "rathole"
-            needs_backhaul_server = tunnel.core == "backhaul"
-            needs_chisel_server = tunnel.core == "chisel"
-            needs_frp_server = tunnel.core == "frp"
             needs_node_apply = tunnel.core in {"rathole", "backhaul", "chisel", "frp"}
             
             if needs_gost_forwarding:
@@ -1143,10 +1004,12 @@ async def update_tunnel(
                 
                 if panel_port and forward_to and hasattr(request.app.state, 'gost_forwarder'):
                     try:
-                        request.app.state.gost_forwarder.stop_forward(tunnel.id)
-                        time.sleep(0.5)
+                        for forward_id in previous_forward_ids:
+                            await asyncio.to_thread(request.app.state.gost_forwarder.stop_forward, forward_id)
+                        await asyncio.sleep(0.5)
                         logger.info(f"Restarting gost forwarding for tunnel {tunnel.id}: {tunnel.type}://:{panel_port} -> {forward_to}, use_ipv6={use_ipv6}")
-                        request.app.state.gost_forwarder.start_forward(
+                        await asyncio.to_thread(
+                            request.app.state.gost_forwarder.start_forward,
                             tunnel_id=tunnel.id,
                             local_port=int(panel_port),
                             forward_to=forward_to,
@@ -1166,113 +1029,19 @@ async def update_tunnel(
                         tunnel.status = "error"
                         tunnel.error_message = "forward_to is required for gost tunnels"
             
-            elif needs_rathole_server:
-                if hasattr(request.app.state, 'rathole_server_manager'):
-                    remote_addr = tunnel.spec.get("remote_addr")
-                    token = tunnel.spec.get("token")
-                    proxy_port = tunnel.spec.get("remote_port") or tunnel.spec.get("listen_port")
-                    
-                    if remote_addr and token and proxy_port:
-                        try:
-                            request.app.state.rathole_server_manager.stop_server(tunnel.id)
-                            request.app.state.rathole_server_manager.start_server(
-                                tunnel_id=tunnel.id,
-                                remote_addr=remote_addr,
-                                token=token,
-                                proxy_port=int(proxy_port)
-                            )
-                            tunnel.status = "active"
-                            tunnel.error_message = None
-                        except Exception as e:
-                            logger.error(f"Failed to restart Rathole server: {e}")
-                            tunnel.status = "error"
-                            tunnel.error_message = f"Rathole server error: {str(e)}"
-            elif needs_backhaul_server:
-                manager = getattr(request.app.state, "backhaul_manager", None)
-                if manager:
-                    try:
-                        manager.stop_server(tunnel.id)
-                    except Exception:
-                        pass
-                    try:
-                        manager.start_server(tunnel.id, tunnel.spec or {})
-                        time.sleep(1.0)
-                        if not manager.is_running(tunnel.id):
-                            raise RuntimeError("Backhaul process not running")
-                        tunnel.status = "active"
-                        tunnel.error_message = None
-                    except Exception as exc:
-                        logger.error("Failed to restart Backhaul server for tunnel %s: %s", tunnel.id, exc, exc_info=True)
-                        tunnel.status = "error"
-                        tunnel.error_message = f"Backhaul server error: {exc}"
-            elif needs_chisel_server:
-                if hasattr(request.app.state, 'chisel_server_manager'):
-                    server_port = tunnel.spec.get("control_port") or (int(tunnel.spec.get("listen_port", 0)) + 10000)
-                    auth = tunnel.spec.get("auth") or tunnel.spec.get("token")
-                    fingerprint = tunnel.spec.get("fingerprint")
-                    use_ipv6 = tunnel.spec.get("use_ipv6", False)
-                    
-                    if server_port and auth and fingerprint:
-                        try:
-                            request.app.state.chisel_server_manager.stop_server(tunnel.id)
-                            request.app.state.chisel_server_manager.start_server(
-                                tunnel_id=tunnel.id,
-                                server_port=int(server_port),
-                                auth=auth,
-                                fingerprint=fingerprint,
-                                use_ipv6=bool(use_ipv6)
-                            )
-                            tunnel.status = "active"
-                            tunnel.error_message = None
-                        except Exception as e:
-                            logger.error(f"Failed to restart Chisel server: {e}")
-                            tunnel.status = "error"
-                            tunnel.error_message = f"Chisel server error: {str(e)}"
-            elif needs_frp_server:
-                if hasattr(request.app.state, 'frp_server_manager'):
-                    bind_port = tunnel.spec.get("bind_port", 7000)
-                    token = tunnel.spec.get("token")
-                    
-                    if bind_port:
-                        try:
-                            request.app.state.frp_server_manager.stop_server(tunnel.id)
-                            request.app.state.frp_server_manager.start_server(
-                                tunnel_id=tunnel.id,
-                                bind_port=int(bind_port),
-                                token=token
-                            )
-                            time.sleep(1.0)
-                            if not request.app.state.frp_server_manager.is_running(tunnel.id):
-                                raise RuntimeError("FRP server process not running")
-                            tunnel.status = "active"
-                            tunnel.error_message = None
-                        except Exception as e:
-                            logger.error(f"Failed to restart FRP server: {e}")
-                            tunnel.status = "error"
-                            tunnel.error_message = f"FRP server error: {str(e)}"
-            
-            if needs_node_apply and tunnel.node_id:
-                result = await db.execute(select(Node).where(Node.id == tunnel.node_id))
-                node = result.scalar_one_or_none()
-                if node:
-                    client = NodeClient()
+            elif needs_node_apply:
+                # Reverse tunnels run on the nodes: server side on the iran node, client on the foreign node
+                iran_node, foreign_node = await node_repository.reverse_nodes(db, tunnel)
+                if not iran_node or not foreign_node:
+                    tunnel.status = "error"
+                    tunnel.error_message = f"Both foreign and iran nodes are required for {tunnel.core.title()} tunnels"
+                else:
                     try:
-                        spec_for_node = tunnel.spec.copy() if tunnel.spec else {}
-                        frp_prep_failed = False
-                        if tunnel.core == "frp":
-                            try:
-                                spec_for_node = prepare_frp_spec_for_node(spec_for_node, node, request)
-                                logger.info(f"FRP spec prepared for tunnel {tunnel.id}: server_addr={spec_for_node.get('server_addr')}")
-                            except Exception as e:
-                                error_msg = f"Failed to prepare FRP spec: {str(e)}"
-                                logger.error(f"Tunnel {tunnel.id}: {error_msg}", exc_info=True)
-                                tunnel.status = "error"
-                                tunnel.error_message = f"FRP configuration error: {error_msg}"
-                                await db.commit()
-                                await db.refresh(tunnel)
-                                frp_prep_failed = True
-                        
-                        if not frp_prep_failed:
+                        server_spec, client_spec, spec_updates = plan_reverse(tunnel, iran_node)
+                        if spec_updates:
+                            tunnel.spec = {**tunnel.spec, **spec_updates}
+                        client = NodeClient()
+                        for node, side_spec, side in ((iran_node, server_spec, "Iran"), (foreign_node, client_spec, "Foreign")):
                             response = await client.send_to_node(
                                 node_id=node.id,
                                 endpoint="/api/agent/tunnels/apply",
@@ -1280,30 +1049,20 @@ async def update_tunnel(
                                     "tunnel_id": tunnel.id,
                                     "core": tunnel.core,
                                     "type": tunnel.type,
-                                    "spec": spec_for_node
+                                    "spec": side_spec
                                 }
                             )
-                            
-                            if response.get("status") == "success":
-                                tunnel.status = "active"
-                                tunnel.error_message = None
-                            else:
-                                tunnel.status = "error"
-                                tunnel.error_message = f"Node error: {response.get('message', 'Unknown error')}"
-                                if needs_backhaul_server and hasattr(request.app.state, "backhaul_manager"):
-                                    try:
-                                        request.app.state.backhaul_manager.stop_server(tunnel.id)
-                                    except Exception:
-                                        pass
+                            if response.get("status") != "success":
+                                raise RuntimeError(f"{side} node error: {response.get('message', 'Unknown error')}")
+                        tunnel.status = "active"
+                        tunnel.error_message = None
+                    except PlanError as e:
+                        tunnel.status = "error"
+                        tunnel.error_message = str(e)
                     except Exception as e:
-                        logger.error(f"Failed to re-apply tunnel to node: {e}")
+                        logger.error(f"Failed to re-apply tunnel {tunnel.id} to nodes: {e}")
                         tunnel.status = "error"
                         tunnel.error_message = f"Node error: {str(e)}"
-                        if needs_backhaul_server and hasattr(request.app.state, "backhaul_manager"):
-                            try:
-                                request.app.state.backhaul_manager.stop_server(tunnel.id)
-                            except Exception:
-                                pass
             
             await db.commit()
             await db.refresh(tunnel)
@@ -1314,6 +1073,7 @@ async def update_tunnel(
             await db.commit()
             await db.refresh(tunnel)
     
+    tunnel_enforcer.track(tunnel)
     return tunnel
 
 
@@ -1332,248 +1092,27 @@ async def apply_tunnel(tunnel_id: str, request: Request, db: AsyncSession = Depe
     iran_node = None
     
     if is_reverse_tunnel:
-        iran_node_id = tunnel.node_id
-        result = await db.execute(select(Node).where(Node.id == iran_node_id))
-        iran_node = result.scalar_one_or_none()
+        iran_node, foreign_node = await node_repository.reverse_nodes(db, tunnel)
         if not iran_node:
-            raise HTTPException(status_code=404, detail=f"Iran node {iran_node_id} not found")
-        
-        result = await db.execute(select(Node))
-        all_nodes = result.scalars().all()
-        foreign_nodes = [n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "foreign"]
-        if not foreign_nodes:
+            raise HTTPException(status_code=404, detail=f"Iran node {tunnel.iran_node_id or tunnel.node_id} not found")
+        if not foreign_node:
             raise HTTPException(status_code=404, detail="No foreign node found. Please ensure at least one node has role='foreign' (set NODE_ROLE=foreign on the foreign node).")
-        foreign_node = foreign_nodes[0]
         
-        if iran_node.node_metadata.get("role") != "iran":
-            raise HTTPException(status_code=400, detail=f"Node {iran_node.id} is not an iran node (role={iran_node.node_metadata.get('role')}). Set NODE_ROLE=iran on the Iran node.")
-        if foreign_node.node_metadata.get("role") != "foreign":
-            raise HTTPException(status_code=400, detail=f"Node {foreign_node.id} is not a foreign node (role={foreign_node.node_metadata.get('role')}). Set NODE_ROLE=foreign on the foreign node.")
+        if iran_node.role != "iran":
+            raise HTTPException(status_code=400, detail=f"Node {iran_node.id} is not an iran node (role={iran_node.role}). Set NODE_ROLE=iran on the Iran node.")
         
         if foreign_node and iran_node:
             try:
-                spec = tunnel.spec.copy() if tunnel.spec else {}
-                
-                if tunnel.core == "backhaul":
-                    transport = spec.get("transport", "tcp")
-                    control_port = spec.get("control_port") or spec.get("public_port") or spec.get("listen_port") or 3080
-                    public_port = spec.get("public_port") or spec.get("listen_port") or control_port
-                    target_host = spec.get("target_host", "127.0.0.1")
-                    token = spec.get("token")
-                    
-                    server_spec = spec.copy()
-                    server_spec["bind_addr"] = f"0.0.0.0:{control_port}"
-                    server_spec["control_port"] = control_port
-                    server_spec["public_port"] = public_port
-                    server_spec["listen_port"] = public_port
-                    
-                    # IMPORTANT: Read ports from spec (which is tunnel.spec.copy()) first
-                    ports = spec.get("ports", [])
-                    if not ports:
-                        ports = tunnel.spec.get("ports", [])
-                    if ports:
-                        server_spec["ports"] = ports
-                    logger.info(f"Backhaul tunnel update {tunnel.id}: received ports from spec: {spec.get('ports')}, from tunnel.spec: {tunnel.spec.get('ports')}, final: {ports} (type: {type(ports)}, length: {len(ports) if isinstance(ports, list) else 'N/A'})")
-                    
-                    if not ports or (isinstance(ports, list) and len(ports) == 0):
-                        target_port = spec.get("target_port") or public_port
-                        if target_port:
-                            target_addr = f"{target_host}:{target_port}"
-                            ports = [f"{public_port}={target_addr}"]
-                        else:
-                            ports = [str(public_port)]
-                    else:
-                        if isinstance(ports, list) and ports:
-                            processed_ports = []
-                            for p in ports:
-                                if not p:
-                                    continue
-                                if isinstance(p, str):
-                                    if '=' in p:
-                                        processed_ports.append(p)
-                                    elif p.isdigit():
-                                        processed_ports.append(f"{p}={target_host}:{p}")
-                                    else:
-                                        processed_ports.append(p)
-                                elif isinstance(p, int):
-                                    processed_ports.append(f"{p}={target_host}:{p}")
-                                elif isinstance(p, dict):
-                                    local = p.get("local") or p.get("listen_port") or p.get("public_port")
-                                    tgt_host = p.get("target_host") or target_host
-                                    tgt_port = p.get("target_port") or p.get("remote_port") or local
-                                    if local:
-                                        processed_ports.append(f"{local}={tgt_host}:{tgt_port}")
-                                else:
-                                    processed_ports.append(str(p))
-                            ports = processed_ports
-                    
-                    logger.info(f"Backhaul tunnel update {tunnel.id}: processed ports: {ports} (count: {len(ports)})")
-                    server_spec["ports"] = ports
-                    server_spec["mode"] = "server"  # Ensure mode is set
-                    if token:
-                        server_spec["token"] = token
-                    
-                    # CRITICAL: Update the database spec with processed ports so they're preserved
-                    if "ports" not in tunnel.spec:
-                        tunnel.spec["ports"] = []
-                    tunnel.spec["ports"] = ports.copy() if isinstance(ports, list) else ports
-                    from sqlalchemy.orm.attributes import flag_modified
-                    flag_modified(tunnel, "spec")
+                try:
+                    server_spec, client_spec, spec_updates = plan_reverse(tunnel, iran_node)
+                except PlanError as e:
+                    tunnel.status = "error"
+                    tunnel.error_message = str(e)
+                    await db.commit()
+                    raise HTTPException(status_code=400, detail=str(e))
+                if spec_updates:
+                    tunnel.spec = {**tunnel.spec, **spec_updates}
                     await db.commit()
-                    await db.refresh(tunnel)
-                    logger.info(f"Backhaul tunnel update {tunnel.id}: saved ports to database: {tunnel.spec.get('ports')} (count: {len(tunnel.spec.get('ports', []))})")
-                    
-                    client_spec = spec.copy()
-                    iran_node_ip = iran_node.node_metadata.get("ip_address")
-                    if not iran_node_ip:
-                        tunnel.status = "error"
-                        tunnel.error_message = "Iran node has no IP address"
-                        await db.commit()
-                        raise HTTPException(status_code=400, detail="Iran node has no IP address")
-                    
-                    transport_lower = transport.lower()
-                    if transport_lower in ("ws", "wsmux"):
-                        use_tls = bool(server_spec.get("tls_cert") or server_spec.get("server_options", {}).get("tls_cert"))
-                        protocol = "wss://" if use_tls else "ws://"
-                        client_spec["remote_addr"] = f"{protocol}{iran_node_ip}:{control_port}"
-                    else:
-                        client_spec["remote_addr"] = f"{iran_node_ip}:{control_port}"
-                    client_spec["transport"] = transport
-                    client_spec["type"] = transport
-                    client_spec["mode"] = "client"  # Ensure mode is set
-                    if token:
-                        client_spec["token"] = token
-                
-                if tunnel.core == "frp":
-                    bind_port = spec.get("bind_port")
-                    if not bind_port:
-                        import hashlib
-                        port_hash = int(hashlib.md5(tunnel.id.encode()).hexdigest()[:8], 16)
-                        bind_port = 7000 + (port_hash % 1000)
-                    
-                    token = spec.get("token")
-                    if not token:
-                        from app.utils import generate_token
-                        token = generate_token()
-                        spec["token"] = token
-                        tunnel.spec["token"] = token
-                        from sqlalchemy.orm.attributes import flag_modified
-                        flag_modified(tunnel, "spec")
-                        await db.commit()
-                        await db.refresh(tunnel)
-                    
-                    iran_node_ip = iran_node.node_metadata.get("ip_address")
-                    if not iran_node_ip:
-                        tunnel.status = "error"
-                        tunnel.error_message = "Iran node has no IP address"
-                        await db.commit()
-                        raise HTTPException(status_code=400, detail="Iran node has no IP address")
-                    
-                    server_spec = spec.copy()
-                    server_spec["mode"] = "server"
-                    server_spec["bind_port"] = bind_port
-                    server_spec["token"] = token
-                    
-                    client_spec = spec.copy()
-                    client_spec["mode"] = "client"
-                    client_spec["server_addr"] = iran_node_ip
-                    client_spec["server_port"] = bind_port
-                    client_spec["token"] = token
-                    tunnel_type = tunnel.type.lower() if tunnel.type else "tcp"
-                    if tunnel_type not in ["tcp", "udp"]:
-                        tunnel_type = "tcp"
-                    client_spec["type"] = tunnel_type
-                    
-                    ports = spec.get("ports", [])
-                    if not ports:
-                        local_port = spec.get("local_port")
-                        remote_port = spec.get("remote_port") or spec.get("listen_port")
-                        if remote_port and local_port:
-                            client_spec["ports"] = [{"local": int(local_port), "remote": int(remote_port)}]
-                        elif remote_port:
-                            client_spec["ports"] = [{"local": int(remote_port), "remote": int(remote_port)}]
-                        elif local_port:
-                            client_spec["ports"] = [{"local": int(local_port), "remote": int(local_port)}]
-                    else:
-                        client_spec["ports"] = ports
-                
-                elif tunnel.core == "rathole":
-                    transport = spec.get("transport") or spec.get("type") or "tcp"
-                    proxy_port = spec.get("remote_port") or spec.get("listen_port")
-                    token = spec.get("token")
-                    
-                    if not proxy_port or not token:
-                        tunnel.status = "error"
-                        tunnel.error_message = "Missing required fields: remote_port/listen_port or token"
-                        await db.commit()
-                        raise HTTPException(status_code=400, detail="Missing required fields: remote_port/listen_port or token")
-                    
-                    from app.utils import parse_address_port
-                    remote_addr = spec.get("remote_addr", "0.0.0.0:23333")
-                    _, control_port, _ = parse_address_port(remote_addr)
-                    if not control_port:
-                        import hashlib
-                        port_hash = int(hashlib.md5(tunnel.id.encode()).hexdigest()[:8], 16)
-                        control_port = 23333 + (port_hash % 1000)
-                    
-                    server_spec = spec.copy()
-                    server_spec["mode"] = "server"
-                    server_spec["bind_addr"] = f"0.0.0.0:{control_port}"
-                    server_spec["proxy_port"] = proxy_port
-                    server_spec["transport"] = transport
-                    server_spec["token"] = token
-                    
-                    iran_node_ip = iran_node.node_metadata.get("ip_address")
-                    if not iran_node_ip:
-                        tunnel.status = "error"
-                        tunnel.error_message = "Iran node has no IP address"
-                        await db.commit()
-                        raise HTTPException(status_code=400, detail="Iran node has no IP address")
-                    
-                    client_spec = spec.copy()
-                    client_spec["mode"] = "client"
-                    transport_lower = transport.lower()
-                    if transport_lower in ("websocket", "ws"):
-                        use_tls = bool(spec.get("websocket_tls") or spec.get("tls"))
-                        protocol = "wss://" if use_tls else "ws://"
-                        client_spec["remote_addr"] = f"{protocol}{iran_node_ip}:{control_port}"
-                    else:
-                        client_spec["remote_addr"] = f"{iran_node_ip}:{control_port}"
-                    client_spec["transport"] = transport
-                    client_spec["token"] = token
-                
-                elif tunnel.core == "chisel":
-                    listen_port = spec.get("listen_port") or spec.get("remote_port")
-                    if not listen_port:
-                        tunnel.status = "error"
-                        tunnel.error_message = "Missing required field: listen_port or remote_port"
-                        await db.commit()
-                        raise HTTPException(status_code=400, detail="Missing required field: listen_port or remote_port")
-                    
-                    import hashlib
-                    port_hash = int(hashlib.md5(tunnel.id.encode()).hexdigest()[:8], 16)
-                    server_control_port = spec.get("control_port") or (int(listen_port) + 10000 + (port_hash % 1000))
-                    
-                    server_spec = spec.copy()
-                    server_spec["mode"] = "server"
-                    server_spec["server_port"] = server_control_port
-                    server_spec["reverse_port"] = listen_port
-                    
-                    iran_node_ip = iran_node.node_metadata.get("ip_address")
-                    if not iran_node_ip:
-                        tunnel.status = "error"
-                        tunnel.error_message = "Iran node has no IP address"
-                        await db.commit()
-                        raise HTTPException(status_code=400, detail="Iran node has no IP address")
-                    
-                    client_spec = spec.copy()
-                    client_spec["mode"] = "client"
-                    from app.utils import is_valid_ipv6_address
-                    if is_valid_ipv6_address(iran_node_ip):
-                        client_spec["server_url"] = f"http://[{iran_node_ip}]:{server_control_port}"
-                    else:
-                        client_spec["server_url"] = f"http://{iran_node_ip}:{server_control_port}"
-                    client_spec["reverse_port"] = listen_port
                 
                 if not iran_node.node_metadata.get("api_address"):
                     iran_node.node_metadata["api_address"] = f"http://{iran_node.node_metadata.get('ip_address', iran_node.fingerprint)}:{iran_node.node_metadata.get('api_port', 8888)}"
@@ -1587,7 +1126,7 @@ async def apply_tunnel(tunnel_id: str, request: Request, db: AsyncSession = Depe
                         "tunnel_id": tunnel.id,
                         "core": tunnel.core,
                         "type": tunnel.type,
-                        "spec": server_spec if tunnel.core in ["backhaul", "frp", "rathole", "chisel"] else spec
+                        "spec": server_spec
                     }
                 )
                 
@@ -1610,7 +1149,7 @@ async def apply_tunnel(tunnel_id: str, request: Request, db: AsyncSession = Depe
                         "tunnel_id": tunnel.id,
                         "core": tunnel.core,
                         "type": tunnel.type,
-                        "spec": client_spec if tunnel.core in ["backhaul", "frp", "rathole", "chisel"] else spec
+                        "spec": client_spec
                     }
                 )
                 
@@ -1625,6 +1164,7 @@ async def apply_tunnel(tunnel_id: str, request: Request, db: AsyncSession = Depe
                     tunnel.status = "active"
                     tunnel.error_message = None
                     await db.commit()
+                    tunnel_enforcer.track(tunnel)
                     return {"status": "applied", "message": "Tunnel reapplied successfully to both nodes"}
                 else:
                     tunnel.status = "error"
@@ -1680,6 +1220,7 @@ async def apply_tunnel(tunnel_id: str, request: Request, db: AsyncSession = Depe
             tunnel.status = "active"
             tunnel.error_message = None
             await db.commit()
+            tunnel_enforcer.track(tunnel)
             return {"status": "applied", "message": "Tunnel reapplied successfully"}
         else:
             error_msg = response.get("message", "Failed to apply tunnel")
@@ -1696,53 +1237,41 @@ async def apply_tunnel(tunnel_id: str, request: Request, db: AsyncSession = Depe
         raise HTTPException(status_code=500, detail=f"Failed to apply tunnel: {str(e)}")
 
 
-@router.post("/reapply-all")
-async def reapply_all_tunnels(request: Request, db: AsyncSession = Depends(get_db)):
-    """Reapply all tunnels"""
-    result = await db.execute(select(Tunnel))
-    tunnels = result.scalars().all()
-    
-    if not tunnels:
-        return {"status": "success", "message": "No tunnels to reapply", "applied": 0, "failed": 0}
-    
-    applied = 0
-    failed = 0
-    errors = []
-    
-    # Call apply_tunnel for each tunnel
-    for tunnel in tunnels:
-        try:
-            # Call apply_tunnel directly - it's in the same module
-            try:
-                result_data = await apply_tunnel(tunnel.id, request, db)
-                if result_data and result_data.get("status") == "applied":
-                    applied += 1
-                else:
-                    failed += 1
-                    errors.append(f"Tunnel {tunnel.name}: Failed to apply")
-            except HTTPException as e:
-                failed += 1
-                errors.append(f"Tunnel {tunnel.name}: {e.detail}")
-            except Exception as e:
-                failed += 1
-                error_msg = str(e)
-                errors.append(f"Tunnel {tunnel.name}: {error_msg}")
-        except Exception as e:
-            logger.error(f"Error reapplying tunnel {tunnel.id}: {e}", exc_info=True)
-            failed += 1
-            errors.append(f"Tunnel {tunnel.name}: {str(e)}")
-    
+@router.post("/reapply-all", status_code=202)
+async def reapply_all_tunnels(request: Request):
+    """Start reapplying all tunnels in the background; poll the returned job for progress"""
+    job = reapply_engine.start(request=request)
     return {
-        "status": "success",
-        "message": f"Reapplied {applied} tunnels, {failed} failed",
-        "applied": applied,
-        "failed": failed,
-        "errors": errors[:10]  # Limit errors to first 10
+        "status": "accepted",
+        "message": f"Reapply job {job.id} started",
+        "job_id": job.id,
+        "job": job.to_dict()
     }
 
 
+@router.post("/reconcile")
+async def reconcile_tunnels(request: Request):
+    """Push only tunnels that nodes report missing, drifted or not running"""
+    return await reapply_engine.reconcile(request)
+
+
+@router.get("/reapply-all/{job_id}")
+async def get_reapply_job(job_id: str):
+    """Get progress of a reapply-all job"""
+    job = reapply_engine.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Reapply job not found")
+    return job.to_dict()
+
+
 @router.delete("/{tunnel_id}")
-async def delete_tunnel(tunnel_id: str, request: Request, db: AsyncSession = Depends(get_db)):
+async def delete_tunnel(tunnel_id: str, request: Request):
+    """Delete a tunnel; runs as a job (202 with Prefer: respond-async)"""
+    job = await job_queue.submit("tunnel.delete", {"tunnel_id": tunnel_id}, request, key=f"tunnel:{tunnel_id}")
+    return await job_queue.respond(job, request)
+
+
+async def _delete_tunnel(tunnel_id: str, request: Request, db: AsyncSession):
     """Delete a tunnel"""
     result = await db.execute(select(Tunnel).where(Tunnel.id == tunnel_id))
     tunnel = result.scalar_one_or_none()
@@ -1758,7 +1287,8 @@ async def delete_tunnel(tunnel_id: str, request: Request, db: AsyncSession = Dep
     if needs_gost_forwarding:
         if hasattr(request.app.state, 'gost_forwarder'):
             try:
-                request.app.state.gost_forwarder.stop_forward(tunnel.id)
+                for forward_id in gost_forward_ids(tunnel):
+                    await asyncio.to_thread(request.app.state.gost_forwarder.stop_forward, forward_id)
             except Exception as e:
                 import logging
                 logging.error(f"Failed to stop gost forwarding: {e}")
@@ -1766,28 +1296,28 @@ async def delete_tunnel(tunnel_id: str, request: Request, db: AsyncSession = Dep
     elif needs_rathole_server:
         if hasattr(request.app.state, 'rathole_server_manager'):
             try:
-                request.app.state.rathole_server_manager.stop_server(tunnel.id)
+                await asyncio.to_thread(request.app.state.rathole_server_manager.stop_server, tunnel.id)
             except Exception as e:
                 import logging
                 logging.error(f"Failed to stop Rathole server: {e}")
     elif needs_backhaul_server:
         if hasattr(request.app.state, "backhaul_manager"):
             try:
-                request.app.state.backhaul_manager.stop_server(tunnel.id)
+                await asyncio.to_thread(request.app.state.backhaul_manager.stop_server, tunnel.id)
             except Exception as e:
                 import logging
                 logging.error(f"Failed to stop Backhaul server: {e}")
     elif needs_chisel_server:
         if hasattr(request.app.state, 'chisel_server_manager'):
             try:
-                request.app.state.chisel_server_manager.stop_server(tunnel.id)
+                await asyncio.to_thread(request.app.state.chisel_server_manager.stop_server, tunnel.id)
             except Exception as e:
                 import logging
                 logging.error(f"Failed to stop Chisel server: {e}")
     elif needs_frp_server:
         if hasattr(request.app.state, 'frp_server_manager'):
             try:
-                request.app.state.frp_server_manager.stop_server(tunnel.id)
+                await asyncio.to_thread(request.app.state.frp_server_manager.stop_server, tunnel.id)
             except Exception as e:
                 import logging
                 logging.error(f"Failed to stop FRP server: {e}")
@@ -1808,6 +1338,24 @@ async def delete_tunnel(tunnel_id: str, request: Request, db: AsyncSession = Dep
     
     await db.delete(tunnel)
     await db.commit()
+    tunnel_enforcer.untrack(tunnel_id)
     return {"status": "deleted"}
 
 
+async def _run_create(payload: dict, request: Request, db: AsyncSession):
+    tunnel = await _create_tunnel(TunnelCreate(**payload), request, db)
+    return TunnelResponse.model_validate(tunnel).model_dump(mode="json")
+
+
+async def _run_update(payload: dict, request: Request, db: AsyncSession):
+    tunnel = await _update_tunnel(payload["tunnel_id"], TunnelUpdate(**payload["update"]), request, db)
+    return TunnelResponse.model_validate(tunnel).model_dump(mode="json")
+
+
+async def _run_delete(payload: dict, request: Request, db: AsyncSession):
+    return await _delete_tunnel(payload["tunnel_id"], request, db)
+
+
+job_queue.register("tunnel.create", _run_create)
+job_queue.register("tunnel.update", _run_update)
+job_queue.register("tunnel.delete", _run_delete)
@@ -0,0 +1,273 @@
+"""Consolidated rathole and frps servers, one process per control port"""
+import hashlib
+import hmac
+import logging
+import subprocess
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+from app.config import settings
+from app.pid_registry import pid_registry, stop_process
+from app.process_monitor import process_monitor
+from app.readiness import READY_PATTERNS, wait_for_ready
+
+logger = logging.getLogger(__name__)
+
+# Control port every frp tunnel of a node uses in shared mode unless its spec pins one
+SHARED_FRP_PORT = 7000
+
+
+def shared_frp_token(node_id: str, bind_port) -> str:
+    """Token for all tunnels on one shared frps endpoint, derived from the panel secret"""
+    message = f"frp:{node_id}:{bind_port}".encode()
+    return hmac.new(settings.secret_key.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+class SharedServer:
+    """One server process on the panel carrying the tunnels that share its control port.
+
+    The config file always holds every tunnel, so the process monitor brings
+    a crashed instance back complete. Adding or removing a tunnel rewrites
+    the file while the process keeps running, so the other tunnels stay up.
+    """
+
+    core = "core"
+    extension = "conf"
+    patterns: List[str] = []
+
+    def __init__(self, config_dir: Path, binary: Path, bind_port: int, params: Dict[str, Any]):
+        self.config_dir = config_dir
+        self.binary = binary
+        self.bind_port = bind_port
+        self.params = params
+        self.services: Dict[str, List[Dict[str, Any]]] = {}
+        self.proc: Optional[subprocess.Popen] = None
+        self._log_f = None
+        self._lock = threading.RLock()
+
+    @property
+    def key(self) -> str:
+        return f"{self.core}:shared:{self.bind_port}"
+
+    @property
+    def config_path(self) -> Path:
+        return self.config_dir / f"shared_{self.bind_port}.{self.extension}"
+
+    def command(self) -> List[str]:
+        return [str(self.binary), "-c", str(self.config_path)]
+
+    def render(self) -> str:
+        raise NotImplementedError
+
+    def wait_services(self, tunnel_id: str):
+        """Wait until the tunnel is served by the running instance"""
+
+    def is_running(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def _write(self):
+        # Written in place: rathole watches the file itself and would lose the watch on a rename
+        with open(self.config_path, "w") as f:
+            f.write(self.render())
+
+    def ensure_running(self):
+        """Start the instance on the current config if it is not running"""
+        if self.is_running():
+            return
+        self._close_log()
+        self._write()
+        cmd = self.command()
+        log_file = self.config_dir / f"shared_{self.bind_port}.log"
+        self._log_f = open(log_file, 'w', buffering=1)
+        self._log_f.write(f"Starting shared {self.core} with command: {' '.join(cmd)}\n")
+        self._log_f.flush()
+        self.proc = subprocess.Popen(
+            cmd,
+            stdout=self._log_f,
+            stderr=subprocess.STDOUT,
+            cwd=str(self.config_dir),
+            start_new_session=True
+        )
+        pid_registry.add(self.key, self.proc.pid, cmd)
+        ready, reason = wait_for_ready(self.proc, tcp_ports=[self.bind_port], log_path=log_file, patterns=self.patterns)
+        if not ready:
+            self.stop()
+            raise RuntimeError(f"Shared {self.core} on port {self.bind_port} failed to start ({reason})")
+        process_monitor.watch(self.key, self.proc, self.restart)
+        logger.info(f"Shared {self.core} instance ready on port {self.bind_port}, PID={self.proc.pid}")
+
+    def restart(self):
+        """Bring a crashed instance back with all of its tunnels"""
+        with self._lock:
+            if self.services:
+                self.ensure_running()
+
+    def put(self, tunnel_id: str, services: List[Dict[str, Any]]):
+        """Install a tunnel's services, replacing the ones it had before"""
+        with self._lock:
+            previous = self.services.get(tunnel_id)
+            self.services[tunnel_id] = services
+            try:
+                self._write()
+                self.ensure_running()
+                self.wait_services(tunnel_id)
+            except Exception:
+                if previous is None:
+                    self.services.pop(tunnel_id, None)
+                else:
+                    self.services[tunnel_id] = previous
+                if self.services:
+                    self._write()
+                else:
+                    self.stop()
+                raise
+
+    def remove(self, tunnel_id: str):
+        """Drop a tunnel, stopping the process once no tunnel is left"""
+        with self._lock:
+            if self.services.pop(tunnel_id, None) is None:
+                return
+            if self.services:
+                self._write()
+            else:
+                self.stop()
+
+    def tunnel_running(self, tunnel_id: str) -> bool:
+        return tunnel_id in self.services and self.is_running()
+
+    def stop(self):
+        process_monitor.unwatch(self.key)
+        if self.proc is not None:
+            try:
+                stop_process(self.proc)
+            except Exception as e:
+                logger.warning(f"Error stopping shared {self.core} on port {self.bind_port}: {e}")
+            pid_registry.remove(self.key)
+        self.proc = None
+        self._close_log()
+        if self.config_path.exists():
+            try:
+                self.config_path.unlink()
+            except:
+                pass
+
+    def _close_log(self):
+        if self._log_f:
+            try:
+                self._log_f.close()
+            except:
+                pass
+            self._log_f = None
+
+
+class SharedRatholeServer(SharedServer):
+    """A rathole server; rathole reloads its services when the config file changes"""
+
+    core = "rathole"
+    extension = "toml"
+    patterns = READY_PATTERNS["rathole"]
+
+    def command(self) -> List[str]:
+        return [str(self.binary), "-s", str(self.config_path)]
+
+    def render(self) -> str:
+        config = f"""[server]
+bind_addr = "0.0.0.0:{self.bind_port}"
+"""
+        for services in self.services.values():
+            for service in services:
+                config += f"""
+[server.services.{service['name']}]
+token = "{service['token']}"
+bind_addr = "{service['bind_addr']}"
+"""
+        return config
+
+    def wait_services(self, tunnel_id: str):
+        ports = [service["port"] for service in self.services.get(tunnel_id, [])]
+        ready, reason = wait_for_ready(self.proc, tcp_ports=ports)
+        if not ready:
+            raise RuntimeError(f"rathole did not pick up tunnel {tunnel_id} ({reason})")
+
+
+class SharedFrpsServer(SharedServer):
+    """One frps per bind port; proxies come from the clients, so tunnels only hold a reference"""
+
+    core = "frps"
+    extension = "yaml"
+    patterns = READY_PATTERNS["frp"]
+
+    def render(self) -> str:
+        config = f"""bindPort: {self.bind_port}
+"""
+        if self.params.get("token"):
+            config += f"""auth:
+  method: token
+  token: "{self.params['token']}"
+"""
+        return config
+
+
+class SharedServers:
+    """Shared server instances keyed by control port, and which tunnel lives where"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.instances: Dict[int, SharedServer] = {}
+        self.owners: Dict[str, int] = {}
+        self._lock = threading.RLock()
+
+    def owns(self, tunnel_id: str) -> bool:
+        return tunnel_id in self.owners
+
+    def put(self, tunnel_id: str, bind_port: int, params: Dict[str, Any], services: List[Dict[str, Any]]):
+        """Install a tunnel on the instance for `bind_port`, moving it off any other instance"""
+        with self._lock:
+            instance = self.instances.get(bind_port)
+            if instance is not None and instance.params != params:
+                others = [t for t in instance.services if t != tunnel_id]
+                if others:
+                    raise ValueError(
+                        f"Port {bind_port} is already used by tunnels {', '.join(others)} with a different token"
+                    )
+                instance.stop()
+                instance.params = params
+            if instance is None:
+                instance = self.instances[bind_port] = self.factory(bind_port, params)
+            previous = self.owners.get(tunnel_id)
+            if previous is not None and previous != bind_port:
+                self.remove(tunnel_id)
+            try:
+                instance.put(tunnel_id, services)
+            except Exception:
+                if not instance.services:
+                    self.instances.pop(bind_port, None)
+                raise
+            self.owners[tunnel_id] = bind_port
+
+    def remove(self, tunnel_id: str) -> bool:
+        """Remove a tunnel from its instance; returns False if no instance carries it"""
+        with self._lock:
+            bind_port = self.owners.pop(tunnel_id, None)
+            instance = self.instances.get(bind_port) if bind_port is not None else None
+            if instance is None:
+                return False
+            instance.remove(tunnel_id)
+            if not instance.services:
+                self.instances.pop(bind_port, None)
+            return True
+
+    def tunnel_running(self, tunnel_id: str) -> bool:
+        instance = self.instances.get(self.owners.get(tunnel_id))
+        return instance is not None and instance.tunnel_running(tunnel_id)
+
+    def active_tunnels(self) -> List[str]:
+        return [tunnel_id for tunnel_id in self.owners if self.tunnel_running(tunnel_id)]
+
+    def stop(self):
+        with self._lock:
+            for instance in self.instances.values():
+                instance.stop()
+            self.instances.clear()
+            self.owners.clear()
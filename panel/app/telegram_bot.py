@@ -670,7 +670,7 @@ Use buttons in messages to interact with nodes and tunnels."""
                 
                 for node in nodes:
                     status = "🟢" if node.status == "active" else "🔴"
-                    role = node.node_metadata.get("role", "unknown") if node.node_metadata else "unknown"
+                    role = node.role or "unknown"
                     text += f"{status} {node.name} ({role})\n"
                     text += f"   ID: {node.id[:8]}...\n\n"
                 
@@ -0,0 +1,229 @@
+"""Expiry and quota enforcement for tunnels"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, or_
+
+from app.database import AsyncSessionLocal
+from app.models import Tunnel
+from app.node_client import NodeClient
+from app.tunnel_specs import gost_forward_ids
+
+logger = logging.getLogger(__name__)
+
+EXPIRED = "expired"
+QUOTA_EXCEEDED = "quota_exceeded"
+DISABLED_STATUSES = (EXPIRED, QUOTA_EXCEEDED)
+
+# Deadlines are wall-clock times; re-check at least this often in case the clock is adjusted
+MAX_SLEEP = 3600.0
+
+
+def to_timestamp(value: datetime) -> float:
+    """Convert a naive UTC datetime (as stored on Tunnel) to a POSIX timestamp"""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+class TunnelEnforcer:
+    """Disables tunnels when they expire or run out of quota.
+
+    Pending events live in a min-heap of (due time, sequence, tunnel id,
+    reason). Tunnels are loaded once at startup and re-tracked whenever
+    they change; superseded heap entries are skipped lazily using a per
+    tunnel generation. Quota events are pushed as soon as the usage
+    collector reports traffic that crosses a tunnel's quota, so the loop
+    only ever sleeps until the earliest event.
+    """
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.node_client = NodeClient()
+        self._heap: List[Tuple[float, int, str, str, int]] = []
+        self._seq = itertools.count()
+        self._generation: Dict[str, int] = {}
+        self._quota_mb: Dict[str, float] = {}
+        self._used_mb: Dict[str, float] = {}
+        self._wakeup = asyncio.Event()
+
+    async def start(self):
+        """Load tracked tunnels and start the enforcement task"""
+        await self.stop()
+        await self.load()
+        self.task = asyncio.create_task(self._loop())
+        logger.info(f"Tunnel enforcer started: {len(self._generation)} tunnels with expiry or quota")
+
+    async def stop(self):
+        """Stop the enforcement task"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            logger.info("Tunnel enforcer stopped")
+
+    async def load(self):
+        """Build the event heap from the database"""
+        self._heap.clear()
+        self._generation.clear()
+        self._quota_mb.clear()
+        self._used_mb.clear()
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(Tunnel.id, Tunnel.status, Tunnel.expires_at, Tunnel.quota_mb, Tunnel.used_mb).where(
+                    Tunnel.status.notin_(DISABLED_STATUSES),
+                    or_(Tunnel.expires_at.isnot(None), Tunnel.quota_mb > 0),
+                )
+            )
+            for row in result.all():
+                self._track(row.id, row.status, row.expires_at, row.quota_mb, row.used_mb)
+        self._wakeup.set()
+
+    def track(self, tunnel: Tunnel):
+        """(Re)schedule a tunnel after it was created, updated or applied"""
+        self._track(tunnel.id, tunnel.status, tunnel.expires_at, tunnel.quota_mb, tunnel.used_mb)
+        self._wakeup.set()
+
+    def untrack(self, tunnel_id: str):
+        """Forget a deleted tunnel; its heap entries become stale"""
+        self._generation.pop(tunnel_id, None)
+        self._quota_mb.pop(tunnel_id, None)
+        self._used_mb.pop(tunnel_id, None)
+
+    def add_usage(self, used: Dict[str, float]):
+        """Account freshly ingested traffic (MB per tunnel) and queue tunnels that crossed their quota"""
+        now = time.time()
+        for tunnel_id, mb in used.items():
+            quota = self._quota_mb.get(tunnel_id)
+            if not quota:
+                continue
+            previous = self._used_mb.get(tunnel_id, 0.0)
+            self._used_mb[tunnel_id] = previous + mb
+            if previous < quota <= previous + mb:
+                self._push(now, tunnel_id, QUOTA_EXCEEDED)
+                self._wakeup.set()
+
+    def _track(self, tunnel_id: str, status: Optional[str], expires_at: Optional[datetime], quota_mb: Optional[float], used_mb: Optional[float]):
+        if status in DISABLED_STATUSES or (not expires_at and not quota_mb):
+            self.untrack(tunnel_id)
+            return
+        # Globally unique, so entries from before an untrack never match again
+        self._generation[tunnel_id] = next(self._seq)
+        if quota_mb:
+            self._quota_mb[tunnel_id] = quota_mb
+            self._used_mb[tunnel_id] = used_mb or 0.0
+            if (used_mb or 0.0) >= quota_mb:
+                self._push(time.time(), tunnel_id, QUOTA_EXCEEDED)
+        else:
+            self._quota_mb.pop(tunnel_id, None)
+            self._used_mb.pop(tunnel_id, None)
+        if expires_at:
+            self._push(to_timestamp(expires_at), tunnel_id, EXPIRED)
+
+    def _push(self, due: float, tunnel_id: str, reason: str):
+        heapq.heappush(self._heap, (due, next(self._seq), tunnel_id, reason, self._generation.get(tunnel_id, 0)))
+
+    def _next_delay(self) -> Optional[float]:
+        """Drop stale entries from the top of the heap and return seconds until the next live one"""
+        while self._heap:
+            due, _, tunnel_id, _, generation = self._heap[0]
+            if self._generation.get(tunnel_id) != generation:
+                heapq.heappop(self._heap)
+                continue
+            return max(0.0, due - time.time())
+        return None
+
+    def _pop_due(self) -> List[Tuple[str, str]]:
+        due_events = []
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, tunnel_id, reason, generation = heapq.heappop(self._heap)
+            if self._generation.get(tunnel_id) == generation:
+                due_events.append((tunnel_id, reason))
+        return due_events
+
+    async def _loop(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._next_delay()
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(delay if delay is not None else MAX_SLEEP, MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+            for tunnel_id, reason in self._pop_due():
+                try:
+                    await self._disable(tunnel_id, reason)
+                except Exception as e:
+                    logger.error(f"Failed to enforce {reason} for tunnel {tunnel_id}: {e}", exc_info=True)
+
+    def _stop_panel_side(self, tunnel: Tunnel):
+        from app.gost_forwarder import gost_forwarder
+        from app.rathole_server import rathole_server_manager
+        from app.backhaul_manager import backhaul_manager
+        from app.chisel_server import chisel_server_manager
+        from app.frp_server import frp_server_manager
+
+        managers = {
+            "gost": gost_forwarder.stop_forward,
+            "rathole": rathole_server_manager.stop_server,
+            "backhaul": backhaul_manager.stop_server,
+            "chisel": chisel_server_manager.stop_server,
+            "frp": frp_server_manager.stop_server,
+        }
+        stop = managers.get(tunnel.core)
+        if not stop:
+            return
+        forward_ids = gost_forward_ids(tunnel) if tunnel.core == "gost" else [tunnel.id]
+        for forward_id in forward_ids:
+            try:
+                stop(forward_id)
+            except Exception as e:
+                logger.warning(f"Failed to stop {tunnel.core} server {forward_id} for tunnel {tunnel.id}: {e}")
+
+    async def _disable(self, tunnel_id: str, reason: str):
+        """Tear a tunnel down on the panel and its nodes and mark it disabled"""
+        async with AsyncSessionLocal() as session:
+            tunnel = await session.get(Tunnel, tunnel_id)
+            if not tunnel or tunnel.status in DISABLED_STATUSES:
+                self.untrack(tunnel_id)
+                return
+
+            # The database is authoritative; reschedule if the event no longer applies
+            now = datetime.utcnow()
+            if reason == EXPIRED and not (tunnel.expires_at and tunnel.expires_at <= now):
+                self.track(tunnel)
+                return
+            if reason == QUOTA_EXCEEDED and not (tunnel.quota_mb and (tunnel.used_mb or 0) >= tunnel.quota_mb):
+                self.track(tunnel)
+                return
+
+            await asyncio.to_thread(self._stop_panel_side, tunnel)
+
+            node_ids = {node_id for node_id in (tunnel.node_id, tunnel.foreign_node_id, tunnel.iran_node_id) if node_id}
+            for node_id in node_ids:
+                response = await self.node_client.send_to_node(
+                    node_id=node_id,
+                    endpoint="/api/agent/tunnels/remove",
+                    data={"tunnel_id": tunnel.id}
+                )
+                if response.get("status") == "error":
+                    logger.warning(f"Failed to remove tunnel {tunnel.id} from node {node_id}: {response.get('message')}")
+
+            if reason == EXPIRED:
+                tunnel.error_message = f"Tunnel expired at {tunnel.expires_at}"
+            else:
+                tunnel.error_message = f"Quota exceeded: {tunnel.used_mb:.2f} MB used of {tunnel.quota_mb:.2f} MB"
+            tunnel.status = reason
+            await session.commit()
+            self.untrack(tunnel_id)
+            logger.info(f"Disabled tunnel {tunnel_id}: {tunnel.error_message}")
+
+
+tunnel_enforcer = TunnelEnforcer()
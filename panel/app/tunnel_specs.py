@@ -0,0 +1,195 @@
+"""Node specs for reverse tunnels, shared by create, update, apply and the reconciler"""
+import hashlib
+from typing import Dict, Any, List, Tuple
+
+from app.config import settings
+from app.models import Tunnel, Node
+from app.shared_cores import SHARED_FRP_PORT, shared_frp_token
+from app.utils import generate_token, parse_address_port, is_valid_ipv6_address
+
+REVERSE_CORES = {"rathole", "backhaul", "chisel", "frp"}
+
+
+class PlanError(Exception):
+    """A tunnel's stored configuration cannot be turned into node specs"""
+
+
+def port_hash(tunnel_id: str) -> int:
+    return int(hashlib.md5(tunnel_id.encode()).hexdigest()[:8], 16)
+
+
+def parse_ports_from_spec(spec: dict) -> list:
+    """Parse ports from spec - supports both comma-separated string and list formats"""
+    ports = spec.get("ports", [])
+    if isinstance(ports, str):
+        # Comma-separated string: "8080,8081,8082"
+        ports = [int(p.strip()) for p in ports.split(",") if p.strip().isdigit()]
+    elif isinstance(ports, list) and ports:
+        # List of numbers or strings
+        ports = [int(p) if isinstance(p, (int, str)) and str(p).isdigit() else p for p in ports]
+    return ports if ports else []
+
+
+def gost_forward_ids(tunnel: Tunnel) -> List[str]:
+    """Ids of a tunnel's panel gost forwards; create registers one per port when it forwards several"""
+    spec = tunnel.spec or {}
+    ports = parse_ports_from_spec(spec) or _single_port(spec, "listen_port")
+    ids = [tunnel.id]
+    if len(ports) > 1:
+        ids.extend(f"{tunnel.id}_{port}" for port in ports)
+    return ids
+
+
+def _single_port(spec: Dict[str, Any], *keys: str) -> list:
+    """The port list of a spec that only sets one port under one of `keys`"""
+    for key in keys:
+        port = spec.get(key)
+        if port:
+            return [int(port) if str(port).isdigit() else port]
+    return []
+
+
+def _generated(spec: Dict[str, Any], updates: Dict[str, Any], key: str) -> str:
+    """A new secret for `key`, recorded so the caller stores it with the tunnel"""
+    value = spec[key] = updates[key] = generate_token()
+    return value
+
+
+def backhaul_ports(spec: Dict[str, Any], target_host: str, public_port) -> List[str]:
+    """Backhaul `public=host:target` port mappings from a spec's ports, or its single public port"""
+    ports = spec.get("ports") or []
+    if not ports:
+        target_port = spec.get("target_port") or public_port
+        if target_port:
+            return [f"{public_port}={target_host}:{target_port}"]
+        return [str(public_port)]
+    if not isinstance(ports, list):
+        return ports
+    processed = []
+    for p in ports:
+        if not p:
+            continue
+        if isinstance(p, str):
+            if "=" not in p and p.isdigit():
+                processed.append(f"{p}={target_host}:{p}")
+            else:
+                processed.append(p)
+        elif isinstance(p, int):
+            processed.append(f"{p}={target_host}:{p}")
+        elif isinstance(p, dict):
+            local = p.get("local") or p.get("listen_port") or p.get("public_port")
+            tgt_host = p.get("target_host") or target_host
+            tgt_port = p.get("target_port") or p.get("remote_port") or local
+            if local:
+                processed.append(f"{local}={tgt_host}:{tgt_port}")
+        else:
+            processed.append(str(p))
+    return processed
+
+
+def plan_reverse(tunnel: Tunnel, iran_node: Node) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+    """Return (server spec, client spec, spec fields to store back) for a reverse tunnel.
+
+    This is the only place these specs are built. Nodes skip re-applying a
+    spec whose hash they already run, so create, update, apply and the
+    reconciler must all send exactly the same specs for the same tunnel.
+    """
+    spec = dict(tunnel.spec or {})
+    updates: Dict[str, Any] = {}
+    iran_node_ip = iran_node.ip_address
+    if not iran_node_ip:
+        raise PlanError("Iran node has no IP address")
+
+    if tunnel.core == "rathole":
+        transport = spec.get("transport") or spec.get("type") or "tcp"
+        token = spec.get("token") or _generated(spec, updates, "token")
+        ports = parse_ports_from_spec(spec) or _single_port(spec, "remote_port", "listen_port")
+        if not ports:
+            raise PlanError("Rathole requires ports")
+        _, control_port, _ = parse_address_port(spec.get("remote_addr", "0.0.0.0:23333"))
+        if not control_port:
+            control_port = 23333 + (port_hash(tunnel.id) % 1000)
+
+        common = {"transport": transport, "type": transport, "token": token, "ports": ports}
+        if "websocket_tls" not in spec and "tls" in spec:
+            common["websocket_tls"] = spec["tls"]
+        server_spec = {**spec, **common, "mode": "server", "bind_addr": f"0.0.0.0:{control_port}"}
+        if transport.lower() in ("websocket", "ws"):
+            protocol = "wss://" if server_spec.get("websocket_tls") or server_spec.get("tls") else "ws://"
+            remote_addr = f"{protocol}{iran_node_ip}:{control_port}"
+        else:
+            remote_addr = f"{iran_node_ip}:{control_port}"
+        client_spec = {**spec, **common, "mode": "client", "remote_addr": remote_addr}
+
+    elif tunnel.core == "chisel":
+        ports = parse_ports_from_spec(spec) or _single_port(spec, "listen_port", "remote_port")
+        if not ports:
+            raise PlanError("Chisel requires ports")
+        first_port = ports[0]
+        server_control_port = spec.get("control_port") or (int(first_port) + 10000 + (port_hash(tunnel.id) % 1000))
+        auth = spec.get("auth") or _generated(spec, updates, "auth")
+
+        server_spec = {**spec, "mode": "server", "server_port": server_control_port, "reverse_port": first_port, "auth": auth}
+        host = f"[{iran_node_ip}]" if is_valid_ipv6_address(iran_node_ip) else iran_node_ip
+        client_spec = {
+            **spec,
+            "mode": "client",
+            "server_url": f"http://{host}:{server_control_port}",
+            "ports": ports,
+            "auth": auth,
+        }
+
+    elif tunnel.core == "frp":
+        if settings.frp_shared_mode:
+            # The node runs one frps per bind port, so its tunnels share the port's token
+            bind_port = spec.get("bind_port") or SHARED_FRP_PORT
+            token = shared_frp_token(iran_node.id, bind_port)
+        else:
+            bind_port = spec.get("bind_port") or (7000 + (port_hash(tunnel.id) % 1000))
+            token = spec.get("token") or _generated(spec, updates, "token")
+
+        server_spec = {**spec, "mode": "server", "bind_port": bind_port, "token": token}
+        tunnel_type = tunnel.type.lower() if tunnel.type else "tcp"
+        client_spec = {
+            **spec,
+            "mode": "client",
+            "server_addr": iran_node_ip,
+            "server_port": bind_port,
+            "token": token,
+            "type": tunnel_type if tunnel_type in ("tcp", "udp") else "tcp",
+        }
+        ports = parse_ports_from_spec(spec)
+        if ports:
+            client_spec["ports"] = [p if isinstance(p, dict) else {"local": int(p), "remote": int(p)} for p in ports]
+        else:
+            client_spec["local_ip"] = client_spec.get("local_ip") or iran_node_ip
+            client_spec["local_port"] = client_spec.get("local_port") or spec.get("listen_port") or spec.get("remote_port") or bind_port
+            if "remote_port" not in client_spec:
+                client_spec["remote_port"] = spec.get("listen_port") or bind_port
+
+    elif tunnel.core == "backhaul":
+        transport = spec.get("transport") or spec.get("type") or "tcp"
+        control_port = spec.get("control_port") or spec.get("listen_port") or (3080 + (port_hash(tunnel.id) % 1000))
+        target_host = spec.get("target_host", "127.0.0.1")
+        token = spec.get("token") or _generated(spec, updates, "token")
+        public_port = spec.get("public_port") or spec.get("remote_port") or spec.get("listen_port")
+        if not spec.get("ports") and not public_port:
+            raise PlanError("Backhaul requires ports array or public_port/remote_port")
+        ports = backhaul_ports(spec, target_host, public_port)
+        # Stored back so the tunnel keeps the normalized mappings
+        spec["ports"] = updates["ports"] = list(ports) if isinstance(ports, list) else ports
+
+        bind_ip = spec.get("bind_ip") or spec.get("listen_ip") or "0.0.0.0"
+        common = {"transport": transport, "type": transport, "token": token, "ports": ports}
+        server_spec = {**spec, **common, "mode": "server", "bind_addr": f"{bind_ip}:{control_port}"}
+        if transport.lower() in ("ws", "wsmux"):
+            use_tls = bool(spec.get("tls_cert") or (spec.get("server_options") or {}).get("tls_cert"))
+            remote_addr = f"{'wss://' if use_tls else 'ws://'}{iran_node_ip}:{control_port}"
+        else:
+            remote_addr = f"{iran_node_ip}:{control_port}"
+        client_spec = {**spec, **common, "mode": "client", "remote_addr": remote_addr}
+
+    else:
+        raise PlanError(f"{tunnel.core} is not a reverse tunnel core")
+
+    return server_spec, client_spec, updates
@@ -0,0 +1,310 @@
+"""Traffic usage ingestion, rollups and retention"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import select, update, delete, insert, text, func, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Node, Tunnel, Usage, UsageRollup, UsageCounter, Settings
+from app.node_client import NodeClient
+from app.tunnel_enforcer import tunnel_enforcer
+from app.change_sequence import change_sequence
+
+logger = logging.getLogger(__name__)
+
+BYTES_PER_MB = 1024 * 1024
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Same text layout SQLAlchemy uses for DateTime on SQLite, so string comparisons line up
+DB_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# resolution -> (strftime bucket format, bucket size, source table, source resolution)
+RESOLUTIONS = [
+    ("minute", "%Y-%m-%d %H:%M:00.000000", timedelta(minutes=1), "usage", None),
+    ("hour", "%Y-%m-%d %H:00:00.000000", timedelta(hours=1), "usage_rollups", "minute"),
+    ("day", "%Y-%m-%d 00:00:00.000000", timedelta(days=1), "usage_rollups", "hour"),
+]
+
+
+def floor_time(value: datetime, size: timedelta) -> datetime:
+    """Round a timestamp down to the start of its bucket"""
+    if size >= timedelta(days=1):
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if size >= timedelta(hours=1):
+        return value.replace(minute=0, second=0, microsecond=0)
+    return value.replace(second=0, microsecond=0)
+
+
+class UsageCollector:
+    """Polls node traffic counters and maintains usage samples and rollups.
+
+    Every poll turns cumulative node counters into per-tunnel deltas, writes
+    them as raw samples in one batch and adds them to Tunnel.used_mb. A
+    periodic compaction rolls raw samples into minute buckets, minutes into
+    hours and hours into days, then prunes each level past its retention.
+    """
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.node_client = NodeClient()
+        self._last_compact = 0.0
+
+    async def start(self):
+        """Start the collection task"""
+        await self.stop()
+        self.task = asyncio.create_task(self._loop())
+        logger.info(f"Usage collector started: poll every {settings.usage_poll_interval}s")
+
+    async def stop(self):
+        """Stop the collection task"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            logger.info("Usage collector stopped")
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(settings.usage_poll_interval)
+            try:
+                await self.collect()
+            except Exception as e:
+                logger.error(f"Usage collection failed: {e}", exc_info=True)
+            if time.monotonic() - self._last_compact >= settings.usage_compact_interval:
+                self._last_compact = time.monotonic()
+                try:
+                    await self.compact()
+                except Exception as e:
+                    logger.error(f"Usage compaction failed: {e}", exc_info=True)
+
+    async def _fetch_counters(self, node_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        async def fetch(node_id: str):
+            response = await self.node_client.get_traffic(node_id)
+            if response.get("status") != "success":
+                logger.debug(f"No traffic counters from node {node_id}: {response.get('message')}")
+                return node_id, None
+            return node_id, response.get("data") or {}
+
+        results = await asyncio.gather(*(fetch(node_id) for node_id in node_ids), return_exceptions=True)
+        return {
+            result[0]: result[1]
+            for result in results
+            if not isinstance(result, BaseException) and result[1] is not None
+        }
+
+    async def collect(self) -> int:
+        """Poll every node once and ingest the deltas; returns the number of samples written"""
+        async with AsyncSessionLocal() as session:
+            node_ids = (await session.execute(select(Node.id).where(Node.status == "active"))).scalars().all()
+            tunnel_nodes = dict((await session.execute(select(Tunnel.id, Tunnel.node_id))).all())
+            previous = {
+                (row.node_id, row.tunnel_id): row
+                for row in (await session.execute(select(UsageCounter))).scalars().all()
+            }
+
+        counters_by_node = await self._fetch_counters(list(node_ids))
+        if not counters_by_node:
+            return 0
+
+        now = datetime.utcnow()
+        counter_rows: List[Dict[str, Any]] = []
+        samples: List[Dict[str, Any]] = []
+        used: Dict[str, int] = {}
+        for node_id, counters in counters_by_node.items():
+            for tunnel_id, data in counters.items():
+                total = int(data.get("rx_bytes", 0)) + int(data.get("tx_bytes", 0))
+                installed_at = data.get("installed_at")
+                last = previous.get((node_id, tunnel_id))
+                if last is None or total < (last.total_bytes or 0):
+                    # New or reset counter: everything it holds is new traffic
+                    delta = total
+                else:
+                    delta = total - (last.total_bytes or 0)
+                counter_rows.append({
+                    "node_id": node_id,
+                    "tunnel_id": tunnel_id,
+                    "total_bytes": total,
+                    "installed_at": installed_at,
+                    "updated_at": now,
+                })
+                # Only the tunnel's public node is counted so both ends are not billed twice
+                if delta > 0 and tunnel_nodes.get(tunnel_id) == node_id:
+                    samples.append({"tunnel_id": tunnel_id, "node_id": node_id, "bytes_used": delta, "timestamp": now})
+                    used[tunnel_id] = used.get(tunnel_id, 0) + delta
+
+        usage_table = Usage.__table__
+        tunnels_table = Tunnel.__table__
+        async with AsyncSessionLocal() as session:
+            # Core executemany on the session connection: one statement per batch
+            conn = await session.connection()
+            if counter_rows:
+                stmt = sqlite_insert(UsageCounter.__table__)
+                await conn.execute(
+                    stmt.on_conflict_do_update(
+                        index_elements=["node_id", "tunnel_id"],
+                        set_={
+                            "total_bytes": stmt.excluded.total_bytes,
+                            "installed_at": stmt.excluded.installed_at,
+                            "updated_at": stmt.excluded.updated_at,
+                        },
+                    ),
+                    counter_rows,
+                )
+            if samples:
+                await conn.execute(insert(usage_table), samples)
+                await conn.execute(
+                    update(tunnels_table)
+                    .where(tunnels_table.c.id == bindparam("tid"))
+                    .values(
+                        used_mb=func.coalesce(tunnels_table.c.used_mb, 0) + bindparam("mb"),
+                        updated_at=tunnels_table.c.updated_at,
+                    ),
+                    [{"tid": tunnel_id, "mb": delta / BYTES_PER_MB} for tunnel_id, delta in used.items()],
+                )
+            await session.commit()
+
+        if used:
+            # Core updates bypass the session hooks; used_mb is part of the tunnel listing
+            change_sequence.bump()
+            tunnel_enforcer.add_usage({tunnel_id: delta / BYTES_PER_MB for tunnel_id, delta in used.items()})
+        if samples:
+            logger.debug(f"Ingested {len(samples)} usage samples from {len(counters_by_node)} nodes")
+        return len(samples)
+
+    async def compact(self):
+        """Roll samples up level by level and apply retention"""
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(select(Settings).where(Settings.key == "usage_rollup"))
+            setting = result.scalar_one_or_none()
+            watermarks: Dict[str, str] = dict(setting.value or {}) if setting else {}
+
+            now = datetime.utcnow()
+            limit = now
+            for resolution, bucket_format, size, source, source_resolution in RESOLUTIONS:
+                end = floor_time(limit, size)
+                start = await self._rollup_start(session, watermarks.get(resolution), source, source_resolution, size)
+                if start is not None and start < end:
+                    await self._rollup(session, resolution, bucket_format, source, source_resolution, start, end)
+                    watermarks[resolution] = end.strftime(TIME_FORMAT)
+                else:
+                    watermarks.setdefault(resolution, end.strftime(TIME_FORMAT))
+                # A coarser bucket is only complete once all of its finer buckets are
+                limit = datetime.strptime(watermarks[resolution], TIME_FORMAT)
+
+            await self._apply_retention(session, watermarks, now)
+
+            if setting:
+                setting.value = watermarks
+            else:
+                session.add(Settings(key="usage_rollup", value=watermarks))
+            await session.commit()
+
+    async def _rollup_start(
+        self,
+        session,
+        watermark: Optional[str],
+        source: str,
+        source_resolution: Optional[str],
+        size: timedelta,
+    ) -> Optional[datetime]:
+        if watermark:
+            return datetime.strptime(watermark, TIME_FORMAT)
+        if source == "usage":
+            earliest = (await session.execute(select(func.min(Usage.timestamp)))).scalar()
+        else:
+            earliest = (await session.execute(
+                select(func.min(UsageRollup.bucket)).where(UsageRollup.resolution == source_resolution)
+            )).scalar()
+        return floor_time(earliest, size) if earliest else None
+
+    async def _rollup(
+        self,
+        session,
+        resolution: str,
+        bucket_format: str,
+        source: str,
+        source_resolution: Optional[str],
+        start: datetime,
+        end: datetime,
+    ):
+        """Recompute every bucket in [start, end) from its source rows"""
+        params = {
+            "resolution": resolution,
+            "start": start.strftime(DB_TIME_FORMAT),
+            "end": end.strftime(DB_TIME_FORMAT),
+        }
+        if source == "usage":
+            time_column, source_filter = "timestamp", ""
+        else:
+            time_column, source_filter = "bucket", "AND resolution = :source_resolution"
+            params["source_resolution"] = source_resolution
+        await session.execute(
+            text(
+                f"INSERT INTO usage_rollups (tunnel_id, resolution, bucket, bytes_used) "
+                f"SELECT tunnel_id, :resolution, strftime('{bucket_format}', {time_column}) AS b, SUM(bytes_used) "
+                f"FROM {source} WHERE {time_column} >= :start AND {time_column} < :end {source_filter} "
+                f"GROUP BY tunnel_id, b "
+                f"ON CONFLICT (resolution, tunnel_id, bucket) DO UPDATE SET bytes_used = excluded.bytes_used"
+            ),
+            params,
+        )
+
+    async def _apply_retention(self, session, watermarks: Dict[str, str], now: datetime):
+        """Drop rows past retention, never before they have been rolled up"""
+
+        def cutoff(age: timedelta, rolled_up_until: Optional[str]) -> datetime:
+            horizon = now - age
+            if rolled_up_until is None:
+                return datetime.min
+            return min(horizon, datetime.strptime(rolled_up_until, TIME_FORMAT))
+
+        raw_cutoff = cutoff(timedelta(hours=settings.usage_raw_retention_hours), watermarks.get("minute"))
+        await session.execute(delete(Usage).where(Usage.timestamp < raw_cutoff))
+
+        for resolution, days, next_resolution in (
+            ("minute", settings.usage_minute_retention_days, "hour"),
+            ("hour", settings.usage_hour_retention_days, "day"),
+            ("day", settings.usage_day_retention_days, None),
+        ):
+            if days <= 0:
+                continue
+            if next_resolution:
+                bucket_cutoff = cutoff(timedelta(days=days), watermarks.get(next_resolution))
+            else:
+                bucket_cutoff = now - timedelta(days=days)
+            await session.execute(
+                delete(UsageRollup).where(
+                    UsageRollup.resolution == resolution,
+                    UsageRollup.bucket < bucket_cutoff,
+                )
+            )
+
+    async def get_usage(
+        self,
+        tunnel_id: str,
+        resolution: str = "hour",
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> List[Tuple[datetime, int]]:
+        """Return (bucket, bytes) pairs for a tunnel from the rollup table"""
+        query = select(UsageRollup.bucket, UsageRollup.bytes_used).where(
+            UsageRollup.tunnel_id == tunnel_id,
+            UsageRollup.resolution == resolution,
+        )
+        if since:
+            query = query.where(UsageRollup.bucket >= since)
+        if until:
+            query = query.where(UsageRollup.bucket < until)
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(query.order_by(UsageRollup.bucket))
+            return [(row[0], row[1]) for row in result.all()]
+
+
+usage_collector = UsageCollector()
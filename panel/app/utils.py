@@ -1,9 +1,11 @@
 """Utility functions for address parsing and validation"""
+import hashlib
 import ipaddress
+import json
 import re
 import secrets
 import string
-from typing import Tuple, Optional
+from typing import Any, Dict, Tuple, Optional
 
 
 def parse_address_port(address_str: str) -> Tuple[str, Optional[int], bool]:
@@ -131,3 +133,13 @@ def generate_token(length: int = 16) -> str:
     alphabet = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
+
+def spec_hash(core: str, spec: Dict[str, Any]) -> str:
+    """
+    Hash a tunnel's core and spec in canonical JSON form.
+    
+    Node agents store the same hash with every applied tunnel, so the panel
+    can tell whether a node runs exactly the spec it would send.
+    """
+    canonical = json.dumps({"core": core, "spec": spec}, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
@@ -8,7 +8,7 @@ from pathlib import Path
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from app.database import AsyncSessionLocal
-from app.models import Tunnel, Node, CoreResetConfig
+from app.models import Tunnel, CoreResetConfig
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
@@ -17,17 +17,24 @@ from fastapi.staticfiles import StaticFiles
 
 from app.config import settings
 from app.database import init_db
-from app.routers import nodes, tunnels, panel, status, logs, auth, core_health
+from app.routers import nodes, tunnels, panel, status, logs, auth, core_health, jobs
 from app.routers import settings as settings_router
-from app.node_server import NodeServer
+from app.node_server import NodeServer, node_server
 from app.gost_forwarder import gost_forwarder
 from app.rathole_server import rathole_server_manager
 from app.backhaul_manager import backhaul_manager
 from app.chisel_server import chisel_server_manager
 from app.frp_server import frp_server_manager
 from app.frp_comm_manager import frp_comm_manager
+from app.pid_registry import pid_registry
+from app.process_monitor import process_monitor
+from app.usage_collector import usage_collector
+from app.tunnel_enforcer import tunnel_enforcer
+from app.job_queue import job_queue
+from app.reapply_engine import reapply_engine
+from app.change_sequence import etag_middleware
 from app.telegram_bot import telegram_bot
-from app.node_client import NodeClient
+from app.node_client import node_pool
 from app.models import Settings
 import logging
 
@@ -43,9 +50,12 @@ async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
     await init_db()
     
-    h2_server = NodeServer()
-    await h2_server.start()
-    app.state.h2_server = h2_server
+    # Before anything that can spawn a core: every entry on disk is from a previous run
+    orphans = await asyncio.to_thread(pid_registry.reap_orphans)
+    if orphans:
+        logger.info(f"Killed {orphans} orphaned core process groups from a previous run")
+    
+    cert_generator = NodeServer()
     
     try:
         cert_path = Path(settings.node_cert_path)
@@ -54,9 +64,9 @@ async def lifespan(app: FastAPI):
         
         if not cert_path.exists() or cert_path.stat().st_size == 0:
             logger.info("Generating CA certificate for Iran nodes on startup...")
-            h2_server.cert_path = str(cert_path)
-            h2_server.key_path = str(cert_path.parent / "ca.key")
-            await h2_server._generate_certs(common_name="CIMEX CA")
+            cert_generator.cert_path = str(cert_path)
+            cert_generator.key_path = str(cert_path.parent / "ca.key")
+            await cert_generator._generate_certs(common_name="CIMEX CA")
             logger.info(f"CA certificate generated at {cert_path}")
     except Exception as e:
         logger.warning(f"Failed to generate CA certificate on startup: {e}")
@@ -68,13 +78,16 @@ async def lifespan(app: FastAPI):
         
         if not server_cert_path.exists() or server_cert_path.stat().st_size == 0:
             logger.info("Generating CA certificate for foreign servers on startup...")
-            h2_server.cert_path = str(server_cert_path)
-            h2_server.key_path = str(server_cert_path.parent / "ca-server.key")
-            await h2_server._generate_certs(common_name="CIMEX Server CA")
+            cert_generator.cert_path = str(server_cert_path)
+            cert_generator.key_path = str(server_cert_path.parent / "ca-server.key")
+            await cert_generator._generate_certs(common_name="CIMEX Server CA")
             logger.info(f"Server CA certificate generated at {server_cert_path}")
     except Exception as e:
         logger.warning(f"Failed to generate server CA certificate on startup: {e}")
     
+    await node_server.start()
+    app.state.h2_server = node_server
+    
     app.state.gost_forwarder = gost_forwarder
     
     app.state.rathole_server_manager = rathole_server_manager
@@ -86,16 +99,26 @@ async def lifespan(app: FastAPI):
     await _load_and_start_frp_comm()
     await _load_and_start_telegram_bot()
     await _load_and_start_tunnel_reapply()
+    await usage_collector.start()
+    await tunnel_enforcer.start()
+    await job_queue.start(app)
     
     await _restore_forwards()
     
-    await _restore_node_tunnels()
+    app.state.restore_task = asyncio.create_task(_restore_node_tunnels())
     
     reset_task = asyncio.create_task(_auto_reset_scheduler(app))
     app.state.reset_task = reset_task
     
     yield
     
+    if not app.state.restore_task.done():
+        app.state.restore_task.cancel()
+        try:
+            await app.state.restore_task
+        except asyncio.CancelledError:
+            pass
+    
     if hasattr(app.state, 'reset_task'):
         app.state.reset_task.cancel()
         try:
@@ -110,8 +133,14 @@ async def lifespan(app: FastAPI):
         app.state.frp_comm_manager.stop()
     
     await telegram_bot.stop()
+    await usage_collector.stop()
+    await tunnel_enforcer.stop()
+    await job_queue.stop()
+    
+    await node_pool.aclose()
     
-    gost_forwarder.cleanup_all()
+    await asyncio.to_thread(gost_forwarder.cleanup_all)
+    process_monitor.shutdown()
 
 
 async def _restore_forwards():
@@ -145,7 +174,8 @@ async def _restore_forwards():
                 try:
                     use_ipv6 = tunnel.spec.get("use_ipv6", False)
                     logger.info(f"Restoring gost forwarding for tunnel {tunnel.id}: {tunnel.type}://:{panel_port} -> {forward_to}, use_ipv6={use_ipv6}")
-                    gost_forwarder.start_forward(
+                    await asyncio.to_thread(
+                        gost_forwarder.start_forward,
                         tunnel_id=tunnel.id,
                         local_port=int(panel_port),
                         forward_to=forward_to,
@@ -178,7 +208,8 @@ async def _restore_rathole_servers():
                     continue
                 
                 use_ipv6 = tunnel.spec.get("use_ipv6", False)
-                rathole_server_manager.start_server(
+                await asyncio.to_thread(
+                    rathole_server_manager.start_server,
                     tunnel_id=tunnel.id,
                     remote_addr=remote_addr,
                     token=token,
@@ -201,7 +232,7 @@ async def _restore_backhaul_servers():
                     continue
 
                 try:
-                    backhaul_manager.start_server(tunnel.id, tunnel.spec or {})
+                    await asyncio.to_thread(backhaul_manager.start_server, tunnel.id, tunnel.spec or {})
                 except Exception as exc:
                     logger.error(
                         "Failed to restore Backhaul server for tunnel %s: %s",
@@ -237,7 +268,8 @@ async def _restore_chisel_servers():
                         server_control_port = int(server_control_port)
                     else:
                         server_control_port = int(listen_port) + 10000
-                    chisel_server_manager.start_server(
+                    await asyncio.to_thread(
+                        chisel_server_manager.start_server,
                         tunnel_id=tunnel.id,
                         server_port=server_control_port,
                         auth=auth,
@@ -272,7 +304,8 @@ async def _restore_frp_servers():
                     continue
                 
                 try:
-                    frp_server_manager.start_server(
+                    await asyncio.to_thread(
+                        frp_server_manager.start_server,
                         tunnel_id=tunnel.id,
                         bind_port=int(bind_port),
                         token=token
@@ -292,367 +325,24 @@ async def _restore_node_tunnels():
     
     Note: Nodes restore their own tunnels on startup independently.
     This function syncs the panel's view with nodes, but tunnels will
-    continue working even if panel is down or this sync fails.
+    continue working even if panel is down or this sync fails. It runs in
+    the background after startup and only pushes the tunnels nodes report
+    as missing, drifted or not running, batched per node under the
+    reapply concurrency limits (see ReapplyEngine.reconcile).
     """
     try:
         logger.info("Starting to sync node-side tunnels with panel database...")
-        async with AsyncSessionLocal() as db:
-            result = await db.execute(select(Tunnel).where(Tunnel.status == "active"))
-            tunnels = result.scalars().all()
-            
-            logger.info(f"Found {len(tunnels)} active tunnels to check for sync")
-            
-            reverse_tunnels = [t for t in tunnels if t.core in ["rathole", "backhaul", "chisel", "frp"]]
-            gost_tunnels = [t for t in tunnels if t.core == "gost" and t.node_id]
-            
-            if not reverse_tunnels and not gost_tunnels:
-                logger.info("No node-side tunnels to sync")
-                return
-            
-            logger.info(f"Found {len(reverse_tunnels)} active reverse tunnels and {len(gost_tunnels)} node-side GOST tunnels to sync")
-            
-            client = NodeClient()
-            restored_count = 0
-            failed_count = 0
-            skipped_count = 0
-            
-            for tunnel in reverse_tunnels:
-                try:
-                    iran_node = None
-                    foreign_node = None
-                    
-                    if tunnel.node_id:
-                        result = await db.execute(select(Node).where(Node.id == tunnel.node_id))
-                        iran_node = result.scalar_one_or_none()
-                        if iran_node and iran_node.node_metadata.get("role") != "iran":
-                            foreign_node = iran_node
-                            iran_node = None
-                    
-                    if not foreign_node:
-                        result = await db.execute(select(Node))
-                        all_nodes = result.scalars().all()
-                        foreign_nodes = [n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "foreign"]
-                        if foreign_nodes:
-                            foreign_node = foreign_nodes[0]
-                    
-                    if not iran_node:
-                        if tunnel.node_id:
-                            result = await db.execute(select(Node).where(Node.id == tunnel.node_id))
-                            iran_node = result.scalar_one_or_none()
-                        if not iran_node:
-                            result = await db.execute(select(Node))
-                            all_nodes = result.scalars().all()
-                            iran_nodes = [n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "iran"]
-                            if iran_nodes:
-                                iran_node = iran_nodes[0]
-                    
-                    if not foreign_node or not iran_node:
-                        logger.warning(f"Tunnel {tunnel.id}: Missing foreign or iran node, skipping sync (nodes will restore themselves)")
-                        skipped_count += 1
-                        continue
-                    
-                    server_spec = tunnel.spec.copy() if tunnel.spec else {}
-                    server_spec["mode"] = "server"
-                    
-                    client_spec = tunnel.spec.copy() if tunnel.spec else {}
-                    client_spec["mode"] = "client"
-                    
-                    if tunnel.core == "rathole":
-                        transport = server_spec.get("transport") or server_spec.get("type") or "tcp"
-                        proxy_port = server_spec.get("remote_port") or server_spec.get("listen_port")
-                        token = server_spec.get("token")
-                        if not proxy_port or not token:
-                            logger.warning(f"Tunnel {tunnel.id}: Missing remote_port or token, skipping")
-                            continue
-                        
-                        remote_addr = server_spec.get("remote_addr", "0.0.0.0:23333")
-                        from app.utils import parse_address_port
-                        _, control_port, _ = parse_address_port(remote_addr)
-                        if not control_port:
-                            import hashlib
-                            port_hash = int(hashlib.md5(tunnel.id.encode()).hexdigest()[:8], 16)
-                            control_port = 23333 + (port_hash % 1000)  # Ports 23333-24332
-                        server_spec["bind_addr"] = f"0.0.0.0:{control_port}"
-                        server_spec["proxy_port"] = proxy_port
-                        server_spec["transport"] = transport
-                        server_spec["type"] = transport
-                        if "websocket_tls" in server_spec:
-                            server_spec["websocket_tls"] = server_spec["websocket_tls"]
-                        elif "tls" in server_spec:
-                            server_spec["websocket_tls"] = server_spec["tls"]
-                        
-                        iran_node_ip = iran_node.node_metadata.get("ip_address")
-                        if not iran_node_ip:
-                            logger.warning(f"Tunnel {tunnel.id}: Iran node has no IP address, skipping")
-                            continue
-                        transport_lower = transport.lower()
-                        if transport_lower in ("websocket", "ws"):
-                            use_tls = bool(server_spec.get("websocket_tls") or server_spec.get("tls"))
-                            protocol = "wss://" if use_tls else "ws://"
-                            client_spec["remote_addr"] = f"{protocol}{iran_node_ip}:{control_port}"
-                        else:
-                            client_spec["remote_addr"] = f"{iran_node_ip}:{control_port}"
-                        client_spec["transport"] = transport
-                        client_spec["type"] = transport
-                        client_spec["token"] = token
-                        if "websocket_tls" in server_spec:
-                            client_spec["websocket_tls"] = server_spec["websocket_tls"]
-                        elif "tls" in server_spec:
-                            client_spec["websocket_tls"] = server_spec["tls"]
-                        local_addr = client_spec.get("local_addr")
-                        if not local_addr:
-                            local_addr = f"{iran_node_ip}:{proxy_port}"
-                        client_spec["local_addr"] = local_addr
-                    
-                    elif tunnel.core == "chisel":
-                        listen_port = server_spec.get("listen_port") or server_spec.get("remote_port")
-                        if not listen_port:
-                            logger.warning(f"Tunnel {tunnel.id}: Missing listen_port, skipping")
-                            continue
-                        
-                        iran_node_ip = iran_node.node_metadata.get("ip_address")
-                        if not iran_node_ip:
-                            logger.warning(f"Tunnel {tunnel.id}: Iran node has no IP address, skipping")
-                            continue
-                        import hashlib
-                        port_hash = int(hashlib.md5(tunnel.id.encode()).hexdigest()[:8], 16)
-                        server_control_port = server_spec.get("control_port") or (int(listen_port) + 10000 + (port_hash % 1000))
-                        server_spec["server_port"] = server_control_port
-                        server_spec["reverse_port"] = listen_port
-                        auth = server_spec.get("auth")
-                        if auth:
-                            server_spec["auth"] = auth
-                        fingerprint = server_spec.get("fingerprint")
-                        if fingerprint:
-                            server_spec["fingerprint"] = fingerprint
-                        
-                        client_spec["server_url"] = f"http://{iran_node_ip}:{server_control_port}"
-                        client_spec["reverse_port"] = listen_port
-                        if auth:
-                            client_spec["auth"] = auth
-                        if fingerprint:
-                            client_spec["fingerprint"] = fingerprint
-                        local_addr = client_spec.get("local_addr")
-                        if not local_addr:
-                            local_addr = f"{iran_node_ip}:{listen_port}"
-                        client_spec["local_addr"] = local_addr
-                    
-                    elif tunnel.core == "frp":
-                        bind_port = server_spec.get("bind_port", 7000)
-                        token = server_spec.get("token")
-                        server_spec["bind_port"] = bind_port
-                        if token:
-                            server_spec["token"] = token
-                        
-                        iran_node_ip = iran_node.node_metadata.get("ip_address")
-                        if not iran_node_ip:
-                            logger.warning(f"Tunnel {tunnel.id}: Iran node has no IP address, skipping")
-                            continue
-                        client_spec["server_addr"] = iran_node_ip
-                        client_spec["server_port"] = bind_port
-                        if token:
-                            client_spec["token"] = token
-                        tunnel_type = tunnel.type.lower() if tunnel.type else "tcp"
-                        if tunnel_type not in ["tcp", "udp"]:
-                            tunnel_type = "tcp"
-                        client_spec["type"] = tunnel_type
-                    
-                    elif tunnel.core == "backhaul":
-                        transport = server_spec.get("transport") or server_spec.get("type") or "tcp"
-                        import hashlib
-                        port_hash = int(hashlib.md5(tunnel.id.encode()).hexdigest()[:8], 16)
-                        control_port = server_spec.get("control_port") or server_spec.get("listen_port") or (3080 + (port_hash % 1000))
-                        public_port = server_spec.get("public_port") or server_spec.get("remote_port") or server_spec.get("listen_port")
-                        target_host = server_spec.get("target_host", "127.0.0.1")
-                        target_port = server_spec.get("target_port") or public_port
-                        token = server_spec.get("token")
-                        
-                        if not public_port:
-                            logger.warning(f"Tunnel {tunnel.id}: Missing public_port, skipping")
-                            continue
-                        
-                        bind_ip = server_spec.get("bind_ip") or server_spec.get("listen_ip") or "0.0.0.0"
-                        server_spec["bind_addr"] = f"{bind_ip}:{control_port}"
-                        server_spec["transport"] = transport
-                        server_spec["type"] = transport
-                        if target_port:
-                            target_addr = f"{target_host}:{target_port}"
-                            server_spec["ports"] = [f"{public_port}={target_addr}"]
-                        else:
-                            server_spec["ports"] = [str(public_port)]
-                        if token:
-                            server_spec["token"] = token
-                        
-                        iran_node_ip = iran_node.node_metadata.get("ip_address")
-                        if not iran_node_ip:
-                            logger.warning(f"Tunnel {tunnel.id}: Iran node has no IP address, skipping")
-                            continue
-                        transport_lower = transport.lower()
-                        if transport_lower in ("ws", "wsmux"):
-                            use_tls = bool(server_spec.get("tls_cert") or server_spec.get("server_options", {}).get("tls_cert"))
-                            protocol = "wss://" if use_tls else "ws://"
-                            client_spec["remote_addr"] = f"{protocol}{iran_node_ip}:{control_port}"
-                        else:
-                            client_spec["remote_addr"] = f"{iran_node_ip}:{control_port}"
-                        client_spec["transport"] = transport
-                        client_spec["type"] = transport
-                        if token:
-                            client_spec["token"] = token
-                    
-                    if not iran_node.node_metadata.get("api_address"):
-                        iran_node.node_metadata["api_address"] = f"http://{iran_node.node_metadata.get('ip_address', iran_node.fingerprint)}:{iran_node.node_metadata.get('api_port', 8888)}"
-                        await db.commit()
-                    
-                    logger.info(f"Restoring tunnel {tunnel.id}: applying server config to iran node {iran_node.id}")
-                    server_response = await client.send_to_node(
-                        node_id=iran_node.id,
-                        endpoint="/api/agent/tunnels/apply",
-                        data={
-                            "tunnel_id": tunnel.id,
-                            "core": tunnel.core,
-                            "type": tunnel.type,
-                            "spec": server_spec
-                        }
-                    )
-                    
-                    if server_response.get("status") == "error":
-                        error_msg = server_response.get("message", "Unknown error from iran node")
-                        logger.error(f"Failed to restore tunnel {tunnel.id} on iran node {iran_node.id}: {error_msg}")
-                        failed_count += 1
-                        continue
-                    
-                    if not foreign_node.node_metadata.get("api_address"):
-                        foreign_node.node_metadata["api_address"] = f"http://{foreign_node.node_metadata.get('ip_address', foreign_node.fingerprint)}:{foreign_node.node_metadata.get('api_port', 8888)}"
-                        await db.commit()
-                    
-                    logger.info(f"Restoring tunnel {tunnel.id}: applying client config to foreign node {foreign_node.id}")
-                    client_response = await client.send_to_node(
-                        node_id=foreign_node.id,
-                        endpoint="/api/agent/tunnels/apply",
-                        data={
-                            "tunnel_id": tunnel.id,
-                            "core": tunnel.core,
-                            "type": tunnel.type,
-                            "spec": client_spec
-                        }
-                    )
-                    
-                    if client_response.get("status") == "error":
-                        error_msg = client_response.get("message", "Unknown error from foreign node")
-                        logger.error(f"Failed to restore tunnel {tunnel.id} on foreign node {foreign_node.id}: {error_msg}")
-                        failed_count += 1
-                    else:
-                        logger.info(f"Successfully restored tunnel {tunnel.id} on both nodes")
-                        restored_count += 1
-                        
-                except Exception as e:
-                    logger.error(f"Failed to restore tunnel {tunnel.id}: {e}", exc_info=True)
-                    failed_count += 1
-            
-            for tunnel in gost_tunnels:
-                try:
-                    logger.info(f"Restoring GOST tunnel {tunnel.id}: node_id={tunnel.node_id}, spec={tunnel.spec}")
-                    
-                    forward_to = tunnel.spec.get("forward_to") if tunnel.spec else None
-                    listen_port = tunnel.spec.get("listen_port") or tunnel.spec.get("remote_port")
-                    
-                    if forward_to:
-                        if ":" in forward_to:
-                            foreign_ip, remote_port = forward_to.rsplit(":", 1)
-                        else:
-                            foreign_ip = forward_to
-                            remote_port = tunnel.spec.get("remote_port", 8080)
-                    else:
-                        remote_ip = tunnel.spec.get("remote_ip", "127.0.0.1")
-                        remote_port = tunnel.spec.get("remote_port", 8080)
-                        foreign_ip = remote_ip
-                    
-                    if not listen_port:
-                        logger.warning(f"GOST tunnel {tunnel.id}: Missing listen_port, checking if panel-side forwarding...")
-                        panel_port = tunnel.spec.get("remote_port")
-                        if panel_port:
-                            listen_port = panel_port
-                        else:
-                            logger.warning(f"GOST tunnel {tunnel.id}: No listen_port found, skipping node-side restore (may be panel-side)")
-                            continue
-                    
-                    if not tunnel.node_id:
-                        logger.info(f"GOST tunnel {tunnel.id}: No node_id, this is a panel-side forwarding tunnel (handled by _restore_forwards)")
-                        continue
-                    
-                    iran_node = None
-                    if tunnel.node_id:
-                        result = await db.execute(select(Node).where(Node.id == tunnel.node_id))
-                        iran_node = result.scalar_one_or_none()
-                        if iran_node and iran_node.node_metadata.get("role") != "iran":
-                            logger.warning(f"GOST tunnel {tunnel.id}: node_id points to non-iran node, skipping")
-                            continue
-                    
-                    if not iran_node:
-                        result = await db.execute(select(Node))
-                        all_nodes = result.scalars().all()
-                        iran_nodes = [n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "iran"]
-                        if iran_nodes:
-                            iran_node = iran_nodes[0]
-                    
-                    if not iran_node:
-                        logger.warning(f"GOST tunnel {tunnel.id}: No iran node found, skipping sync (node will restore itself)")
-                        skipped_count += 1
-                        continue
-                    
-                    if not foreign_ip or foreign_ip in ["127.0.0.1", "localhost"]:
-                        result = await db.execute(select(Node))
-                        all_nodes = result.scalars().all()
-                        foreign_nodes = [n for n in all_nodes if n.node_metadata and n.node_metadata.get("role") == "foreign"]
-                        if foreign_nodes:
-                            foreign_node = foreign_nodes[0]
-                            foreign_ip = foreign_node.node_metadata.get("ip_address")
-                    
-                    if not foreign_ip:
-                        logger.warning(f"GOST tunnel {tunnel.id}: Cannot determine foreign IP, skipping restore")
-                        continue
-                    
-                    use_ipv6 = tunnel.spec.get("use_ipv6", False)
-                    
-                    gost_spec = {
-                        "listen_port": int(listen_port),
-                        "forward_to": f"{foreign_ip}:{remote_port}",
-                        "type": tunnel.type,
-                        "use_ipv6": use_ipv6
-                    }
-                    
-                    client = NodeClient()
-                    if not iran_node.node_metadata.get("api_address"):
-                        iran_node.node_metadata["api_address"] = f"http://{iran_node.node_metadata.get('ip_address', iran_node.fingerprint)}:{iran_node.node_metadata.get('api_port', 8888)}"
-                        await db.commit()
-                    
-                    logger.info(f"Restoring GOST tunnel {tunnel.id}: applying to iran node {iran_node.id}, spec={gost_spec}")
-                    response = await client.send_to_node(
-                        node_id=iran_node.id,
-                        endpoint="/api/agent/tunnels/apply",
-                        data={
-                            "tunnel_id": tunnel.id,
-                            "core": "gost",
-                            "type": tunnel.type,
-                            "spec": gost_spec
-                        }
-                    )
-                    
-                    if response.get("status") != "success":
-                        error_msg = response.get("message", "Unknown error from iran node")
-                        logger.error(f"Failed to restore GOST tunnel {tunnel.id} on iran node {iran_node.id}: {error_msg}")
-                        failed_count += 1
-                    else:
-                        logger.info(f"Successfully restored GOST tunnel {tunnel.id} on iran node {iran_node.id}")
-                        restored_count += 1
-                        
-                except Exception as e:
-                    logger.error(f"Failed to restore GOST tunnel {tunnel.id}: {e}", exc_info=True)
-                    failed_count += 1
-            
-            logger.info(f"Tunnel sync completed: {restored_count} synced, {failed_count} failed, {skipped_count} skipped out of {len(reverse_tunnels) + len(gost_tunnels)} total")
-            logger.info("Note: Nodes restore their own tunnels on startup, so tunnels work even if panel is down")
-                    
+        summary = await reapply_engine.reconcile()
+        if summary.get("status") != "success":
+            logger.info(f"Tunnel sync skipped: {summary.get('message')}")
+            return
+        logger.info(
+            f"Tunnel sync completed: {summary['in_sync']} in sync, {summary['pushed']} synced, "
+            f"{summary['failed']} failed, {summary['unreachable']} on unreachable nodes"
+        )
+        logger.info("Note: Nodes restore their own tunnels on startup, so tunnels work even if panel is down")
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         logger.error(f"Error restoring node tunnels: {e}", exc_info=True)
 
@@ -744,12 +434,14 @@ app = FastAPI(
     redoc_url="/redoc" if settings.docs_enabled else None,
 )
 
+app.middleware("http")(etag_middleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
@@ -759,6 +451,7 @@ app.include_router(tunnels.router, prefix="/api/tunnels", tags=["tunnels"])
 app.include_router(status.router, prefix="/api/status", tags=["status"])
 app.include_router(logs.router, prefix="/api/logs", tags=["logs"])
 app.include_router(core_health.router, prefix="/api/core-health", tags=["core-health"])
+app.include_router(jobs.router, prefix="/api/jobs", tags=["jobs"])
 app.include_router(settings_router.router)
 
 static_dir = os.path.join(os.path.dirname(__file__), "static")